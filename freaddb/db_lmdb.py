@@ -1,32 +1,101 @@
-import gc
+import base64
+import heapq
 import math
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import operator
 import os
 import pickle
+import queue
 import random
 import struct
 import sys
-from collections import defaultdict
-from dataclasses import asdict, dataclass
+import tempfile
+import threading
+import weakref
+import zlib
+from array import array
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict, dataclass, replace
 from datetime import datetime
 from enum import Enum
+from functools import lru_cache, partial, reduce
+from itertools import count, islice
 from numbers import Number
-from typing import (Any, ByteString, Callable, Iterator, List, Optional, Tuple,
-                    Union)
+from operator import itemgetter
+from typing import Any, ByteString, Callable, Iterator, List, Optional, Tuple, Union
 
 import lmdb
 import msgpack
 import numpy
 import psutil
 import ujson
-from lz4 import frame
+from lz4 import block, frame
 from pyroaring import BitMap
 from tqdm import tqdm
 
 ENCODING = "utf-8"
 SIZE_1GB = 1_073_741_824  # 1GB
+SIZE_1MB = 1_048_576  # 1MB
 LMDB_MAX_KEY = 511
 LMDB_MAP_SIZE = SIZE_1GB
 LMDB_BUFF_LIMIT = SIZE_1GB
+SCAN_BATCH_SIZE = 1_000
+POSITION_INDEX_STEP = 4_096
+# Returned by WriteBuffer.get for keys that are not buffered
+BUFF_MISSING = object()
+# Returned by ValueCache.get for keys that are not cached
+CACHE_MISSING = object()
+# Orders read sessions and cache invalidations, see ValueCache.put
+CACHE_CLOCK = count()
+SERIALIZE_CHUNK_SIZE = 100_000
+# Bytes of the dict slot and the int of an indexed WriteBuffer key, on top
+# of the key object itself (measured on CPython with 1M keys)
+WRITE_BUFFER_INDEX_ENTRY = 72
+# Value header byte: 2 bits version, 2 bits ValueCompression, 4 bits ValueCodec
+VALUE_HEADER_VERSION = 1
+# Smaller values are not worth compressing
+VALUE_COMPRESS_MIN_SIZE = 32
+# LZ4 matches within 64KB, a larger dictionary is not used
+VALUE_DICT_SIZE = 65_536
+VALUE_DICT_SAMPLES = 4_096
+# Items per block of ToBytes.INT_PACKED lists
+INT_PACK_BLOCK = 128
+# Byte alignment of the data of ToBytes.NDARRAY values
+NDARRAY_ALIGNMENT = 16
+# Variable-length field types of RecordSchema
+RECORD_VAR_TYPES = ("str", "bytes", "obj")
+# struct formats of fixed-width record fields by numpy dtype kind and size
+RECORD_STRUCT_FORMATS = {
+    ("b", 1): "?",
+    ("i", 1): "b",
+    ("i", 2): "h",
+    ("i", 4): "i",
+    ("i", 8): "q",
+    ("u", 1): "B",
+    ("u", 2): "H",
+    ("u", 4): "I",
+    ("u", 8): "Q",
+    ("f", 2): "e",
+    ("f", 4): "f",
+    ("f", 8): "d",
+}
+# Intersect posting lists by binary search once one list is this much longer
+POSTING_GALLOP_RATIO = 32
+# File signature of frozen sub databases, see FrozenMap
+FROZEN_MAGIC = b"FRDBMPH2"
+# Average keys per bucket of the perfect hash, one keeps the build fast
+FROZEN_BUCKET_SIZE = 1
+FROZEN_MAX_DISPLACEMENT = 1 << 24
+FROZEN_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+# File signature of frozen sub databases with dense integer keys, see DenseMap
+DENSE_MAGIC = b"FRDBDNS1"
+# Integer keys are dense if the largest key + 1 is at most this many times
+# the number of keys
+DENSE_KEY_RATIO = 2
+UINT64_MASK = (1 << 64) - 1
 
 
 class ToBytes(int, Enum):
@@ -35,11 +104,49 @@ class ToBytes(int, Enum):
     INT_BITMAP = 2
     BYTES = 3
     PICKLE = 4
+    # Sorted uint32 lists, delta bit-packed in blocks with a skip table
+    INT_PACKED = 5
+    # numpy arrays of any numeric dtype and shape, decoded without copying
+    NDARRAY = 6
+    # Records of DBSpec.record_schema, fields are decoded one by one
+    RECORD = 7
+
+
+class ValueCodec(int, Enum):
+    # Serializers recorded in the value header byte
+    RAW = 0
+    MSGPACK = 1
+    PICKLE = 2
+    NUMPY_UINT32 = 3
+    ROARING = 4
+    PACKED_INTS = 5
+    NDARRAY = 6
+    RECORD = 7
+
+
+class ValueCompression(int, Enum):
+    NONE = 0
+    LZ4 = 1
+    # LZ4 block with the dictionary trained for the sub database
+    LZ4_DICT = 2
+
+
+class KeyFormat(int, Enum):
+    # Native byte order integers, combined keys joined by "|"
+    LEGACY = 0
+    # Fixed-width big-endian integers, no deliminator
+    BIG_ENDIAN = 1
+    # Integers prefixed by their byte length, then big-endian bytes
+    VARINT = 2
 
 
 class DBUpdateType(int, Enum):
     SET = 0
     COUNTER = 1
+    MAX = 2
+    MIN = 3
+    LIST = 4
+    BITMAP_OR = 5
 
 
 def create_dir(file_dir: str):
@@ -64,72 +171,264 @@ def is_byte_obj(obj: Any) -> bool:
     return False
 
 
+def pack_varint(number: int) -> bytes:
+    # Length prefixed big-endian bytes keep the byte order of the numbers
+    n_bytes = (number.bit_length() + 7) // 8
+    return bytes((n_bytes,)) + number.to_bytes(n_bytes, "big")
+
+
+def unpack_varints(key: ByteString) -> Tuple[int, ...]:
+    key = bytes(key)
+    numbers = []
+    cur = 0
+    while cur < len(key):
+        n_bytes = key[cur]
+        cur += 1
+        numbers.append(int.from_bytes(key[cur : cur + n_bytes], "big"))
+        cur += n_bytes
+    return tuple(numbers)
+
+
+def get_prefix_upper_bound(prefix: bytes) -> Optional[bytes]:
+    # The smallest key greater than every key starting with prefix
+    prefix = prefix.rstrip(b"\xff")
+    if not prefix:
+        return None
+    return prefix[:-1] + bytes((prefix[-1] + 1,))
+
+
+def set_default(obj):
+    if isinstance(obj, set):
+        return sorted(list(obj))
+    raise TypeError
+
+
+# Merge operators of update_bulk_with_buffer: merge(db_value, new_value)
+# returns the value to write, or db_value itself to leave the key as is
+
+
+def merge_bitmap_or(db_value: BitMap, value) -> BitMap:
+    if not isinstance(value, BitMap):
+        value = BitMap(value)
+    if db_value.issuperset(value):
+        return db_value
+    return db_value | value
+
+
+def merge_set(db_value, value):
+    if isinstance(db_value, BitMap):
+        return merge_bitmap_or(db_value, value)
+    db_value_set = set(db_value)
+    if len(value) <= len(db_value_set) and db_value_set.issuperset(value):
+        return db_value
+    db_value_set.update(value)
+    return db_value_set
+
+
+def merge_counter(db_value, value):
+    return value + db_value
+
+
+def merge_max(db_value, value):
+    return value if value > db_value else db_value
+
+
+def merge_min(db_value, value):
+    return value if value < db_value else db_value
+
+
+def merge_list(db_value, value):
+    if not len(value):
+        return db_value
+    return list(db_value) + list(value)
+
+
+MERGE_OPERATORS = {
+    DBUpdateType.SET: merge_set,
+    DBUpdateType.COUNTER: merge_counter,
+    DBUpdateType.MAX: merge_max,
+    DBUpdateType.MIN: merge_min,
+    DBUpdateType.LIST: merge_list,
+    DBUpdateType.BITMAP_OR: merge_bitmap_or,
+}
+
+
+def get_merge_operator(update_type: Union[DBUpdateType, Callable]) -> Callable:
+    if callable(update_type):
+        return update_type
+    if update_type not in MERGE_OPERATORS:
+        raise ValueError(f"Error: Unknown update type {update_type}")
+    return MERGE_OPERATORS[DBUpdateType(update_type)]
+
+
+def pack_value_header(
+    codec: ValueCodec, compression: ValueCompression = ValueCompression.NONE
+) -> int:
+    return VALUE_HEADER_VERSION << 6 | compression << 4 | codec
+
+
+def invalid_value_header(value: ByteString):
+    raise ValueError(f"Error: Unknown value header {value[0]}")
+
+
+def train_value_dict(samples: List[bytes], dict_size: int = VALUE_DICT_SIZE) -> bytes:
+    """
+    Build an LZ4 dictionary from sample values: samples sharing the most
+    8-byte substrings with the other samples are kept until dict_size, the
+    most shared ones last, where LZ4 finds them first.
+    """
+    shingles = [
+        {sample[i : i + 8] for i in range(len(sample) - 7)} for sample in samples
+    ]
+    counts = Counter(shingle for sample in shingles for shingle in sample)
+    scores = [
+        sum(counts[shingle] - 1 for shingle in sample) / (len(sample) or 1)
+        for sample in shingles
+    ]
+    chosen, covered, size = [], set(), 0
+    for i in sorted(range(len(samples)), key=scores.__getitem__, reverse=True):
+        if size >= dict_size or scores[i] <= 0:
+            break
+        # Skip samples adding no shared substrings to the dictionary
+        new_shingles = shingles[i] - covered
+        if not any(counts[shingle] > 1 for shingle in new_shingles):
+            continue
+        covered |= new_shingles
+        chosen.append(samples[i])
+        size += len(samples[i])
+    return b"".join(reversed(chosen))[-dict_size:]
+
+
+def get_value_payload(value: ByteString, value_dict: Optional[bytes] = None):
+    """
+    Get the serialized value after the header byte, decompressed
+    """
+    compression = (value[0] >> 4) & 3
+    payload = memoryview(value)[1:]
+    if compression == ValueCompression.LZ4:
+        return block.decompress(payload)
+    if compression == ValueCompression.LZ4_DICT:
+        return block.decompress(payload, dict=value_dict)
+    return payload
+
+
+@lru_cache(maxsize=None)
+def get_value_decoders(
+    value_dict: Optional[bytes] = None, record_schema: Optional["RecordSchema"] = None
+) -> Tuple[Callable, ...]:
+    """
+    Decoders of values with a header byte, indexed by the header byte
+    """
+    payload_decoders = {
+        ValueCodec.RAW: bytes,
+        ValueCodec.MSGPACK: partial(msgpack.unpackb, strict_map_key=False),
+        ValueCodec.PICKLE: pickle.loads,
+        ValueCodec.NUMPY_UINT32: partial(numpy.frombuffer, dtype=numpy.uint32),
+        ValueCodec.ROARING: lambda payload: BitMap.deserialize(bytes(payload)),
+        ValueCodec.PACKED_INTS: unpack_sorted_ints,
+        ValueCodec.NDARRAY: unpack_ndarray,
+    }
+    if record_schema is not None:
+        payload_decoders[ValueCodec.RECORD] = record_schema.decode
+    decoders = [invalid_value_header] * 256
+
+    def uncompressed(decode_payload):
+        def decode_value(value):
+            return decode_payload(memoryview(value)[1:])
+
+        return decode_value
+
+    def lz4_compressed(decode_payload):
+        decompress = block.decompress
+
+        def decode_value(value):
+            return decode_payload(decompress(memoryview(value)[1:]))
+
+        return decode_value
+
+    def lz4_dict_compressed(decode_payload):
+        decompress = block.decompress
+
+        def decode_value(value):
+            return decode_payload(decompress(memoryview(value)[1:], dict=value_dict))
+
+        return decode_value
+
+    for value_codec, decode_payload in payload_decoders.items():
+        header = pack_value_header(value_codec)
+        decoders[header] = uncompressed(decode_payload)
+        header = pack_value_header(value_codec, ValueCompression.LZ4)
+        decoders[header] = lz4_compressed(decode_payload)
+        if value_dict:
+            header = pack_value_header(value_codec, ValueCompression.LZ4_DICT)
+            decoders[header] = lz4_dict_compressed(decode_payload)
+    # Uncompressed numpy arrays are views of the value after the header
+    header = pack_value_header(ValueCodec.NUMPY_UINT32)
+    decoders[header] = partial(numpy.frombuffer, dtype=numpy.uint32, offset=1)
+    return tuple(decoders)
+
+
+@lru_cache(maxsize=None)
+def get_codec(
+    integerkey: bool = False,
+    is_64bit: bool = False,
+    combinekey: bool = False,
+    bytes_value: ToBytes = ToBytes.OBJ,
+    compress_value: bool = False,
+    key_format: KeyFormat = KeyFormat.LEGACY,
+    value_header: bool = False,
+    value_dict: Optional[str] = None,
+    record_schema: Optional[Tuple] = None,
+) -> "DBCodec":
+    return DBCodec(
+        DBSpec(
+            name="",
+            integerkey=integerkey,
+            is_64bit=is_64bit,
+            combinekey=combinekey,
+            bytes_value=bytes_value,
+            compress_value=compress_value,
+            key_format=key_format,
+            value_header=value_header,
+            value_dict=value_dict,
+            record_schema=record_schema,
+        )
+    )
+
+
 def deserialize_key(
     key: Any,
     integerkey=False,
     is_64bit=False,
     combinekey: bool = False,
     deliminator: str = "|",
+    key_format: KeyFormat = KeyFormat.LEGACY,
 ) -> Union[int, str]:
-    if combinekey:
-        # if integerkey:
-        step = 8 if is_64bit else 4
-        cur = 0
-        key_parts = []
-        while cur <= len(key):
-            start = cur
-            end = cur + step
-            if end > len(key):
-                break
-            key_parts.append(
-                deserialize_key(key[start:end], integerkey=True, is_64bit=is_64bit)
-            )
-            cur = end + 1
-        return tuple(key_parts)
-        # If not integerkey
-        # return tuple(key.decode(ENCODING).split(deliminator))
-        # return ValueError
-
-    # String key
-    if not integerkey:
-        if isinstance(key, memoryview):
-            key = key.tobytes()
-        return key.decode(ENCODING)
-
-    if is_64bit:
-        return struct.unpack("Q", key)[0]
-    else:
-        return struct.unpack("I", key)[0]
+    codec = get_codec(
+        integerkey=integerkey,
+        is_64bit=is_64bit,
+        combinekey=combinekey,
+        key_format=key_format,
+    )
+    return codec.decode_key(key)
 
 
 def deserialize_value(
     value: ByteString,
     bytes_value: ToBytes = ToBytes.OBJ,
     compress_value: bool = False,
+    value_header: bool = False,
+    value_dict: Optional[str] = None,
+    record_schema: Optional[Tuple] = None,
 ) -> Any:
-    if bytes_value == ToBytes.INT_NUMPY:
-        value = numpy.frombuffer(value, dtype=numpy.uint32)
-
-    elif bytes_value == ToBytes.INT_BITMAP:
-        if not isinstance(value, bytes):
-            value = bytes(value)
-        value = BitMap.deserialize(value)
-
-    elif bytes_value == ToBytes.BYTES:
-        if isinstance(value, memoryview):
-            value = value.tobytes()
-
-    else:  # mode == "msgpack"
-        if compress_value:
-            try:
-                value = frame.decompress(value)
-            except RuntimeError:
-                pass
-        if bytes_value == ToBytes.PICKLE:
-            value = pickle.loads(value)
-        else:
-            value = msgpack.unpackb(value, strict_map_key=False)
-    return value
+    codec = get_codec(
+        bytes_value=bytes_value,
+        compress_value=compress_value,
+        value_header=value_header,
+        value_dict=value_dict,
+        record_schema=record_schema,
+    )
+    return codec.decode_value(value)
 
 
 def deserialize(
@@ -140,17 +439,23 @@ def deserialize(
     is_64bit: bool = False,
     bytes_value: ToBytes = ToBytes.OBJ,
     compress_value: bool = False,
+    key_format: KeyFormat = KeyFormat.LEGACY,
+    value_header: bool = False,
+    value_dict: Optional[str] = None,
+    record_schema: Optional[Tuple] = None,
 ) -> Tuple[Any, Any]:
-    key = deserialize_key(
-        key=key,
-        integerkey=integerkey,
-        is_64bit=is_64bit,
-        combinekey=combinekey,
+    codec = get_codec(
+        integerkey,
+        is_64bit,
+        combinekey,
+        bytes_value,
+        compress_value,
+        key_format,
+        value_header,
+        value_dict,
+        record_schema,
     )
-    value = deserialize_value(
-        value=value, bytes_value=bytes_value, compress_value=compress_value
-    )
-    res_obj = (key, value)
+    res_obj = (codec.decode_key(key), codec.decode_value(value))
     return res_obj
 
 
@@ -161,36 +466,18 @@ def serialize_key(
     is_64bit: bool = False,
     deliminator: str = "|",
     get_postfix_deliminator: bool = False,
+    key_format: KeyFormat = KeyFormat.LEGACY,
 ) -> ByteString:
-    if combinekey:
-        # if integerkey:
-        if not isinstance(key[0], Number):
-            raise ValueError("Error: Please use int key tuple")
-        results = [serialize_key(k, integerkey=True, is_64bit=is_64bit) for k in key]
-        deliminator_bytes = "|".encode(ENCODING)
-        results = deliminator_bytes.join(results)
-        if get_postfix_deliminator:
-            results += serialize_key(deliminator)
-        return results[:LMDB_MAX_KEY]
-        # return ValueError
-        # If not integerkey
-        # results = "|".join([str(k) for k in key])
-        # if get_postfix_deliminator:
-        #     results += "|"
-        # return results.encode(ENCODING)[:LMDB_MAX_KEY]
-
-    if not integerkey:
-        if not isinstance(key, str):
-            key = str(key)
-        return key.encode(ENCODING)[:LMDB_MAX_KEY]
-
-    if not isinstance(key, int) and hasattr(key, "is_integer") and not key.is_integer():
-        raise TypeError
-
-    if is_64bit:
-        return struct.pack("Q", key)
-    else:
-        return struct.pack("I", key)
+    codec = get_codec(
+        integerkey=integerkey,
+        is_64bit=is_64bit,
+        combinekey=combinekey,
+        key_format=key_format,
+    )
+    results = codec.encode_key(key)
+    if combinekey and get_postfix_deliminator and key_format == KeyFormat.LEGACY:
+        results = (results + deliminator.encode(ENCODING))[:LMDB_MAX_KEY]
+    return results
 
 
 def serialize_value(
@@ -198,32 +485,22 @@ def serialize_value(
     bytes_value: ToBytes = ToBytes.OBJ,
     compress_value: bool = False,
     sort_values: bool = True,
+    value_header: bool = False,
+    value_dict: Optional[str] = None,
+    record_schema: Optional[Tuple] = None,
 ) -> ByteString:
-    def set_default(obj):
-        if isinstance(obj, set):
-            return sorted(list(obj))
-        raise TypeError
-
-    if bytes_value == ToBytes.INT_NUMPY:
-        if sort_values:
-            value = sorted(list(value))
+    if bytes_value == ToBytes.INT_NUMPY and not sort_values and not value_header:
         if not isinstance(value, numpy.ndarray):
             value = numpy.array(value, dtype=numpy.uint32)
-        value = value.tobytes()
-
-    elif bytes_value == ToBytes.INT_BITMAP:
-        value = BitMap(value).serialize()
-
-    else:  # mode == "msgpack"
-        if bytes_value == ToBytes.PICKLE:
-            value = pickle.dumps(value)
-        else:
-            if not isinstance(value, bytes) and not isinstance(value, bytearray):
-                value = msgpack.packb(value, default=set_default)
-        if compress_value:
-            value = frame.compress(value)
-
-    return value
+        return value.tobytes()
+    codec = get_codec(
+        bytes_value=bytes_value,
+        compress_value=compress_value,
+        value_header=value_header,
+        value_dict=value_dict,
+        record_schema=record_schema,
+    )
+    return codec.encode_value(value)
 
 
 def serialize(
@@ -234,17 +511,23 @@ def serialize(
     is_64bit: bool = False,
     bytes_value: ToBytes = ToBytes.OBJ,
     compress_value: bool = False,
+    key_format: KeyFormat = KeyFormat.LEGACY,
+    value_header: bool = False,
+    value_dict: Optional[str] = None,
+    record_schema: Optional[Tuple] = None,
 ) -> Tuple[ByteString, ByteString]:
-    key = serialize_key(
-        key=key,
-        integerkey=integerkey,
-        combinekey=combinekey,
-        is_64bit=is_64bit,
+    codec = get_codec(
+        integerkey,
+        is_64bit,
+        combinekey,
+        bytes_value,
+        compress_value,
+        key_format,
+        value_header,
+        value_dict,
+        record_schema,
     )
-    value = serialize_value(
-        value=value, bytes_value=bytes_value, compress_value=compress_value
-    )
-    res_obj = (key, value)
+    res_obj = (codec.encode_key(key), codec.encode_value(value))
     return res_obj
 
 
@@ -256,43 +539,449 @@ def preprocess_data_before_dump(
     bytes_value: ToBytes = ToBytes.OBJ,
     compress_value: bool = False,
     sort_key: bool = True,
+    codec: Optional["DBCodec"] = None,
+    key_format: KeyFormat = KeyFormat.LEGACY,
+    value_header: bool = False,
+    value_dict: Optional[str] = None,
+    record_schema: Optional[Tuple] = None,
 ) -> List[Any]:
+    if codec is None:
+        codec = get_codec(
+            integerkey,
+            is_64bit,
+            combinekey,
+            bytes_value,
+            compress_value,
+            key_format,
+            value_header,
+            value_dict,
+            record_schema,
+        )
+
     if isinstance(data, dict):
         data = list(data.items())
 
-    if sort_key and integerkey:
+    if sort_key and codec.lmdb_integerkey:
         data.sort(key=lambda x: x[0])
 
     first_key, first_value = data[0]
     to_bytes_key = not is_byte_obj(first_key)
     to_bytes_value = not is_byte_obj(first_value)
 
+    encode_key, encode_value = codec.encode_key, codec.encode_value
     for i in range(len(data)):
         k, v = data[i]
         if k is None:
             continue
         if to_bytes_key:
-            data[i][0] = serialize_key(
-                key=k,
-                integerkey=integerkey,
-                combinekey=combinekey,
-                is_64bit=is_64bit,
-            )
+            k = encode_key(k)
         if to_bytes_value:
-            data[i][1] = serialize_value(
-                value=v,
-                bytes_value=bytes_value,
-                compress_value=compress_value,
-            )
+            v = encode_value(v)
+        data[i] = (k, v)
 
-    if sort_key and not integerkey:
+    if sort_key and not codec.lmdb_integerkey:
         data.sort(key=lambda x: x[0])
 
-    if not isinstance(data[0], tuple):
-        data = [(k, v) for k, v in data]
     return data
 
 
+def preprocess_chunk(args: tuple) -> List[Any]:
+    chunk, kwargs = args
+    return preprocess_data_before_dump(chunk, **kwargs)
+
+
+def serialize_values_chunk(args: tuple) -> List[bytes]:
+    values, kwargs = args
+    encode_value = get_codec(**kwargs).encode_value
+    return [encode_value(value) for value in values]
+
+
+def preprocess_data_parallel(
+    data: List[Any],
+    pool: multiprocessing.pool.Pool,
+    chunk_size: int = SERIALIZE_CHUNK_SIZE,
+    **kwargs,
+) -> List[Any]:
+    """
+    preprocess_data_before_dump with a process pool: every chunk of data is
+    serialized and sorted by a worker, and the sorted runs are merged in key
+    order. Equal keys keep their order in data.
+    """
+    if isinstance(data, dict):
+        data = list(data.items())
+    runs = pool.map(
+        preprocess_chunk,
+        [(data[i : i + chunk_size], kwargs) for i in range(0, len(data), chunk_size)],
+    )
+    return list(heapq.merge(*runs, key=get_merge_key(get_codec(**kwargs))))
+
+
+def to_sorted_uint32(value) -> numpy.ndarray:
+    # Sort integer lists with numpy instead of sorted(list(value))
+    if isinstance(value, numpy.ndarray):
+        value = value.astype(numpy.uint32)
+    elif hasattr(value, "__len__"):
+        value = numpy.fromiter(value, dtype=numpy.uint32, count=len(value))
+    else:
+        value = numpy.fromiter(value, dtype=numpy.uint32)
+    value.sort()
+    return value
+
+
+def get_packed_layout(n_items: int, bit_widths: numpy.ndarray):
+    """
+    :return: number of deltas, byte size and byte offset of each block
+    """
+    n_deltas = numpy.full(len(bit_widths), INT_PACK_BLOCK - 1, dtype=numpy.int64)
+    if len(n_deltas):
+        n_deltas[-1] = n_items - (len(n_deltas) - 1) * INT_PACK_BLOCK - 1
+    sizes = (n_deltas * bit_widths + 7) // 8
+    offsets = numpy.cumsum(sizes) - sizes
+    return n_deltas, sizes, offsets
+
+
+def pack_sorted_ints(value) -> bytes:
+    """
+    Pack a sorted integer list in blocks of INT_PACK_BLOCK items: the first
+    item of each block is kept in a skip table, the deltas to the next items
+    are bit-packed with the bit width of the largest delta in the block.
+    Layout: n items (uint32), first items (uint32) and bit widths (uint8) of
+    the blocks, then the packed deltas of the blocks.
+    """
+    value = to_sorted_uint32(value).astype(numpy.int64)
+    n_items = len(value)
+    if not n_items:
+        return struct.pack("<I", 0)
+    n_blocks = -(-n_items // INT_PACK_BLOCK)
+    firsts = value[::INT_PACK_BLOCK]
+    deltas = numpy.diff(value)
+    # The delta to the first item of the next block is not stored
+    deltas[INT_PACK_BLOCK - 1 :: INT_PACK_BLOCK] = 0
+    deltas = numpy.append(deltas, numpy.zeros(n_blocks * INT_PACK_BLOCK - n_items + 1))
+    deltas = deltas.astype(numpy.int64).reshape(n_blocks, INT_PACK_BLOCK)[:, :-1]
+    max_deltas = deltas.max(axis=1)
+    bit_widths = numpy.zeros(n_blocks, dtype=numpy.uint8)
+    non_zero = max_deltas > 0
+    bit_widths[non_zero] = numpy.floor(numpy.log2(max_deltas[non_zero])) + 1
+    n_deltas, _, _ = get_packed_layout(n_items, bit_widths)
+
+    packed = [b""] * n_blocks
+    for bit_width in numpy.unique(bit_widths[bit_widths > 0]):
+        rows = numpy.flatnonzero(bit_widths == bit_width)
+        shifts = numpy.arange(bit_width, dtype=numpy.int64)
+        bits = ((deltas[rows][:, :, None] >> shifts) & 1).astype(numpy.uint8)
+        bits = numpy.packbits(bits.reshape(len(rows), -1), axis=1, bitorder="little")
+        for row, block in zip(rows.tolist(), bits):
+            packed[row] = block[: (n_deltas[row] * bit_width + 7) // 8].tobytes()
+
+    return b"".join(
+        [
+            struct.pack("<I", n_items),
+            firsts.astype(numpy.uint32).tobytes(),
+            bit_widths.tobytes(),
+        ]
+        + packed
+    )
+
+
+def get_packed_blocks(value: ByteString) -> Tuple[int, numpy.ndarray, numpy.ndarray]:
+    """
+    Read the skip table of a packed integer list
+    :return: n items, first item and bit width of each block
+    """
+    n_items = struct.unpack_from("<I", value)[0]
+    n_blocks = -(-n_items // INT_PACK_BLOCK)
+    firsts = numpy.frombuffer(value, dtype=numpy.uint32, count=n_blocks, offset=4)
+    bit_widths = numpy.frombuffer(
+        value, dtype=numpy.uint8, count=n_blocks, offset=4 + 4 * n_blocks
+    )
+    return n_items, firsts, bit_widths
+
+
+def unpack_sorted_ints(
+    value: ByteString, blocks: Optional[numpy.ndarray] = None
+) -> numpy.ndarray:
+    """
+    Unpack a packed integer list, or only some of its blocks, in order
+    """
+    n_items, firsts, bit_widths = get_packed_blocks(value)
+    n_blocks = len(firsts)
+    n_deltas, sizes, offsets = get_packed_layout(n_items, bit_widths)
+    data = numpy.frombuffer(value, dtype=numpy.uint8, offset=4 + 5 * n_blocks)
+    if blocks is None:
+        blocks = numpy.arange(n_blocks)
+    blocks = numpy.asarray(blocks, dtype=numpy.int64)
+
+    # Padded blocks of deltas, padding deltas are 0
+    deltas = numpy.zeros((len(blocks), INT_PACK_BLOCK), dtype=numpy.uint64)
+    block_widths = bit_widths[blocks]
+    for bit_width in numpy.unique(block_widths[block_widths > 0]):
+        rows = numpy.flatnonzero(block_widths == bit_width)
+        size = ((INT_PACK_BLOCK - 1) * int(bit_width) + 7) // 8
+        # Bytes after the end of a short last block are masked as 0
+        positions = offsets[blocks[rows]][:, None] + numpy.arange(size)
+        in_block = positions < (offsets + sizes)[blocks[rows]][:, None]
+        block_bytes = numpy.where(
+            in_block, data[numpy.minimum(positions, len(data) - 1)], 0
+        )
+        bits = numpy.unpackbits(
+            block_bytes.astype(numpy.uint8),
+            axis=1,
+            count=(INT_PACK_BLOCK - 1) * int(bit_width),
+            bitorder="little",
+        ).reshape(len(rows), INT_PACK_BLOCK - 1, bit_width)
+        weights = numpy.left_shift(1, numpy.arange(bit_width, dtype=numpy.uint64))
+        deltas[rows, 1:] = bits @ weights
+    responds = (firsts[blocks][:, None] + numpy.cumsum(deltas, axis=1)).astype(
+        numpy.uint32
+    )
+
+    n_block_items = n_deltas[blocks] + 1
+    if numpy.all(n_block_items == INT_PACK_BLOCK):
+        return responds.ravel()
+    return responds[numpy.arange(INT_PACK_BLOCK) < n_block_items[:, None]]
+
+
+def pack_ndarray(value, offset: int = 0) -> bytes:
+    """
+    Serialize an array as: data offset, ndim, dtype length (uint8), dtype
+    string, shape (uint64), padding, then the raw C-order data. The data
+    starts at a multiple of NDARRAY_ALIGNMENT bytes from the value start,
+    the value starts offset bytes before this header.
+    """
+    value = numpy.asarray(value)
+    if value.dtype.hasobject:
+        raise ValueError("Error: NDARRAY values cannot hold Python objects")
+    dtype = value.dtype.str.encode()
+    if len(dtype) > 0xFF:
+        raise ValueError("Error: The NDARRAY dtype string is longer than 255 bytes")
+    header = struct.pack(
+        f"<BBB{len(dtype)}s{value.ndim}Q",
+        0,
+        value.ndim,
+        len(dtype),
+        dtype,
+        *value.shape,
+    )
+    data_offset = -(-(offset + len(header)) // NDARRAY_ALIGNMENT) * NDARRAY_ALIGNMENT
+    data_offset -= offset
+    # The data offset is stored in one byte
+    if data_offset > 0xFF:
+        raise ValueError(
+            f"Error: The NDARRAY header of a {value.ndim}-dimensional array does "
+            "not fit in 255 bytes"
+        )
+    return b"".join(
+        [
+            bytes((data_offset,)),
+            header[1:],
+            bytes(data_offset - len(header)),
+            value.tobytes(),
+        ]
+    )
+
+
+get_dtype = lru_cache(maxsize=None)(numpy.dtype)
+
+
+def unpack_ndarray(value: ByteString, offset: int = 0) -> numpy.ndarray:
+    """
+    Deserialize an array as a view of value, the header is at offset
+    """
+    data_offset, ndim, dtype_len = value[offset], value[offset + 1], value[offset + 2]
+    dtype = get_dtype(bytes(value[offset + 3 : offset + 3 + dtype_len]).decode())
+    shape = struct.unpack_from(f"<{ndim}Q", value, offset + 3 + dtype_len)
+    responds = numpy.frombuffer(
+        value, dtype=dtype, count=math.prod(shape), offset=offset + data_offset
+    ).reshape(shape)
+    if not responds.flags.aligned:
+        # LMDB aligns the values stored in overflow pages (larger than about
+        # half a page), smaller values may start anywhere
+        responds = responds.copy()
+    return responds
+
+
+class RecordSchema:
+    """
+    Layout of ToBytes.RECORD values: the fixed-width fields packed
+    little-endian, then the end offsets (uint32) of the variable-length
+    fields, then the variable-length fields. A field type is a numpy dtype
+    name of a number or bool ("int32", "float64", "bool"), or "str",
+    "bytes", "obj" (msgpack) for variable-length fields.
+    """
+
+    __slots__ = (
+        "fields",
+        "fixed_dtype",
+        "fixed_struct",
+        "fixed_size",
+        "field_structs",
+        "var_fields",
+        "var_struct",
+        "packer",
+    )
+
+    def __init__(self, fields: List[Tuple[str, str]]):
+        self.fields = tuple((name, field_type) for name, field_type in fields)
+        fixed_fields = [
+            (name, numpy.dtype(field_type).newbyteorder("<"))
+            for name, field_type in self.fields
+            if field_type not in RECORD_VAR_TYPES
+        ]
+        self.var_fields = {
+            name: (i, field_type)
+            for i, (name, field_type) in enumerate(
+                (name, field_type)
+                for name, field_type in self.fields
+                if field_type in RECORD_VAR_TYPES
+            )
+        }
+        self.fixed_dtype = numpy.dtype(fixed_fields)
+        formats = []
+        self.field_structs = {}
+        for name, dtype in fixed_fields:
+            format_char = RECORD_STRUCT_FORMATS.get((dtype.kind, dtype.itemsize))
+            if format_char is None:
+                raise ValueError(f"Error: Unsupported record field type {dtype}")
+            self.field_structs[name] = (
+                struct.Struct("<" + format_char),
+                struct.calcsize("<" + "".join(formats)),
+            )
+            formats.append(format_char)
+        self.fixed_struct = struct.Struct("<" + "".join(formats))
+        self.fixed_size = self.fixed_struct.size
+        self.var_struct = struct.Struct(f"<{len(self.var_fields)}I")
+        self.packer = msgpack.Packer(default=set_default)
+
+    def encode(self, value: dict) -> bytes:
+        fixed = self.fixed_struct.pack(
+            *[value.get(name, 0) for name in self.fixed_dtype.names]
+        )
+        var_values, ends, end = [], [], 0
+        for name, (_, field_type) in self.var_fields.items():
+            var_value = value.get(name)
+            if var_value is None:
+                var_value = b""
+            elif field_type == "str":
+                var_value = var_value.encode(ENCODING)
+            elif field_type == "obj":
+                var_value = self.packer.pack(var_value)
+            end += len(var_value)
+            ends.append(end)
+            var_values.append(var_value)
+        return b"".join([fixed, self.var_struct.pack(*ends)] + var_values)
+
+    def decode_var_field(self, value: ByteString, name: str):
+        i, field_type = self.var_fields[name]
+        data_start = self.fixed_size + self.var_struct.size
+        start = 0
+        if i:
+            start = struct.unpack_from("<I", value, self.fixed_size + 4 * (i - 1))[0]
+        end = struct.unpack_from("<I", value, self.fixed_size + 4 * i)[0]
+        if start == end and field_type != "bytes":
+            return "" if field_type == "str" else None
+        var_value = bytes(value[data_start + start : data_start + end])
+        if field_type == "str":
+            return var_value.decode(ENCODING)
+        if field_type == "obj":
+            return msgpack.unpackb(var_value, strict_map_key=False)
+        return var_value
+
+    def decode(self, value: ByteString) -> dict:
+        fixed = dict(zip(self.fixed_dtype.names, self.fixed_struct.unpack_from(value)))
+        return {
+            name: fixed[name] if name in fixed else self.decode_var_field(value, name)
+            for name, _ in self.fields
+        }
+
+    def decode_fields(self, value: ByteString, fields: List[str]) -> dict:
+        responds = {}
+        for name in fields:
+            field_struct = self.field_structs.get(name)
+            if field_struct is not None:
+                responds[name] = field_struct[0].unpack_from(value, field_struct[1])[0]
+            elif name in self.var_fields:
+                responds[name] = self.decode_var_field(value, name)
+            else:
+                raise ValueError(f"Error: Unknown record field {name}")
+        return responds
+
+    def decode_columns(self, values: List[ByteString], fields: List[str]) -> dict:
+        """
+        Decode fields of many records: fixed-width fields as numpy arrays,
+        variable-length fields as object arrays
+        """
+        fixed_size = self.fixed_size
+        if not values or not fixed_size:
+            # numpy cannot read an empty buffer, or one with zero-size items
+            fixed = numpy.zeros(len(values), dtype=self.fixed_dtype)
+        else:
+            fixed = numpy.frombuffer(
+                b"".join([value[:fixed_size] for value in values]),
+                dtype=self.fixed_dtype,
+            )
+        responds = {}
+        for name in fields:
+            if name in self.field_structs:
+                responds[name] = fixed[name].copy()
+            elif name in self.var_fields:
+                column = numpy.empty(len(values), dtype=object)
+                column[:] = [self.decode_var_field(value, name) for value in values]
+                responds[name] = column
+            else:
+                raise ValueError(f"Error: Unknown record field {name}")
+        return responds
+
+
+def intersect_sorted(a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+    """
+    Intersect two sorted arrays. Skewed sizes search the short array in the
+    long one, similar sizes merge them.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return a
+    if len(b) >= len(a) * POSTING_GALLOP_RATIO:
+        positions = numpy.searchsorted(b, a)
+        positions[positions == len(b)] = 0
+        return a[b[positions] == a]
+    return numpy.intersect1d(a, b, assume_unique=True)
+
+
+def get_merge_key(codec: "DBCodec") -> Callable:
+    # Serialized items sort by their key bytes, except legacy integer keys
+    # that LMDB compares as native integers
+    if codec.lmdb_integerkey:
+        unpack = codec.key_struct.unpack
+
+        def merge_key(item):
+            return unpack(item[0])
+
+        return merge_key
+    return itemgetter(0)
+
+
+def dump_sorted_run(file_name: str, data: List[Tuple[bytes, bytes]]):
+    header = struct.Struct("<II")
+    with open(file_name, "wb", buffering=SIZE_1MB) as f:
+        for k, v in data:
+            f.write(header.pack(len(k), len(v)))
+            f.write(k)
+            f.write(v)
+
+
+def read_sorted_run(file_name: str) -> Iterator[Tuple[bytes, bytes]]:
+    header = struct.Struct("<II")
+    with open(file_name, "rb", buffering=SIZE_1MB) as f:
+        while True:
+            lengths = f.read(header.size)
+            if not lengths:
+                return
+            k_len, v_len = header.unpack(lengths)
+            yield f.read(k_len), f.read(v_len)
+
+
 def get_file_size(num: int, suffix="B"):
     num = abs(num)
     if num == 0:
@@ -336,16 +1025,50 @@ class DBSpec:
     bytes_value: bool = ToBytes.OBJ
     compress_value: bool = False
     combinekey: bool = False
+    key_format: int = KeyFormat.LEGACY
+    # Prefix values with a header byte recording their serializer and
+    # compression: values are compressed only when it saves space, and values
+    # written with another bytes_value or compress_value still decode
+    value_header: bool = False
+    # Base64 LZ4 dictionary of values with a header, trained by compress()
+    value_dict: Optional[str] = None
+    # [(field name, field type), ...] of ToBytes.RECORD values, see RecordSchema
+    record_schema: Optional[List] = None
+    # Cache up to cache_size decoded values, 0 disables the cache
+    cache_size: int = 0
+    # Approximate byte bound of the cached values, 0 for no bound
+    cache_bytes: int = 0
+    # "lru" or "slru" (segmented LRU)
+    cache_policy: str = "lru"
+    # Build a static perfect hash map of the sub database in compress(), see
+    # FReadDB.freeze
+    freeze: bool = False
+    # Freeze integer keys as a DenseMap: None if they are dense (largest key
+    # below DENSE_KEY_RATIO times the number of keys), True always, False never
+    dense_keys: Optional[bool] = None
 
     def get_key_args(self):
         return {
             "integerkey": self.integerkey,
             "is_64bit": self.is_64bit,
             "combinekey": self.combinekey,
+            "key_format": self.key_format,
         }
 
     def get_value_args(self):
-        return {"bytes_value": self.bytes_value, "compress_value": self.compress_value}
+        return {
+            "bytes_value": self.bytes_value,
+            "compress_value": self.compress_value,
+            "value_header": self.value_header,
+            "value_dict": self.value_dict,
+            "record_schema": self.get_record_schema(),
+        }
+
+    def get_record_schema(self) -> Optional[Tuple]:
+        # Hashable for get_codec
+        if not self.record_schema:
+            return None
+        return tuple(tuple(field) for field in self.record_schema)
 
     def get_args(self):
         return {
@@ -354,77 +1077,2389 @@ class DBSpec:
             "combinekey": self.combinekey,
             "bytes_value": self.bytes_value,
             "compress_value": self.compress_value,
+            "key_format": self.key_format,
+            "value_header": self.value_header,
+            "value_dict": self.value_dict,
+            "record_schema": self.get_record_schema(),
         }
 
 
-class FReadDB:
-    def __init__(
-        self,
-        db_file: str,
-        db_schema: Optional[List[DBSpec]] = None,
-        map_size: int = None,
-        readonly: bool = False,
-        buff_limit: int = LMDB_BUFF_LIMIT,
-        split_subdatabases=False,
-    ):
-        __slots__ = [
-            "db_file",
-            "metadata_file",
-            "db_schema",
-            "buff_limit",
-            "split_subdatabases",
-            "max_db",
-            "map_size",
-            "readonly",
-            "env",
-            "buff",
-            "buff_size",
-        ]
+class DBCodec:
+    """
+    Key and value serializers of a sub database. The encode/decode callables
+    are compiled once from the DBSpec, so per item reads and writes do not
+    dispatch on the spec again.
+    """
+
+    __slots__ = (
+        "name",
+        "integerkey",
+        "combinekey",
+        "key_format",
+        "lmdb_integerkey",
+        "bytes_value",
+        "compress_value",
+        "value_header",
+        "value_dict",
+        "record_schema",
+        "key_struct",
+        "key_dtype",
+        "combine_structs",
+        "packer",
+        "encode_key",
+        "decode_key",
+        "encode_value",
+        "decode_value",
+        "view_value",
+    )
 
-        db_file_name = db_file.split("/")[-1]
-        self.db_file = db_file + f"/{db_file_name}"
-        create_dir(self.db_file)
+    def __init__(self, db_spec: DBSpec):
+        self.name = db_spec.name
+        self.combinekey = db_spec.combinekey
+        self.integerkey = db_spec.integerkey and not db_spec.combinekey
+        self.key_format = KeyFormat(db_spec.key_format)
+        # Only legacy integer keys rely on the LMDB integerkey comparator,
+        # the other key formats sort correctly as plain bytes
+        self.lmdb_integerkey = self.integerkey and self.key_format == KeyFormat.LEGACY
+        self.bytes_value = ToBytes(db_spec.bytes_value)
+        self.compress_value = db_spec.compress_value
+        self.value_header = db_spec.value_header
+        self.value_dict = None
+        if db_spec.value_dict:
+            self.value_dict = base64.b64decode(db_spec.value_dict)
+        self.record_schema = None
+        if self.bytes_value == ToBytes.RECORD:
+            if not db_spec.record_schema:
+                raise ValueError("Error: ToBytes.RECORD needs a record_schema")
+            self.record_schema = RecordSchema(db_spec.record_schema)
+
+        int_format = "Q" if db_spec.is_64bit else "I"
+        if self.key_format == KeyFormat.BIG_ENDIAN:
+            self.key_struct = struct.Struct(">" + int_format)
+        else:
+            self.key_struct = struct.Struct(int_format)
+        self.key_dtype = None
+        if self.integerkey and self.key_format != KeyFormat.VARINT:
+            self.key_dtype = numpy.dtype(self.key_struct.format)
+        self.combine_structs = {}
+        self.packer = msgpack.Packer(default=set_default)
+
+        self.encode_key = self.compile_encode_key()
+        self.decode_key = self.compile_decode_key()
+        self.encode_value = self.compile_encode_value()
+        self.decode_value = self.compile_decode_value()
+        self.view_value = self.compile_view_value()
+
+    def get_combine_struct(self, n_parts: int) -> struct.Struct:
+        combine_struct = self.combine_structs.get(n_parts)
+        if combine_struct is None:
+            int_format = self.key_struct.format[-1]
+            if self.key_format == KeyFormat.LEGACY:
+                # "x" skips the deliminator byte between the parts
+                fmt = "=" + "x".join([int_format] * n_parts)
+            else:
+                fmt = ">" + int_format * n_parts
+            combine_struct = struct.Struct(fmt)
+            self.combine_structs[n_parts] = combine_struct
+        return combine_struct
+
+    def compile_encode_key(self) -> Callable:
+        if not self.integerkey and not self.combinekey:
+
+            def encode_key(key):
+                if not isinstance(key, str):
+                    key = str(key)
+                return key.encode(ENCODING)[:LMDB_MAX_KEY]
+
+        elif self.key_format == KeyFormat.VARINT:
+
+            def encode_key(key):
+                if self.combinekey:
+                    if not isinstance(key[0], Number):
+                        raise ValueError("Error: Please use int key tuple")
+                    key = b"".join([pack_varint(k) for k in key])
+                else:
+                    key = pack_varint(key)
+                if len(key) > LMDB_MAX_KEY:
+                    raise ValueError(f"Error: Key is longer than {LMDB_MAX_KEY} bytes")
+                return key
+
+        elif not self.combinekey:
+            encode_key = self.key_struct.pack
+
+        elif self.key_format == KeyFormat.BIG_ENDIAN:
+            get_struct = self.combine_structs.get
+
+            def encode_key(key):
+                if not isinstance(key[0], Number):
+                    raise ValueError("Error: Please use int key tuple")
+                combine_struct = get_struct(len(key))
+                if combine_struct is None:
+                    combine_struct = self.get_combine_struct(len(key))
+                if combine_struct.size > LMDB_MAX_KEY:
+                    raise ValueError(f"Error: Key is longer than {LMDB_MAX_KEY} bytes")
+                return combine_struct.pack(*key)
 
-        self.metadata_file = self.db_file + "_metadata.json"
-        create_dir(self.metadata_file)
+        else:
+            pack = self.key_struct.pack
+            deliminator = "|".encode(ENCODING)
 
-        if readonly and not os.path.exists(self.db_file) and not split_subdatabases:
-            split_subdatabases = True
+            def encode_key(key):
+                if not isinstance(key[0], Number):
+                    raise ValueError("Error: Please use int key tuple")
+                return deliminator.join([pack(k) for k in key])[:LMDB_MAX_KEY]
+
+        return encode_key
+
+    def compile_decode_key(self) -> Callable:
+        if not self.integerkey and not self.combinekey:
+
+            def decode_key(key):
+                return str(key, ENCODING)
+
+        elif self.key_format == KeyFormat.VARINT:
+            if self.combinekey:
+                decode_key = unpack_varints
+            else:
+
+                def decode_key(key):
+                    return unpack_varints(key)[0]
+
+        elif not self.combinekey:
+            unpack = self.key_struct.unpack
+
+            def decode_key(key):
+                return unpack(key)[0]
 
-        if db_schema:
-            self.db_schema = {db_spec.name: db_spec for db_spec in db_schema}
-            self.buff_limit = buff_limit
-            self.save_metadata_info(db_schema, buff_limit)
         else:
-            self.db_schema, self.buff_limit = self.load_metadata_info()
+            get_struct = self.combine_structs.get
+            if self.key_format == KeyFormat.LEGACY:
+                step = self.key_struct.size + 1
+                offset = 1
+            else:
+                step = self.key_struct.size
+                offset = 0
+
+            def decode_key(key):
+                n_parts = (len(key) + offset) // step
+                combine_struct = get_struct(n_parts)
+                if combine_struct is None:
+                    combine_struct = self.get_combine_struct(n_parts)
+                return combine_struct.unpack_from(key)
+
+        return decode_key
+
+    def compile_encode_value(self) -> Callable:
+        if self.value_header:
+            return self.compile_encode_value_with_header()
+        bytes_value = self.bytes_value
+        if bytes_value == ToBytes.INT_NUMPY:
+
+            def encode_value(value):
+                return to_sorted_uint32(value).tobytes()
+
+            return encode_value
+
+        if bytes_value == ToBytes.INT_PACKED:
+            return pack_sorted_ints
+
+        if bytes_value == ToBytes.NDARRAY:
+            return pack_ndarray
+
+        if bytes_value == ToBytes.RECORD:
+            return self.record_schema.encode
+
+        if bytes_value == ToBytes.INT_BITMAP:
+
+            def encode_value(value):
+                return BitMap(value).serialize()
+
+            return encode_value
+
+        if bytes_value == ToBytes.PICKLE:
+            dumps = pickle.dumps
+        else:
+            pack = self.packer.pack
+
+            def dumps(value):
+                if isinstance(value, (bytes, bytearray)):
+                    return value
+                return pack(value)
+
+        if not self.compress_value:
+            return dumps
+
+        compress = frame.compress
+
+        def encode_value(value):
+            return compress(dumps(value))
+
+        return encode_value
+
+    def compile_encode_value_with_header(self) -> Callable:
+        bytes_value = self.bytes_value
+        pack = self.packer.pack
+        if bytes_value == ToBytes.INT_NUMPY:
+            value_codec = ValueCodec.NUMPY_UINT32
+
+            def dumps(value):
+                return to_sorted_uint32(value).tobytes()
+
+        elif bytes_value == ToBytes.INT_PACKED:
+            value_codec = ValueCodec.PACKED_INTS
+            dumps = pack_sorted_ints
+
+        elif bytes_value == ToBytes.NDARRAY:
+            value_codec = ValueCodec.NDARRAY
+            # Align the data after the header byte
+            dumps = partial(pack_ndarray, offset=1)
+
+        elif bytes_value == ToBytes.RECORD:
+            value_codec = ValueCodec.RECORD
+            dumps = self.record_schema.encode
+
+        elif bytes_value == ToBytes.INT_BITMAP:
+            value_codec = ValueCodec.ROARING
+
+            def dumps(value):
+                return BitMap(value).serialize()
+
+        elif bytes_value == ToBytes.PICKLE:
+            value_codec = ValueCodec.PICKLE
+            dumps = pickle.dumps
+        else:
+            value_codec = ValueCodec.MSGPACK
+            dumps = pack
+
+        header = bytes((pack_value_header(value_codec),))
+        raw_header = bytes((pack_value_header(ValueCodec.RAW),))
+        compress_value = self.compress_value
+        compression = ValueCompression.LZ4
+        compress = block.compress
+        if self.value_dict:
+            compression = ValueCompression.LZ4_DICT
+            compress = partial(block.compress, dict=self.value_dict)
+        lz4_headers = {
+            header: bytes((pack_value_header(value_codec, compression),)),
+            raw_header: bytes((pack_value_header(ValueCodec.RAW, compression),)),
+        }
+
+        def encode_value(value):
+            if bytes_value in (ToBytes.OBJ, ToBytes.BYTES) and isinstance(
+                value, (bytes, bytearray)
+            ):
+                value_header, value = raw_header, value
+            else:
+                value_header, value = header, dumps(value)
+            if compress_value and len(value) >= VALUE_COMPRESS_MIN_SIZE:
+                compressed = compress(value)
+                if len(compressed) < len(value):
+                    return lz4_headers[value_header] + compressed
+            return value_header + value
+
+        return encode_value
+
+    def compile_decode_value(self) -> Callable:
+        if self.value_header:
+            decoders = get_value_decoders(self.value_dict, self.record_schema)
+
+            def decode_value(value):
+                return decoders[value[0]](value)
+
+            return decode_value
+        bytes_value = self.bytes_value
+        if bytes_value == ToBytes.INT_NUMPY:
+            return partial(numpy.frombuffer, dtype=numpy.uint32)
+
+        if bytes_value == ToBytes.INT_PACKED:
+            return unpack_sorted_ints
+
+        if bytes_value == ToBytes.NDARRAY:
+            return unpack_ndarray
+
+        if bytes_value == ToBytes.RECORD:
+            return self.record_schema.decode
+
+        if bytes_value == ToBytes.INT_BITMAP:
+            deserialize_bitmap = BitMap.deserialize
+
+            def decode_value(value):
+                return deserialize_bitmap(bytes(value))
+
+            return decode_value
+
+        if bytes_value == ToBytes.BYTES:
+            return bytes
+
+        if bytes_value == ToBytes.PICKLE:
+            loads = pickle.loads
+        else:
+            loads = partial(msgpack.unpackb, strict_map_key=False)
+
+        if not self.compress_value:
+            return loads
+
+        decompress = frame.decompress
+
+        def decode_value(value):
+            try:
+                value = decompress(value)
+            except RuntimeError:
+                pass
+            return loads(value)
+
+        return decode_value
+
+    def get_payload(self, value: ByteString) -> ByteString:
+        # The serialized value without its header byte and compression
+        if self.value_header:
+            return get_value_payload(value, self.value_dict)
+        return value
+
+    def compile_view_value(self) -> Callable:
+        # Values of these types are handed out without copying the buffer
+        if self.value_header:
+            decode_value = self.decode_value
+            raw_header = pack_value_header(ValueCodec.RAW)
+
+            def view_value(value):
+                if value[0] == raw_header:
+                    return memoryview(value)[1:]
+                return decode_value(value)
+
+            return view_value
+        if self.bytes_value in (ToBytes.INT_NUMPY, ToBytes.NDARRAY):
+            return self.decode_value
+        if self.bytes_value == ToBytes.BYTES:
+            return memoryview
+        return self.decode_value
+
+
+class WriteBuffer:
+    """
+    Serialized items of a sub database waiting to be written. Keys and
+    values are appended to two bytearray arenas with an offset array each,
+    so buffered items cost their bytes plus 16 bytes of offsets instead of
+    a Python object per item. Items are indexed by serialized key: adding a
+    key again replaces its item and deleting a key leaves a tombstone that
+    is deleted from LMDB at flush time. The sizes returned by add and
+    add_pending count the index entry too (key object, dict slot and int),
+    so buff_limit bounds the memory of the buffer.
+    """
+
+    __slots__ = (
+        "keys",
+        "values",
+        "key_offsets",
+        "value_offsets",
+        "index",
+        "n_removed",
+        "pending",
+        "pending_size",
+        "index_size",
+        "tombstones",
+    )
+
+    def __init__(self):
+        self.keys = bytearray()
+        self.values = bytearray()
+        self.key_offsets = array("Q", [0])
+        self.value_offsets = array("Q", [0])
+        # serialized key -> live item in the arenas
+        self.index = {}
+        self.n_removed = 0
+        # serialized key -> value serialized at flush time (parallel mode)
+        self.pending = {}
+        self.pending_size = 0
+        self.index_size = 0
+        self.tombstones = set()
+
+    def __len__(self) -> int:
+        return len(self.index) + len(self.pending)
+
+    def __bool__(self) -> bool:
+        return bool(self.index or self.pending or self.tombstones)
+
+    def get_size(self) -> int:
+        return (
+            len(self.keys)
+            + len(self.values)
+            + (len(self.key_offsets) + len(self.value_offsets)) * 8
+            + self.pending_size
+            + self.index_size
+        )
+
+    def discard(self, key: bytes) -> bool:
+        if self.index.pop(key, None) is not None:
+            self.n_removed += 1
+            return True
+        if key in self.pending:
+            del self.pending[key]
+            return True
+        return False
+
+    def add(self, key: bytes, value: bytes) -> int:
+        self.discard(key)
+        self.tombstones.discard(key)
+        self.index[key] = len(self.key_offsets) - 1
+        self.keys += key
+        self.key_offsets.append(len(self.keys))
+        self.values += value
+        self.value_offsets.append(len(self.values))
+        index_size = sys.getsizeof(key) + WRITE_BUFFER_INDEX_ENTRY
+        self.index_size += index_size
+        return len(key) + len(value) + 16 + index_size
+
+    def add_pending(self, key: bytes, value: Any) -> int:
+        self.discard(key)
+        self.tombstones.discard(key)
+        self.pending[key] = value
+        size = sys.getsizeof(key) + WRITE_BUFFER_INDEX_ENTRY + sys.getsizeof(value)
+        self.pending_size += size
+        return size
+
+    def serialize_pending(self, serialized_values: List[bytes]):
+        # Index each item before dropping it from pending, so readers on
+        # another thread always find it in one of them
+        for key, value in zip(list(self.pending), serialized_values):
+            self.keys += key
+            self.key_offsets.append(len(self.keys))
+            self.values += value
+            self.value_offsets.append(len(self.values))
+            self.index[key] = len(self.key_offsets) - 2
+            self.index_size += sys.getsizeof(key) + WRITE_BUFFER_INDEX_ENTRY
+            del self.pending[key]
+        self.pending_size = 0
+
+    def remove(self, key: bytes) -> bool:
+        """
+        Delete a key: drop its buffered item and delete it from LMDB at flush.
+        :return: True if an item was buffered for the key
+        """
+        self.tombstones.add(key)
+        return self.discard(key)
+
+    def get(self, key: bytes, codec: "DBCodec", get_deserialize: bool = True):
+        """
+        Get the buffered value of a key.
+        :return: BUFF_MISSING if the key is not buffered, None if it is deleted
+        """
+        value = self.pending.get(key, BUFF_MISSING)
+        if value is not BUFF_MISSING:
+            return value if get_deserialize else codec.encode_value(value)
+        i = self.index.get(key)
+        if i is not None:
+            value = bytes(
+                self.values[self.value_offsets[i] : self.value_offsets[i + 1]]
+            )
+            return codec.decode_value(value) if get_deserialize else value
+        if key in self.tombstones:
+            return None
+        return BUFF_MISSING
+
+    def get_key(self, i: int) -> bytes:
+        return bytes(self.keys[self.key_offsets[i] : self.key_offsets[i + 1]])
+
+    def get_order(self, codec: "DBCodec") -> List[int]:
+        """
+        Get the indexes of the live items sorted by key in LMDB order
+        """
+        if not self.n_removed:
+            order = range(len(self.key_offsets) - 1)
+        else:
+            order = sorted(self.index.values())
+        if codec.key_dtype is not None and not codec.combinekey:
+            keys = numpy.frombuffer(self.keys, dtype=codec.key_dtype)
+            order = numpy.asarray(order, dtype=numpy.int64)
+            return order[numpy.argsort(keys[order], kind="stable")].tolist()
+        return sorted(order, key=self.get_key)
+
+    def iter_items(self, order: List[int]) -> Iterator[Tuple[memoryview, memoryview]]:
+        keys, values = memoryview(self.keys), memoryview(self.values)
+        key_offsets, value_offsets = self.key_offsets, self.value_offsets
+        for i in order:
+            yield (
+                keys[key_offsets[i] : key_offsets[i + 1]],
+                values[value_offsets[i] : value_offsets[i + 1]],
+            )
+
+
+class ValueCache:
+    """
+    Decoded values of a sub database by serialized key, bounded by number of
+    entries and approximate bytes (the serialized value sizes).
+    policy "lru" evicts the least recently used entry. policy "slru" keeps
+    new entries in a probation segment and promotes them to a protected
+    segment on their second hit, so a scan of cold keys does not flush the
+    popular ones. Cached values are shared between readers, do not modify
+    them. The cache is locked, the async flusher invalidates it while other
+    threads read it.
+    """
+
+    __slots__ = (
+        "max_entries",
+        "max_bytes",
+        "policy",
+        "probation",
+        "protected",
+        "max_protected",
+        "n_bytes",
+        "hits",
+        "misses",
+        "evictions",
+        "invalidated",
+        "lock",
+    )
+
+    def __init__(self, max_entries: int, max_bytes: int = 0, policy: str = "lru"):
+        if policy not in ("lru", "slru"):
+            raise ValueError(f"Error: Unknown cache policy {policy}")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        # key -> (value, size)
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.max_protected = max_entries * 4 // 5 if policy == "slru" else 0
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # CACHE_CLOCK time of the last invalidation
+        self.invalidated = -1
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.probation) + len(self.protected)
+
+    def get(self, key: bytes):
+        """
+        :return: the cached value, or CACHE_MISSING
+        """
+        with self.lock:
+            item = self.protected.get(key)
+            if item is not None:
+                self.protected.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            item = self.probation.get(key)
+            if item is None:
+                self.misses += 1
+                return CACHE_MISSING
+            self.hits += 1
+            if self.max_protected:
+                del self.probation[key]
+                self.protected[key] = item
+                if len(self.protected) > self.max_protected:
+                    # Demote the least recently used protected entry
+                    old_key, old_item = self.protected.popitem(last=False)
+                    self.probation[old_key] = old_item
+            else:
+                self.probation.move_to_end(key)
+            return item[0]
+
+    def put(self, key: bytes, value: Any, size: int, since: Optional[int] = None):
+        """
+        :param since: CACHE_CLOCK time the value was read after, the value is
+        not cached if the cache was invalidated since then, it may be stale
+        """
+        with self.lock:
+            if since is not None and since <= self.invalidated:
+                return
+            self.discard(key)
+            if self.max_bytes and size > self.max_bytes:
+                return
+            self.probation[key] = (value, size)
+            self.n_bytes += size
+            while len(self) > self.max_entries or (
+                self.max_bytes and self.n_bytes > self.max_bytes
+            ):
+                segment = self.probation if self.probation else self.protected
+                _, (_, old_size) = segment.popitem(last=False)
+                self.n_bytes -= old_size
+                self.evictions += 1
+
+    def discard(self, key: bytes):
+        with self.lock:
+            item = self.probation.pop(key, None)
+            if item is None:
+                item = self.protected.pop(key, None)
+            if item is not None:
+                self.n_bytes -= item[1]
+
+    def clear(self):
+        with self.lock:
+            self.probation.clear()
+            self.protected.clear()
+            self.n_bytes = 0
+
+    def invalidate(self, keys: Optional[Iterator] = None):
+        """
+        Drop the values of keys, or of all keys, after they were written
+        """
+        with self.lock:
+            self.invalidated = next(CACHE_CLOCK)
+            if keys is None:
+                self.clear()
+                return
+            for key in keys:
+                self.discard(key)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self),
+                "bytes": self.n_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def mix_uint64(x):
+    """
+    splitmix64 finalizer of a Python int or a numpy uint64 array
+    """
+    if isinstance(x, numpy.ndarray):
+        x = x ^ (x >> numpy.uint64(30))
+        x = x * numpy.uint64(0xBF58476D1CE4E5B9)
+        x = x ^ (x >> numpy.uint64(27))
+        x = x * numpy.uint64(0x94D049BB133111EB)
+        return x ^ (x >> numpy.uint64(31))
+    x ^= x >> 30
+    x = (x * 0xBF58476D1CE4E5B9) & UINT64_MASK
+    x ^= x >> 27
+    x = (x * 0x94D049BB133111EB) & UINT64_MASK
+    return x ^ (x >> 31)
+
+
+def hash_frozen_key(key: ByteString) -> int:
+    """
+    64-bit hash of a key: mixed crc32 and adler32 of the key, both computed
+    in C by zlib
+    """
+    return mix_uint64(zlib.crc32(key) | zlib.adler32(key) << 32)
+
+
+@lru_cache(maxsize=None)
+def get_crc32_table() -> numpy.ndarray:
+    table = numpy.arange(256, dtype=numpy.uint32)
+    for _ in range(8):
+        table = numpy.where(table & 1, (table >> 1) ^ 0xEDB88320, table >> 1)
+    return table.astype(numpy.uint32)
+
+
+def hash_frozen_keys(keys: List[ByteString]) -> numpy.ndarray:
+    """
+    hash_frozen_key of many keys, computed one byte column at a time over all
+    keys with numpy
+    """
+    lengths = numpy.fromiter(map(len, keys), dtype=numpy.int64, count=len(keys))
+    max_length = int(lengths.max()) if len(keys) else 0
+    matrix = numpy.array(keys, dtype=f"S{max(max_length, 1)}")
+    matrix = matrix.view(numpy.uint8).reshape(len(keys), -1)
+    table = get_crc32_table()
+    crc = numpy.full(len(keys), 0xFFFFFFFF, dtype=numpy.uint32)
+    adler_a = numpy.ones(len(keys), dtype=numpy.uint32)
+    adler_b = numpy.zeros(len(keys), dtype=numpy.uint32)
+    for j in range(max_length):
+        column = matrix[:, j]
+        active = lengths > j
+        crc = numpy.where(active, table[(crc ^ column) & 0xFF] ^ (crc >> 8), crc)
+        adler_a = numpy.where(active, (adler_a + column) % 65521, adler_a)
+        adler_b = numpy.where(active, (adler_b + adler_a) % 65521, adler_b)
+    crc = (crc ^ numpy.uint32(0xFFFFFFFF)).astype(numpy.uint64)
+    adler = (adler_b << 16 | adler_a).astype(numpy.uint64)
+    return mix_uint64(crc | adler << numpy.uint64(32))
+
+
+class FrozenMap:
+    """
+    Read-only map of a frozen sub database in a memory-mapped file. Keys are
+    placed by a minimal perfect hash (CHD, hash and displace): the 64-bit hash
+    of a key picks a bucket, and the displacement of the bucket picks the slot
+    of the key. Slots store the hash of their key as a fingerprint to reject
+    most missing keys, and the key itself before the value to reject the
+    others.
+    Layout: header, fingerprints (uint64 per slot), item offsets (uint64 per
+    slot), displacements (int32 per bucket), value sizes (uint32 per slot),
+    key sizes (uint32 per slot), then the blob of keys and values.
+    """
+
+    __slots__ = (
+        "mmap",
+        "n_items",
+        "n_buckets",
+        "blob_offset",
+        "fingerprints",
+        "value_offsets",
+        "displacements",
+        "value_sizes",
+        "key_sizes",
+        "blob",
+    )
+
+    header_struct = struct.Struct("<8sQQ")
+
+    def __init__(self, file_name: str):
+        with open(file_name, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n_items, self.n_buckets = self.header_struct.unpack_from(self.mmap)
+        if magic != FROZEN_MAGIC:
+            self.mmap.close()
+            raise ValueError(f"Error: {file_name} is not a frozen sub database")
+        self.blob = memoryview(self.mmap)
+        # memoryview casts: indexing them is faster than indexing numpy arrays
+        offset = self.header_struct.size
+        arrays = []
+        for size, fmt in (
+            (8 * self.n_items, "Q"),
+            (8 * self.n_items, "Q"),
+            (4 * self.n_buckets, "i"),
+            (4 * self.n_items, "I"),
+            (4 * self.n_items, "I"),
+        ):
+            arrays.append(self.blob[offset : offset + size].cast(fmt))
+            offset += size
+        (
+            self.fingerprints,
+            self.value_offsets,
+            self.displacements,
+            self.value_sizes,
+            self.key_sizes,
+        ) = arrays
+        self.blob_offset = offset
+
+    def __len__(self) -> int:
+        return self.n_items
+
+    @staticmethod
+    def get_blob_offset(n_items: int, n_buckets: int) -> int:
+        return FrozenMap.header_struct.size + 24 * n_items + 4 * n_buckets
+
+    @staticmethod
+    def get_slots(n_items: int, h1: numpy.ndarray, displacements: numpy.ndarray):
+        # The slots of keys, uint64 multiplication wraps around like the mask
+        # of get
+        slots = h1 ^ (
+            numpy.maximum(displacements, 0).astype(numpy.uint64)
+            * numpy.uint64(FROZEN_HASH_MULTIPLIER)
+        )
+        slots = (slots % numpy.uint64(n_items)).astype(numpy.int64)
+        return numpy.where(
+            displacements < 0, -displacements.astype(numpy.int64) - 1, slots
+        )
+
+    @staticmethod
+    def get_slot_hash(key_hash):
+        # The key hash rotated by 32 bits, independent of the bucket below n
+        if isinstance(key_hash, numpy.ndarray):
+            return key_hash >> numpy.uint64(32) | key_hash << numpy.uint64(32)
+        return key_hash >> 32 | (key_hash << 32) & UINT64_MASK
+
+    @staticmethod
+    def place_buckets(
+        h1: numpy.ndarray, n_items: int, taken: numpy.ndarray
+    ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Find the first displacement of each bucket that puts its keys in free
+        and distinct slots. All buckets are tried at once for a displacement,
+        the ones that collide with each other or with taken slots try the next.
+        :param h1: slot hashes of the keys, one row per bucket
+        :param taken: mask of the taken slots, updated
+        :return: displacements of the buckets, slots of the keys
+        """
+        n_buckets, bucket_size = h1.shape
+        displacements = numpy.zeros(n_buckets, dtype=numpy.int32)
+        slots = numpy.zeros(h1.shape, dtype=numpy.int64)
+        rows = numpy.arange(n_buckets)
+        for displacement in range(FROZEN_MAX_DISPLACEMENT):
+            if not len(rows):
+                break
+            row_slots = FrozenMap.get_slots(
+                n_items,
+                h1[rows],
+                numpy.full(h1[rows].shape, displacement, dtype=numpy.int32),
+            )
+            sorted_slots = numpy.sort(row_slots, axis=1)
+            ok = ~taken[row_slots].any(axis=1)
+            ok &= (sorted_slots[:, 1:] != sorted_slots[:, :-1]).all(axis=1)
+            # Of the buckets that want the same slot, the first one gets it
+            flat = row_slots[ok].ravel()
+            _, first = numpy.unique(flat, return_index=True)
+            claimed = numpy.zeros(len(flat), dtype=bool)
+            claimed[first] = True
+            ok_rows = numpy.flatnonzero(ok)
+            placed = claimed.reshape(-1, bucket_size).all(axis=1)
+            placed_rows = ok_rows[placed]
+            displacements[rows[placed_rows]] = displacement
+            slots[rows[placed_rows]] = row_slots[placed_rows]
+            taken[row_slots[placed_rows]] = True
+            rows = numpy.delete(rows, placed_rows)
+        if len(rows):
+            raise ValueError("Error: Cannot build the perfect hash of the keys")
+        return displacements, slots
+
+    @staticmethod
+    def build(file_name: str, items: Callable, n_items: int) -> bool:
+        """
+        Build a frozen map file. Keys are grouped in buckets with numpy, and
+        the buckets of a size are placed together, see place_buckets.
+        :param items: callable returning an iterator of (key, value) bytes,
+        it is called twice and must yield the same items in the same order
+        """
+        key_hashes = numpy.zeros(n_items, dtype=numpy.uint64)
+        key_sizes = numpy.zeros(n_items, dtype="<u4")
+        value_sizes = numpy.zeros(n_items, dtype="<u4")
+        start, chunks = 0, items()
+        while True:
+            chunk = list(islice(chunks, SCAN_BATCH_SIZE))
+            if not chunk:
+                break
+            end = start + len(chunk)
+            keys = [k for k, _ in chunk]
+            key_hashes[start:end] = hash_frozen_keys(keys)
+            key_sizes[start:end] = [len(k) for k in keys]
+            value_sizes[start:end] = [len(v) for _, v in chunk]
+            start = end
+        h1 = FrozenMap.get_slot_hash(key_hashes)
+        n_buckets = max(1, -(-n_items // FROZEN_BUCKET_SIZE))
+        buckets = (key_hashes % numpy.uint64(n_buckets)).astype(numpy.int64)
+        order = numpy.argsort(buckets, kind="stable")
+        bucket_ids, starts, sizes = numpy.unique(
+            buckets[order], return_index=True, return_counts=True
+        )
+
+        # Place the largest buckets first, while the table is empty, and
+        # give the keys alone in their bucket the remaining slots directly
+        displacements = numpy.zeros(n_buckets, dtype=numpy.int32)
+        slots = numpy.zeros(n_items, dtype=numpy.int64)
+        taken = numpy.zeros(n_items, dtype=bool)
+        for size in numpy.unique(sizes)[::-1].tolist():
+            if size == 1:
+                break
+            of_size = sizes == size
+            keys = order[starts[of_size][:, None] + numpy.arange(size)]
+            displacements[bucket_ids[of_size]], slots[keys] = FrozenMap.place_buckets(
+                h1[keys], n_items, taken
+            )
+        singles = sizes == 1
+        free_slots = numpy.flatnonzero(~taken)[: int(singles.sum())]
+        displacements[bucket_ids[singles]] = -free_slots - 1
+        slots[order[starts[singles]]] = free_slots
+
+        # Keys and values are written in the order of items, the slot arrays
+        # point to them
+        fingerprints = numpy.zeros(n_items, dtype="<u8")
+        fingerprints[slots] = key_hashes
+        item_offsets = numpy.zeros(n_items, dtype="<u8")
+        numpy.cumsum(key_sizes[:-1] + value_sizes[:-1], out=item_offsets[1:])
+        value_offsets = numpy.zeros(n_items, dtype="<u8")
+        value_offsets[slots] = item_offsets
+        slot_key_sizes = numpy.zeros(n_items, dtype="<u4")
+        slot_key_sizes[slots] = key_sizes
+        slot_value_sizes = numpy.zeros(n_items, dtype="<u4")
+        slot_value_sizes[slots] = value_sizes
+        with open(file_name, "wb") as f:
+            f.write(FrozenMap.header_struct.pack(FROZEN_MAGIC, n_items, n_buckets))
+            f.write(fingerprints.tobytes())
+            f.write(value_offsets.tobytes())
+            f.write(displacements.astype("<i4").tobytes())
+            f.write(slot_value_sizes.tobytes())
+            f.write(slot_key_sizes.tobytes())
+            chunks = items()
+            while True:
+                chunk = list(islice(chunks, SCAN_BATCH_SIZE))
+                if not chunk:
+                    break
+                f.write(b"".join([b for item in chunk for b in item]))
+        return True
+
+    def get(self, key: ByteString) -> Optional[memoryview]:
+        if not self.n_items:
+            return None
+        key_hash = hash_frozen_key(key)
+        displacement = self.displacements[key_hash % self.n_buckets]
+        if displacement < 0:
+            slot = -displacement - 1
+        else:
+            slot = (
+                (key_hash >> 32 | (key_hash << 32) & UINT64_MASK)
+                ^ (displacement * FROZEN_HASH_MULTIPLIER) & UINT64_MASK
+            ) % self.n_items
+        if self.fingerprints[slot] != key_hash:
+            return None
+        offset = self.blob_offset + self.value_offsets[slot]
+        key_end = offset + self.key_sizes[slot]
+        # Another key with the same hash
+        if self.blob[offset:key_end] != key:
+            return None
+        return self.blob[key_end : key_end + self.value_sizes[slot]]
+
+    def get_many(self, keys: List[ByteString]) -> List[Optional[memoryview]]:
+        """
+        Look up keys with vectorized hash arithmetic
+        :return: list of values, None for missing keys
+        """
+        if not self.n_items or not keys:
+            return [None] * len(keys)
+        key_hashes = hash_frozen_keys(keys)
+        displacements = numpy.frombuffer(self.displacements, dtype=numpy.int32)[
+            (key_hashes % numpy.uint64(self.n_buckets)).astype(numpy.int64)
+        ]
+        slots = self.get_slots(
+            self.n_items, self.get_slot_hash(key_hashes), displacements
+        )
+        fingerprints = numpy.frombuffer(self.fingerprints, dtype=numpy.uint64)
+        found = fingerprints[slots] == key_hashes
+        offsets = numpy.frombuffer(self.value_offsets, dtype=numpy.uint64)[slots]
+        offsets = offsets + numpy.uint64(self.blob_offset)
+        key_ends = offsets + numpy.frombuffer(self.key_sizes, dtype=numpy.uint32)[slots]
+        ends = key_ends + numpy.frombuffer(self.value_sizes, dtype=numpy.uint32)[slots]
+        blob = self.blob
+        # Keys with the fingerprint of another key are missing
+        return [
+            blob[key_end:end] if is_found and blob[offset:key_end] == key else None
+            for is_found, key, offset, key_end, end in zip(
+                found.tolist(), keys, offsets.tolist(), key_ends.tolist(), ends.tolist()
+            )
+        ]
+
+    def close(self):
+        try:
+            for view in (
+                self.fingerprints,
+                self.value_offsets,
+                self.displacements,
+                self.value_sizes,
+                self.key_sizes,
+                self.blob,
+            ):
+                view.release()
+            self.mmap.close()
+        except BufferError:
+            # Values handed out by get are still referenced, the map is
+            # unmapped once they are garbage collected
+            pass
+
+
+class DenseMap:
+    """
+    Read-only map of a frozen integerkey sub database whose keys are dense in
+    0..n_rows - 1: the key is the row of its value, so lookups are pointer
+    arithmetic. Values of the same size are stored as a fixed-width array,
+    other values as a blob with n_rows + 1 offsets.
+    Layout: header, present flags (uint8 per row, padded to 8 bytes), then
+    the fixed-width values, or the offsets (uint64) and the value blob.
+    """
+
+    __slots__ = (
+        "mmap",
+        "n_items",
+        "n_rows",
+        "value_width",
+        "key_dtype",
+        "key_byteorder",
+        "present",
+        "value_offsets",
+        "blob_offset",
+        "blob",
+    )
+
+    header_struct = struct.Struct("<8sQQQ8s")
+
+    def __init__(self, file_name: str):
+        with open(file_name, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n_items, self.n_rows, self.value_width, key_dtype = (
+            self.header_struct.unpack_from(self.mmap)
+        )
+        if magic != DENSE_MAGIC:
+            self.mmap.close()
+            raise ValueError(f"Error: {file_name} is not a dense sub database")
+        self.key_dtype = numpy.dtype(key_dtype.rstrip(b"\x00").decode())
+        self.key_byteorder = "big" if self.key_dtype.str[0] == ">" else "little"
+        self.blob = memoryview(self.mmap)
+        offset = self.header_struct.size
+        # memoryviews: indexing them is faster than indexing numpy arrays
+        self.present = self.blob[offset : offset + self.n_rows]
+        offset += -(-self.n_rows // 8) * 8
+        self.value_offsets = None
+        if not self.value_width:
+            size = 8 * (self.n_rows + 1)
+            self.value_offsets = self.blob[offset : offset + size].cast("Q")
+            offset += size
+        self.blob_offset = offset
+
+    def __len__(self) -> int:
+        return self.n_items
+
+    @staticmethod
+    def build(
+        file_name: str,
+        items: Callable,
+        n_items: int,
+        n_rows: int,
+        key_dtype: numpy.dtype,
+    ) -> bool:
+        """
+        Build a dense map file.
+        :param items: callable returning an iterator of (key, value) bytes,
+        it is called twice and must yield the same items in the same order
+        :param n_rows: largest key + 1
+        """
+        keys, sizes = [], []
+        for key, value in items():
+            keys.append(bytes(key))
+            sizes.append(len(value))
+        rows = numpy.frombuffer(b"".join(keys), dtype=key_dtype).astype(numpy.int64)
+        sizes = numpy.array(sizes, dtype=numpy.uint64)
+        present = numpy.zeros(-(-n_rows // 8) * 8, dtype=numpy.uint8)
+        present[rows] = 1
+        value_width = int(sizes[0]) if n_items and (sizes == sizes[0]).all() else 0
+        with open(file_name, "wb") as f:
+            f.write(
+                DenseMap.header_struct.pack(
+                    DENSE_MAGIC, n_items, n_rows, value_width, key_dtype.str.encode()
+                )
+            )
+            f.write(present.tobytes())
+            if value_width:
+                # Missing rows are zero-filled
+                blank, row = bytes(value_width), 0
+                for key_row, (_, value) in zip(rows.tolist(), items()):
+                    f.write(blank * (key_row - row))
+                    f.write(value)
+                    row = key_row + 1
+                f.write(blank * (n_rows - row))
+                return True
+            row_sizes = numpy.zeros(n_rows, dtype=numpy.uint64)
+            row_sizes[rows] = sizes
+            value_offsets = numpy.zeros(n_rows + 1, dtype=numpy.uint64)
+            numpy.cumsum(row_sizes, out=value_offsets[1:])
+            f.write(value_offsets.tobytes())
+            for _, value in items():
+                f.write(value)
+        return True
+
+    def get_row(self, row: int) -> Optional[memoryview]:
+        if row >= self.n_rows or not self.present[row]:
+            return None
+        if self.value_width:
+            offset = self.blob_offset + row * self.value_width
+            return self.blob[offset : offset + self.value_width]
+        value_offsets = self.value_offsets
+        return self.blob[
+            self.blob_offset
+            + value_offsets[row] : self.blob_offset
+            + value_offsets[row + 1]
+        ]
+
+    def get_found(self, rows: numpy.ndarray) -> numpy.ndarray:
+        """
+        :param rows: non-negative int array
+        :return: mask of the rows with a value
+        """
+        found = rows < self.n_rows
+        found[found] = numpy.frombuffer(self.present, dtype=numpy.bool_)[rows[found]]
+        return found
+
+    def get_values(self, rows: numpy.ndarray) -> List[memoryview]:
+        """
+        :param rows: int array of rows with a value, see get_found
+        """
+        blob = self.blob
+        if self.value_width:
+            width = self.value_width
+            starts = (rows * width + self.blob_offset).tolist()
+            return [blob[start : start + width] for start in starts]
+        value_offsets = numpy.frombuffer(self.value_offsets, dtype=numpy.uint64)
+        starts = value_offsets[rows] + numpy.uint64(self.blob_offset)
+        ends = value_offsets[rows + 1] + numpy.uint64(self.blob_offset)
+        return [blob[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
+
+    def get_array(self, dtype: numpy.dtype) -> Optional[numpy.ndarray]:
+        """
+        The fixed-width values as an array of dtype, or None if the values do
+        not have the width of dtype
+        """
+        if self.value_width != dtype.itemsize:
+            return None
+        return numpy.frombuffer(
+            self.mmap, dtype=dtype, count=self.n_rows, offset=self.blob_offset
+        )
+
+    def get(self, key: ByteString) -> Optional[memoryview]:
+        return self.get_row(int.from_bytes(key, self.key_byteorder))
+
+    def get_many(self, keys: List[ByteString]) -> List[Optional[memoryview]]:
+        if not keys:
+            return []
+        rows = numpy.frombuffer(b"".join(keys), dtype=self.key_dtype)
+        rows = rows.astype(numpy.int64)
+        found = self.get_found(rows)
+        responds = [None] * len(keys)
+        values = self.get_values(rows[found])
+        for i, value in zip(numpy.flatnonzero(found).tolist(), values):
+            responds[i] = value
+        return responds
+
+    def close(self):
+        try:
+            self.present.release()
+            if self.value_offsets is not None:
+                self.value_offsets.release()
+            self.blob.release()
+            self.mmap.close()
+        except BufferError:
+            # Values handed out by get are still referenced
+            pass
+
+
+def open_frozen(file_name: str) -> Union[FrozenMap, DenseMap]:
+    with open(file_name, "rb") as f:
+        magic = f.read(len(DENSE_MAGIC))
+    if magic == DENSE_MAGIC:
+        return DenseMap(file_name)
+    return FrozenMap(file_name)
+
+
+# Open read sessions of writable databases, resize_env makes the ones
+# reading the resized env stale. Read-only envs are never resized.
+OPEN_SESSIONS = weakref.WeakSet()
+OPEN_SESSIONS_LOCK = threading.Condition()
+# Envs that resize_env is remapping, shared sessions wait for them
+RESIZING = set()
+RESIZE_POLL = 0.001
+
+
+def resize_env(env, map_size: int):
+    """
+    Grow the memory map of an env. LMDB remaps the file, so no read
+    transaction may be active: resize_env waits for the shared sessions of
+    other threads to finish their call (see ReadSession.enter), then aborts
+    the read transactions of the other open sessions on env. These become
+    stale: their next read raises ValueError.
+    """
+    with OPEN_SESSIONS_LOCK:
+        RESIZING.add(env)
+        try:
+            thread = threading.get_ident()
+            sessions = [
+                session for session in list(OPEN_SESSIONS) if session.thread != thread
+            ]
+            while any(session.active for session in sessions):
+                OPEN_SESSIONS_LOCK.wait(RESIZE_POLL)
+            for session in list(OPEN_SESSIONS):
+                session.drop_env(env)
+            env.set_mapsize(map_size)
+        finally:
+            RESIZING.discard(env)
+            OPEN_SESSIONS_LOCK.notify_all()
+
+
+class ReadSession:
+    """
+    Keep one read transaction per LMDB environment (and one cursor per sub
+    database) open for many lookups. All reads of a session see the same
+    snapshot of each environment, also while the FReadDB writes: the written
+    pages do not reuse pages of the snapshot. A write that grows the map
+    (resize_env) makes the session stale, its next read raises ValueError.
+    Async flushes write from another thread, do not keep a session open
+    across them (call save_buff or wait_flush first).
+    A session is bound to the thread that created it, use one session per
+    thread.
+    A shared session is the session of a thread that FReadDB reuses for its
+    single calls (see FReadDB.get_session): each call reads a new snapshot,
+    and resize_env waits for the call instead of making the session stale.
+    """
+
+    def __init__(self, db: "FReadDB", shared: bool = False):
+        self.db = db
+        self.txns = {}
+        self.cursors = {}
+        self.stale = False
+        self.shared = shared
+        # Depth of the nested calls of a shared session
+        self.active = 0
+        self.thread = threading.get_ident()
+        # Snapshots of the session are taken after this time
+        self.started = next(CACHE_CLOCK)
+        if not db.readonly:
+            with OPEN_SESSIONS_LOCK:
+                OPEN_SESSIONS.add(self)
+
+    def __enter__(self):
+        if self.shared:
+            self.enter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.shared:
+            self.close()
+        elif self.active == 1:
+            if self.txns:
+                self.abort_txns()
+            self.active = 0
+        else:
+            self.active -= 1
+
+    def enter(self):
+        """
+        Start a call of a shared session. The outermost call waits for the
+        running resizes, then reads a new snapshot.
+        """
+        self.active += 1
+        if self.active > 1:
+            return
+        self.wait_resizes(1)
+        self.stale = False
+        if self.db.caches:
+            self.started = next(CACHE_CLOCK)
+
+    def wait_resizes(self, depth: int):
+        # resize_env marks RESIZING before it checks the active sessions
+        self.active = depth
+        while RESIZING:
+            self.active = 0
+            with OPEN_SESSIONS_LOCK:
+                OPEN_SESSIONS_LOCK.wait_for(lambda: not RESIZING)
+            self.active = depth
+
+    @contextmanager
+    def paused(self):
+        """
+        Let resize_env run while the thread of an active shared session waits
+        for another thread (the async flusher). The session is stale if a
+        resize dropped its snapshots.
+        """
+        depth, self.active = self.active, 0
+        try:
+            yield
+        finally:
+            if depth:
+                self.wait_resizes(depth)
+
+    def close(self):
+        if self.db.readonly:
+            self.abort_txns()
+            return
+        with OPEN_SESSIONS_LOCK:
+            OPEN_SESSIONS.discard(self)
+            self.abort_txns()
+
+    def abort_txns(self):
+        for txn in self.txns.values():
+            txn.abort()
+        self.txns.clear()
+        self.cursors.clear()
+
+    def drop_env(self, env):
+        txn = self.txns.pop(env, None)
+        if txn is None:
+            return
+        txn.abort()
+        self.cursors = {}
+        self.stale = True
+
+    def check_stale(self):
+        if self.stale:
+            raise ValueError(
+                "Error: The read session is stale, the database map was resized "
+                "by a write, open a new session"
+            )
+
+    def get_txn(self, db_name: str):
+        self.check_stale()
+        env = self.db.env[db_name]
+        txn = self.txns.get(env)
+        if txn is None:
+            if self.db.readonly or self.active:
+                # resize_env waits for the active shared sessions
+                txn = env.begin(buffers=True)
+            else:
+                # Not while resize_env remaps env
+                with OPEN_SESSIONS_LOCK:
+                    self.check_stale()
+                    txn = env.begin(buffers=True)
+            self.txns[env] = txn
+        return txn
+
+    def get_cursor(self, db_name: str):
+        # drop_env clears the cursors of a stale session
+        cur = self.cursors.get(db_name)
+        if cur is None:
+            cur = self.get_txn(db_name).cursor(db=self.db.dbs[db_name])
+            self.cursors[db_name] = cur
+        return cur
+
+    def get_number_items_from(self, db_name: str):
+        return self.get_txn(db_name).stat(self.db.dbs[db_name])["entries"]
+
+    def get_items(self, db_name: str, keys: List[ByteString]) -> List[Tuple]:
+        """
+        Like cursor.getmulti: the (key, value) items of the found keys, in the
+        order of keys. Frozen sub databases are read from their FrozenMap or
+        DenseMap, which hashes the whole batch with numpy.
+        """
+        frozen = self.db.frozen.get(db_name)
+        if frozen is not None:
+            return [
+                (k, v) for k, v in zip(keys, frozen.get_many(keys)) if v is not None
+            ]
+        return self.get_cursor(db_name).getmulti(keys)
+
+    def get_item(self, db_name: str, key: ByteString) -> Optional[ByteString]:
+        """
+        Like cursor.get: the stored value of a serialized key. Frozen sub
+        databases are read from their map without a read transaction, which
+        makes single lookups of FReadDB about 1.3x faster, see
+        scripts/bench.py (lmdb_retrieval_single after lmdb_freeze)
+        """
+        frozen = self.db.frozen.get(db_name)
+        if frozen is not None:
+            return frozen.get(key)
+        return self.get_cursor(db_name).get(key)
+
+    def seek(self, db_name: str, position: int):
+        """
+        Get a cursor positioned at the position-th key of a sub database, or
+        None if the position is out of range. Uses the position index when it
+        is up to date, otherwise walks from the first key.
+        """
+        n_items = self.get_number_items_from(db_name)
+        if position < 0 or position >= n_items:
+            return None
+        cur = self.get_txn(db_name).cursor(db=self.db.dbs[db_name])
+        db_index = self.db.get_position_index(db_name, n_items)
+        if db_index:
+            block, offset = divmod(position, db_index["step"])
+            cur.set_key(db_index["keys"][block])
+        else:
+            offset = position
+            cur.first()
+        for _ in range(offset):
+            cur.next()
+        return cur
+
+    def seek_positions(self, db_name: str, positions: List[int]) -> Iterator:
+        """
+        Move one cursor to each of the sorted positions of a sub database and
+        yield it there. The cursor steps forward from the previous position,
+        or jumps with the position index when that is shorter, so all
+        positions cost one pass over the keys at most.
+        """
+        n_items = self.get_number_items_from(db_name)
+        db_index = self.db.get_position_index(db_name, n_items)
+        cur = self.get_txn(db_name).cursor(db=self.db.dbs[db_name])
+        current = None
+        for position in positions:
+            if position < 0 or position >= n_items:
+                raise ValueError(f"Error: Position {position} is out of range")
+            if current is not None and position < current:
+                raise ValueError("Error: Positions must be sorted")
+            if db_index:
+                block, offset = divmod(position, db_index["step"])
+                if current is None or offset < position - current:
+                    cur.set_key(db_index["keys"][block])
+                    current = position - offset
+            elif current is None:
+                cur.first()
+                current = 0
+            for _ in range(position - current):
+                cur.next()
+            current = position
+            yield cur
+
+    def get_random_key(self, db_name) -> Any:
+        n_items = self.get_number_items_from(db_name)
+        if not n_items:
+            return None
+        cur = self.seek(db_name, random.randrange(n_items))
+        return self.db.codecs[db_name].decode_key(cur.key())
+
+    def sample(self, db_name: str, n: int = 5, get_values: bool = True) -> List:
+        """
+        Get n distinct items of a sub database chosen uniformly at random
+        :return: list of (key, value), or keys if get_values is False
+        """
+        codec = self.db.codecs[db_name]
+        n_items = self.get_number_items_from(db_name)
+        positions = sorted(random.sample(range(n_items), min(n, n_items)))
+        responds = []
+        for cur in self.seek_positions(db_name, positions):
+            key = codec.decode_key(cur.key())
+            if get_values:
+                responds.append((key, codec.decode_value(cur.value())))
+            else:
+                responds.append(key)
+        return responds
+
+    def scan(
+        self,
+        db_name: str,
+        start: Any = None,
+        stop: Any = None,
+        prefix: Any = None,
+        limit: Optional[int] = None,
+        reverse: bool = False,
+        batch_size: int = SCAN_BATCH_SIZE,
+        get_values: bool = True,
+    ) -> Iterator[List]:
+        """
+        Iterate the keys in [start, stop) that begin with prefix in one cursor
+        pass, and yield them as lists of at most batch_size decoded items.
+        :param limit: stop after limit items
+        :param reverse: iterate from the largest key
+        :return: batches of (key, value), or keys if get_values is False
+        """
+        codec = self.db.codecs[db_name]
+        lower = codec.encode_key(start) if start is not None else None
+        upper = codec.encode_key(stop) if stop is not None else None
+        if prefix is not None:
+            if codec.lmdb_integerkey:
+                raise ValueError(
+                    "Error: Prefix scan is not supported for integerkey databases with KeyFormat.LEGACY"
+                )
+            prefix = codec.encode_key(prefix)
+            prefix_upper = get_prefix_upper_bound(prefix)
+            if lower is None or lower < prefix:
+                lower = prefix
+            if prefix_upper is not None and (upper is None or upper > prefix_upper):
+                upper = prefix_upper
+
+        if lower is not None and upper is not None:
+            if codec.lmdb_integerkey:
+                is_empty = start >= stop
+            else:
+                is_empty = lower >= upper
+            if is_empty:
+                return
+        if limit is not None and limit <= 0:
+            return
+
+        # Find the first key out of the range once, then walk until it
+        txn = self.get_txn(db_name)
+        cur = txn.cursor(db=self.db.dbs[db_name])
+        bound_cur = txn.cursor(db=self.db.dbs[db_name])
+        if not reverse:
+            found = cur.set_range(lower) if lower is not None else cur.first()
+            bound = None
+            if upper is not None and bound_cur.set_range(upper):
+                bound = bytes(bound_cur.key())
+            items = cur.iternext(keys=True, values=get_values)
+        else:
+            if upper is None:
+                found = cur.last()
+            elif cur.set_range(upper):
+                found = cur.prev()
+            else:
+                found = cur.last()
+            bound = None
+            if lower is not None:
+                if not bound_cur.set_range(lower):
+                    bound_cur.last()
+                    bound = bytes(bound_cur.key())
+                elif bound_cur.prev():
+                    bound = bytes(bound_cur.key())
+            items = cur.iterprev(keys=True, values=get_values)
+        if not found:
+            return
+
+        decode_key, decode_value = codec.decode_key, codec.decode_value
+        batch = []
+        n_items = 0
+        for item in items:
+            key = item[0] if get_values else item
+            if bound is not None and key == bound:
+                break
+            batch.append(item)
+            n_items += 1
+            if len(batch) == batch_size or n_items == limit:
+                if get_values:
+                    yield [(decode_key(k), decode_value(v)) for k, v in batch]
+                else:
+                    yield [decode_key(k) for k in batch]
+                batch = []
+                if n_items == limit:
+                    return
+        if batch:
+            if get_values:
+                yield [(decode_key(k), decode_value(v)) for k, v in batch]
+            else:
+                yield [decode_key(k) for k in batch]
+
+    def get_iter_integerkey(
+        self, db_name: str, from_i: int = 0, to_i: int = -1, get_values: bool = True
+    ) -> Iterator:
+        if not self.db.codecs[db_name].integerkey:
+            raise ValueError(
+                f"This function used for integerkey databases. {db_name} is not an integerkey database"
+            )
+        stop = to_i + 1 if to_i != -1 else None
+        for batch in self.scan(db_name, start=from_i, stop=stop, get_values=get_values):
+            yield from batch
+
+    def get_iter_with_prefix(
+        self, db_name: str, prefix: Any, get_values=True
+    ) -> Iterator:
+        for batch in self.scan(db_name, prefix=prefix, get_values=get_values):
+            yield from batch
+
+    def is_available(self, db_name: str, key_obj: str) -> bool:
+        key_obj = self.db.codecs[db_name].encode_key(key_obj)
+        if key_obj and self.get_item(db_name, key_obj):
+            return True
+        return False
+
+    def get_value_byte_size(self, db_name: str, key_obj: Any) -> Union[int, None]:
+        key_obj = self.db.codecs[db_name].encode_key(key_obj)
+        if key_obj:
+            value_obj = self.get_item(db_name, key_obj)
+            if value_obj:
+                return len(value_obj)
+        return None
+
+    def get_values(
+        self,
+        db_name: str,
+        key_objs: List,
+        get_deserialize: bool = True,
+        check_buffer: bool = False,
+        fields: Optional[List[str]] = None,
+    ):
+        """
+        Get the values of keys, missing keys are left out.
+        :param check_buffer: read unflushed add_buff/delete_buff items first
+        :param fields: fields of ToBytes.RECORD values, see get_record_columns
+        """
+        codec = self.db.codecs[db_name]
+        if fields is not None:
+            return self.get_record_columns(
+                db_name, key_objs, fields, check_buffer=check_buffer
+            )
+        if isinstance(key_objs, numpy.ndarray):
+            key_objs = key_objs.tolist()
+        responds = dict()
+
+        if not (
+            isinstance(key_objs, list)
+            or isinstance(key_objs, set)
+            or isinstance(key_objs, tuple)
+        ):
+            return responds
+
+        key_objs = [codec.encode_key(k) for k in key_objs]
+        if check_buffer and self.db.has_buffered(db_name):
+            db_keys = []
+            for k in key_objs:
+                v = self.db.get_buffered(db_name, k, get_deserialize=get_deserialize)
+                if v is BUFF_MISSING:
+                    db_keys.append(k)
+                elif v is not None:
+                    responds[codec.decode_key(k)] = v
+            key_objs = db_keys
+
+        cache = self.db.caches.get(db_name) if get_deserialize else None
+        if cache is not None:
+            db_keys = []
+            for k in key_objs:
+                v = cache.get(k)
+                if v is CACHE_MISSING:
+                    db_keys.append(k)
+                else:
+                    responds[codec.decode_key(k)] = v
+            key_objs = db_keys
+
+        for k, v in self.get_items(db_name, key_objs):
+            if not v:
+                continue
+            key = codec.decode_key(k)
+            if get_deserialize:
+                try:
+                    v = self.decode_value(codec, cache, k, v)
+                except Exception as message:
+                    print(message)
+            responds[key] = v
+
+        return responds
+
+    def get_record_schema(self, db_name: str) -> RecordSchema:
+        record_schema = self.db.codecs[db_name].record_schema
+        if record_schema is None:
+            raise ValueError(f"Error: {db_name} does not store RECORD values")
+        return record_schema
+
+    def get_record_columns(
+        self,
+        db_name: str,
+        key_objs: List,
+        fields: List[str],
+        check_buffer: bool = False,
+    ) -> Tuple[dict, numpy.ndarray]:
+        """
+        Get fields of ToBytes.RECORD values aligned to key_objs, decoded from
+        the fixed-width part of the records without decoding the others.
+        :return: (dict of field: column, found mask), numeric fields are numpy
+        arrays with 0 for missing keys, the other fields are object arrays
+        with None for missing keys
+        """
+        codec = self.db.codecs[db_name]
+        record_schema = self.get_record_schema(db_name)
+        key_objs = [codec.encode_key(k) for k in key_objs]
+        n_keys = len(key_objs)
+        found = numpy.zeros(n_keys, dtype=bool)
+
+        buffered = {}
+        if check_buffer and self.db.has_buffered(db_name):
+            for i, k in enumerate(key_objs):
+                v = self.db.get_buffered(db_name, k)
+                if v is not BUFF_MISSING:
+                    buffered[i] = v
+        rows = [i for i in range(n_keys) if i not in buffered]
+
+        # getmulti returns the found items in the order of the keys
+        found_rows, payloads = [], []
+        items = self.get_items(db_name, [key_objs[i] for i in rows])
+        i = 0
+        for k, v in items:
+            while key_objs[rows[i]] != k:
+                i += 1
+            found_rows.append(rows[i])
+            payloads.append(codec.get_payload(v))
+            i += 1
+        found[found_rows] = True
+
+        columns = {}
+        for name, column in record_schema.decode_columns(payloads, fields).items():
+            if column.dtype == object:
+                columns[name] = numpy.full(n_keys, None, dtype=object)
+            else:
+                columns[name] = numpy.zeros(n_keys, dtype=column.dtype)
+            columns[name][found_rows] = column
+        for i, v in buffered.items():
+            if v is None:
+                continue
+            found[i] = True
+            v = record_schema.decode_fields(record_schema.encode(v), fields)
+            for name in fields:
+                columns[name][i] = v[name]
+        return columns, found
+
+    def decode_value(self, codec: DBCodec, cache: Optional[ValueCache], key, value_obj):
+        value = codec.decode_value(value_obj)
+        if cache is not None:
+            if isinstance(value, numpy.ndarray) and value.base is not None:
+                # Do not keep views of the memory map
+                value = value.copy()
+            # Values of a snapshot older than a write are not cached
+            cache.put(bytes(key), value, len(value_obj), since=self.started)
+        return value
+
+    def get_bitmaps(self, db_name: str, key_objs: List) -> List[BitMap]:
+        """
+        Get the INT_BITMAP values of keys, missing keys are left out
+        """
+        codec = self.db.codecs[db_name]
+        if codec.bytes_value != ToBytes.INT_BITMAP:
+            raise ValueError(f"Error: {db_name} does not store INT_BITMAP values")
+        key_objs = [codec.encode_key(k) for k in key_objs]
+        decode_value = codec.decode_value
+        return [
+            decode_value(v)
+            for _, v in self.get_items(db_name, key_objs)
+            if v is not None
+        ]
+
+    def bitmap_and(self, db_name: str, key_objs: List) -> BitMap:
+        bitmaps = self.get_bitmaps(db_name, key_objs)
+        if not bitmaps or len(bitmaps) < len(key_objs):
+            return BitMap()
+        return BitMap.intersection(*bitmaps)
+
+    def bitmap_or(self, db_name: str, key_objs: List) -> BitMap:
+        bitmaps = self.get_bitmaps(db_name, key_objs)
+        if not bitmaps:
+            return BitMap()
+        return BitMap.union(*bitmaps)
+
+    def bitmap_andnot(self, db_name: str, key_objs: List) -> BitMap:
+        """
+        The bitmap of the first key minus the bitmaps of the other keys
+        """
+        if not key_objs:
+            return BitMap()
+        bitmaps = self.get_bitmaps(db_name, key_objs[:1])
+        if not bitmaps:
+            return BitMap()
+        others = self.get_bitmaps(db_name, key_objs[1:])
+        if not others:
+            return bitmaps[0]
+        return bitmaps[0].difference(*others)
+
+    def bitmap_cardinality(self, db_name: str, key_objs: List, op: str = None):
+        """
+        :param op: None for the cardinality of each key, or "and", "or",
+        "andnot" for the cardinality of their combination
+        :return: dict of key: cardinality, or the combined cardinality
+        """
+        if op is None:
+            codec = self.db.codecs[db_name]
+            key_objs = [codec.encode_key(k) for k in key_objs]
+            return {
+                codec.decode_key(k): len(codec.decode_value(v))
+                for k, v in self.get_items(db_name, key_objs)
+                if v is not None
+            }
+        bitmap_ops = {
+            "and": self.bitmap_and,
+            "or": self.bitmap_or,
+            "andnot": self.bitmap_andnot,
+        }
+        if op not in bitmap_ops:
+            raise ValueError(f"Error: Unknown bitmap operation {op}")
+        return len(bitmap_ops[op](db_name, key_objs))
+
+    def get_posting_lists(
+        self, db_name: str, key_objs: List, packed: bool = False
+    ) -> List[Any]:
+        """
+        Get the INT_NUMPY values of keys as views of the LMDB memory map, or
+        the decoded INT_PACKED values, missing keys are left out. Views are
+        only valid until the session is closed.
+        :param packed: return the packed bytes of INT_PACKED values
+        """
+        codec = self.db.codecs[db_name]
+        if codec.bytes_value not in (ToBytes.INT_NUMPY, ToBytes.INT_PACKED):
+            raise ValueError(
+                f"Error: {db_name} does not store INT_NUMPY or INT_PACKED values"
+            )
+        key_objs = [codec.encode_key(k) for k in key_objs]
+        if packed and codec.bytes_value == ToBytes.INT_PACKED:
+            view_value = partial(get_value_payload, value_dict=codec.value_dict)
+            if not codec.value_header:
+                view_value = memoryview
+        else:
+            view_value = codec.view_value
+        return [
+            view_value(v) for _, v in self.get_items(db_name, key_objs) if v is not None
+        ]
+
+    def postings_intersect(self, db_name: str, key_objs: List) -> numpy.ndarray:
+        codec = self.db.codecs[db_name]
+        if codec.bytes_value == ToBytes.INT_PACKED:
+            return self.packed_postings_intersect(db_name, key_objs)
+        postings = self.get_posting_lists(db_name, key_objs)
+        if not postings or len(postings) < len(key_objs):
+            return numpy.array([], dtype=numpy.uint32)
+        # Start from the shortest list, the result only shrinks
+        postings.sort(key=len)
+        responds = postings[0].copy()
+        for posting in postings[1:]:
+            if not len(responds):
+                break
+            responds = intersect_sorted(responds, posting)
+        return responds
+
+    def packed_postings_intersect(self, db_name: str, key_objs: List) -> numpy.ndarray:
+        postings = self.get_posting_lists(db_name, key_objs, packed=True)
+        if not postings or len(postings) < len(key_objs):
+            return numpy.array([], dtype=numpy.uint32)
+        # Start from the shortest list, by the item counts of the skip tables
+        postings = [(get_packed_blocks(v), v) for v in postings]
+        postings.sort(key=lambda item: item[0][0])
+        responds = unpack_sorted_ints(postings[0][1])
+        for (n_items, firsts, _), posting in postings[1:]:
+            if not len(responds):
+                break
+            if n_items >= len(responds) * POSTING_GALLOP_RATIO:
+                # Only unpack the blocks that may hold the current items
+                blocks = numpy.searchsorted(firsts, responds, side="right") - 1
+                blocks = numpy.unique(blocks[blocks >= 0])
+                posting = unpack_sorted_ints(posting, blocks)
+            else:
+                posting = unpack_sorted_ints(posting)
+            responds = intersect_sorted(responds, posting)
+        return responds
+
+    def postings_union(self, db_name: str, key_objs: List) -> numpy.ndarray:
+        postings = self.get_posting_lists(db_name, key_objs)
+        if not postings:
+            return numpy.array([], dtype=numpy.uint32)
+        if len(postings) == 1:
+            return postings[0].copy()
+        return numpy.unique(numpy.concatenate(postings))
+
+    def postings_count(self, db_name: str, key_objs: List, op: str = "and") -> int:
+        """
+        :param op: "and" for the size of the intersection, "or" of the union
+        """
+        if op == "and":
+            return len(self.postings_intersect(db_name, key_objs))
+        if op == "or":
+            return len(self.postings_union(db_name, key_objs))
+        raise ValueError(f"Error: Unknown posting list operation {op}")
+
+    def postings_top_k(
+        self, db_name: str, key_objs: List, k: int = 10
+    ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Get the k items found in the most posting lists of keys
+        :return: items and their frequencies, by descending frequency then item,
+        empty if k <= 0
+        """
+        postings = self.get_posting_lists(db_name, key_objs)
+        if not postings or k <= 0:
+            return (
+                numpy.array([], dtype=numpy.uint32),
+                numpy.array([], dtype=numpy.int64),
+            )
+        items, counts = numpy.unique(numpy.concatenate(postings), return_counts=True)
+        if len(items) > k:
+            # Items are sorted, ties at the k-th frequency keep the smallest
+            threshold = numpy.partition(counts, len(counts) - k)[len(counts) - k]
+            top = numpy.flatnonzero(counts > threshold)
+            ties = numpy.flatnonzero(counts == threshold)[: k - len(top)]
+            top = numpy.concatenate((top, ties))
+            items, counts = items[top], counts[top]
+        order = numpy.lexsort((items, -counts))
+        return items[order], counts[order]
+
+    def get_values_array(
+        self,
+        db_name: str,
+        key_objs: numpy.ndarray,
+        dtype: Optional[numpy.dtype] = None,
+        fill_value: Any = 0,
+    ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Get values of an integerkey sub database aligned to key_objs.
+        :param dtype: None returns an object array with None for missing keys,
+        otherwise a typed array where missing keys are fill_value. ToBytes.BYTES
+        values are read as raw fixed-width items of dtype.
+        :return: (values, found mask)
+        """
+        codec = self.db.codecs[db_name]
+        if not codec.integerkey:
+            raise ValueError("Error: get_values_array is used for integerkey databases")
+        key_dtype = codec.key_dtype
+        if key_dtype is None:
+            raise ValueError("Error: get_values_array needs fixed-width integer keys")
+        key_objs = numpy.asarray(key_objs)
+        if key_objs.size and (
+            key_objs.min() < 0 or key_objs.max() > numpy.iinfo(key_dtype).max
+        ):
+            raise ValueError(f"Error: keys are out of {key_dtype} range")
+        key_objs = numpy.ascontiguousarray(key_objs, dtype=key_dtype).ravel()
+        n_keys = len(key_objs)
+        frozen = self.db.frozen.get(db_name)
+        if isinstance(frozen, DenseMap):
+            # Keys are rows of the dense map
+            rows = key_objs.astype(numpy.int64)
+            found = frozen.get_found(rows)
+            if (
+                dtype is not None
+                and codec.bytes_value == ToBytes.BYTES
+                and not codec.value_header
+            ):
+                array = frozen.get_array(numpy.dtype(dtype))
+                if array is not None:
+                    values = numpy.full(n_keys, fill_value, dtype=dtype)
+                    values[found] = array[rows[found]]
+                    return values, found
+            found_values = frozen.get_values(rows[found])
+        else:
+            # One bytes object per key, sliced from the array buffer by numpy
+            key_bytes = key_objs.view(f"V{key_dtype.itemsize}").tolist()
+            found = numpy.zeros(n_keys, dtype=bool)
+            found_values = []
+            items = self.get_items(db_name, key_bytes)
+            if len(items) == n_keys:
+                found[:] = True
+                found_values = [v for _, v in items]
+            else:
+                # getmulti returns the found items in the order of key_bytes
+                i = 0
+                for k, v in items:
+                    while key_bytes[i] != k:
+                        i += 1
+                    found[i] = True
+                    found_values.append(v)
+                    i += 1
+
+        if dtype is None:
+            values = numpy.full(n_keys, None, dtype=object)
+            # One by one, numpy would broadcast array values into the rows
+            for i, v in zip(numpy.flatnonzero(found).tolist(), found_values):
+                values[i] = codec.decode_value(v)
+            return values, found
+
+        dtype = numpy.dtype(dtype)
+        values = numpy.full(n_keys, fill_value, dtype=dtype)
+        if not found_values:
+            return values, found
+        if codec.bytes_value == ToBytes.BYTES:
+            if codec.value_header:
+                found_values = [codec.view_value(v) for v in found_values]
+            values[found] = numpy.frombuffer(b"".join(found_values), dtype=dtype)
+        else:
+            values[found] = [codec.decode_value(v) for v in found_values]
+        return values, found
+
+    def get_value(
+        self,
+        db_name: str,
+        key_obj: Any,
+        get_deserialize: bool = True,
+        check_buffer: bool = False,
+        fields: Optional[List[str]] = None,
+    ):
+        """
+        :param fields: only decode these fields of a ToBytes.RECORD value
+        """
+        key_obj = self.db.codecs[db_name].encode_key(key_obj)
+        responds = None
+        if not key_obj:
+            return responds
+        if fields is not None:
+            return self.get_record_fields(
+                db_name, key_obj, fields, check_buffer=check_buffer
+            )
+        if check_buffer and self.db.has_buffered(db_name):
+            value_obj = self.db.get_buffered(
+                db_name, key_obj, get_deserialize=get_deserialize
+            )
+            if value_obj is not BUFF_MISSING:
+                return value_obj
+        cache = self.db.caches.get(db_name) if get_deserialize else None
+        if cache is not None:
+            value_obj = cache.get(key_obj)
+            if value_obj is not CACHE_MISSING:
+                return value_obj
+        # Errors of the transaction (a stale session) are raised
+        value_obj = self.get_item(db_name, key_obj)
+        if not value_obj:
+            return responds
+        responds = value_obj
+        if get_deserialize:
+            try:
+                responds = self.decode_value(
+                    self.db.codecs[db_name], cache, key_obj, value_obj
+                )
+            except Exception as message:
+                print(message)
+
+        return responds
+
+    def get_record_fields(
+        self,
+        db_name: str,
+        key_obj: bytes,
+        fields: List[str],
+        check_buffer: bool = False,
+    ) -> Optional[dict]:
+        record_schema = self.get_record_schema(db_name)
+        if check_buffer and self.db.has_buffered(db_name):
+            value_obj = self.db.get_buffered(db_name, key_obj)
+            if value_obj is None:
+                return None
+            if value_obj is not BUFF_MISSING:
+                value_obj = record_schema.encode(value_obj)
+                return record_schema.decode_fields(value_obj, fields)
+        value_obj = self.get_item(db_name, key_obj)
+        if value_obj is None:
+            return None
+        payload = self.db.codecs[db_name].get_payload(value_obj)
+        return record_schema.decode_fields(payload, fields)
+
+    def get_view(self, db_name: str, key_obj: Any):
+        """
+        Get a value without copying it out of the LMDB memory map: INT_NUMPY
+        and NDARRAY values are numpy.frombuffer views and BYTES values are
+        memoryviews.
+        Views are only valid until the session is closed.
+        """
+        codec = self.db.codecs[db_name]
+        value_obj = self.get_item(db_name, codec.encode_key(key_obj))
+        if value_obj is None:
+            return None
+        return codec.view_value(value_obj)
+
+    def head(self, db_name: str, n: int = 5, from_i: int = 0):
+        respond = defaultdict()
+        for i, (k, v) in enumerate(self.get_db_iter(db_name, from_i=from_i)):
+            respond[k] = v
+            if i == n - 1:
+                break
+        return respond
+
+    def get_db_iter(
+        self,
+        db_name: str,
+        get_values: bool = True,
+        deserialize_obj: bool = True,
+        from_i: int = 0,
+        to_i: int = -1,
+    ):
+        codec = self.db.codecs[db_name]
+        if to_i == -1:
+            to_i = self.get_number_items_from(db_name)
+
+        cur = self.seek(db_name, from_i)
+        if cur is None:
+            return
+        for i, db_obj in enumerate(cur.iternext(values=get_values), start=from_i):
+            if i >= to_i:
+                break
+
+            if get_values:
+                key, value = db_obj
+            else:
+                key = db_obj
+            try:
+                if deserialize_obj:
+                    key = codec.decode_key(key)
+                    if get_values:
+                        value = codec.decode_value(value)
+                else:
+                    key = bytes(key)
+                    if get_values:
+                        value = bytes(value)
+                if get_values:
+                    return_obj = (key, value)
+                    yield return_obj
+                else:
+                    yield key
+            except UnicodeDecodeError:
+                print(f"UnicodeDecodeError: {i}")
+            except Exception:
+                print(i)
+                raise Exception
+
+
+# Read-only database opened once per parallel_scan worker process
+parallel_scan_db = None
+
+
+def init_parallel_scan_worker(db_file: str):
+    global parallel_scan_db
+    parallel_scan_db = FReadDB(db_file=db_file, readonly=True)
+
+
+def run_parallel_scan_range(args: tuple) -> Tuple[bool, Any]:
+    db_name, start, stop, fn, reduce_fn, chunk_keys, get_values = args
+    results = [
+        fn(batch)
+        for batch in parallel_scan_db.scan(
+            db_name,
+            start=start,
+            stop=stop,
+            batch_size=chunk_keys,
+            get_values=get_values,
+        )
+    ]
+    if reduce_fn is None:
+        return True, results
+    if not results:
+        return False, None
+    return True, reduce(reduce_fn, results)
+
+
+class FReadDB:
+    def __init__(
+        self,
+        db_file: str,
+        db_schema: Optional[List[DBSpec]] = None,
+        map_size: int = None,
+        readonly: bool = False,
+        buff_limit: int = LMDB_BUFF_LIMIT,
+        split_subdatabases=False,
+        workers: int = 1,
+        chunk_size: int = SERIALIZE_CHUNK_SIZE,
+        async_flush: bool = False,
+        flush_queue_size: int = 1,
+        cache_size: int = 0,
+        cache_bytes: int = 0,
+        cache_policy: str = "lru",
+    ):
+        __slots__ = [
+            "db_file",
+            "metadata_file",
+            "db_schema",
+            "buff_limit",
+            "split_subdatabases",
+            "max_db",
+            "map_size",
+            "readonly",
+            "env",
+            "buff",
+            "buff_size",
+            "codecs",
+            "position_index_file",
+            "position_index",
+            "workers",
+            "chunk_size",
+            "pool",
+            "async_flush",
+            "flush_queue_size",
+            "flush_queue",
+            "flusher",
+            "flushing",
+            "flush_error",
+            "flush_dropped",
+            "caches",
+            "frozen",
+            "local",
+        ]
+
+        db_file_name = db_file.split("/")[-1]
+        self.db_file = db_file + f"/{db_file_name}"
+        create_dir(self.db_file)
+
+        self.metadata_file = self.db_file + "_metadata.json"
+        create_dir(self.metadata_file)
+        self.position_index_file = self.db_file + "_position_index.msgpack"
+        self.position_index = None
+
+        if readonly and not os.path.exists(self.db_file) and not split_subdatabases:
+            split_subdatabases = True
+
+        if db_schema:
+            self.db_schema = {db_spec.name: db_spec for db_spec in db_schema}
+            self.buff_limit = buff_limit
+            self.save_metadata_info(db_schema, buff_limit)
+        else:
+            self.db_schema, self.buff_limit = self.load_metadata_info()
+
+        self.split_subdatabases = split_subdatabases
+        self.max_db = len(self.db_schema)
+        self.map_size = map_size
+        self.readonly = readonly
+
+        self.env, self.dbs = None, None
+        self.init_env_and_sub_databases()
+
+        # Shared read sessions of the threads, see get_session
+        self.local = threading.local()
+
+        self.buff = defaultdict(WriteBuffer)
+        self.buff_size = 0
+
+        # With workers > 1, buffered items are serialized by a process pool
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.pool = None
+
+        # With async_flush, full buffers are written by a background thread
+        # while add_buff fills a fresh one. At most flush_queue_size full
+        # buffers wait behind the one being written, then add_buff blocks.
+        # After a failed flush the queued buffers are not written, and the
+        # next add_buff or save_buff raises. The writer thread may grow the
+        # map: it waits for the running single calls (get_value, ...), and
+        # makes open snapshot sessions stale, do not keep a snapshot open
+        # across async flushes.
+        self.async_flush = async_flush
+        self.flush_queue_size = flush_queue_size
+        self.flush_queue = None
+        self.flusher = None
+        self.flushing = deque()
+        self.flush_error = None
+        self.flush_dropped = 0
+
+        # Decoded value caches, sub databases without their own cache_size
+        # in DBSpec use the FReadDB settings
+        self.caches = {}
+        for db_name, db_spec in self.db_schema.items():
+            if db_spec.cache_size:
+                self.caches[db_name] = ValueCache(
+                    db_spec.cache_size, db_spec.cache_bytes, db_spec.cache_policy
+                )
+            elif cache_size:
+                self.caches[db_name] = ValueCache(cache_size, cache_bytes, cache_policy)
+
+        # Frozen sub databases are read from their perfect hash maps
+        self.frozen = {}
+        self.load_frozen()
+
+    def get_pool(self) -> multiprocessing.pool.Pool:
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        return self.pool
+
+    def save_metadata_info(self, db_schema: List[DBSpec], buff_limit: int):
+        json_obj = {
+            "db_schema": [asdict(db_i) for db_i in db_schema],
+            "buff_limit": buff_limit,
+        }
+        save_json_file(self.metadata_file, json_obj)
+
+    def load_metadata_info(self):
+        json_obj = read_json_file(self.metadata_file)
+        db_schema = {obj["name"]: DBSpec(**obj) for obj in json_obj["db_schema"]}
+        buff_limit = json_obj["buff_limit"]
+        return db_schema, buff_limit
+
+    def load_position_index(self) -> dict:
+        if self.position_index is None:
+            self.position_index = {}
+            if os.path.exists(self.position_index_file):
+                with open(self.position_index_file, "rb") as f:
+                    self.position_index = msgpack.unpackb(f.read())
+        return self.position_index
+
+    def save_position_index(self):
+        with open(self.position_index_file, "wb") as f:
+            f.write(msgpack.packb(self.position_index))
+
+    def get_position_index(self, db_name: str, n_items: int) -> Optional[dict]:
+        db_index = self.load_position_index().get(db_name)
+        # The index is stale if the sub database was changed by another writer
+        if db_index is None or db_index["entries"] != n_items:
+            return None
+        return db_index
+
+    def build_position_index(
+        self, db_names: Optional[List[str]] = None, step: int = POSITION_INDEX_STEP
+    ) -> bool:
+        """
+        Sample every step-th key of the sub databases, so get_db_iter, head
+        and sample can seek to an ordinal position without walking from the
+        first key. The samples are saved next to the metadata file.
+        """
+        if db_names is None:
+            db_names = list(self.db_schema.keys())
+        self.load_position_index()
+        with self.get_session() as session:
+            for db_name in db_names:
+                cur = session.get_txn(db_name).cursor(db=self.dbs[db_name])
+                keys = [
+                    bytes(k)
+                    for i, k in enumerate(cur.iternext(values=False))
+                    if i % step == 0
+                ]
+                self.position_index[db_name] = {
+                    "step": step,
+                    "entries": session.get_number_items_from(db_name),
+                    "keys": keys,
+                }
+        self.save_position_index()
+        return True
+
+    def invalidate_cache(self, db_name: str, keys: Optional[Iterator] = None):
+        """
+        Drop cached values of serialized keys, or of all keys. Read-only
+        databases cannot be written, so their caches are never invalidated.
+        """
+        cache = self.caches.get(db_name)
+        if cache is None or self.readonly:
+            return
+        cache.invalidate(keys)
+
+    def cache_stats(self) -> dict:
+        return {db_name: cache.stats() for db_name, cache in self.caches.items()}
+
+    def get_frozen_file(self, db_name: str) -> str:
+        return self.db_file + f"_{db_name}.frozen"
+
+    def load_frozen(self):
+        with self.get_session() as session:
+            for db_name in self.db_schema.keys():
+                frozen_file = self.get_frozen_file(db_name)
+                if not os.path.exists(frozen_file):
+                    continue
+                try:
+                    frozen = open_frozen(frozen_file)
+                except ValueError:
+                    # Written by an older version, freeze builds it again
+                    continue
+                # The map is stale if the sub database was changed by another writer
+                if len(frozen) != session.get_number_items_from(db_name):
+                    frozen.close()
+                    continue
+                self.frozen[db_name] = frozen
 
-        self.split_subdatabases = split_subdatabases
-        self.max_db = len(self.db_schema)
-        self.map_size = map_size
-        self.readonly = readonly
+    def freeze(
+        self, db_names: Optional[List[str]] = None, show_progress: bool = False
+    ) -> bool:
+        """
+        Build a static map of the sub databases: a minimal perfect hash of
+        their keys and a copy of their values in a memory-mapped file. Lookups
+        of frozen sub databases read one slot per key instead of walking the
+        LMDB B+tree: single lookups (get_value) need no read transaction, and
+        batch lookups (get_values, get_values_array, posting lists and
+        bitmaps) hash all keys with numpy. Integer keys that are dense (see
+        DBSpec.dense_keys) are frozen as a DenseMap, indexed by the key
+        itself. Any write to a sub database drops its map.
+        """
+        if db_names is None:
+            db_names = [
+                db_name for db_name, db_spec in self.db_schema.items() if db_spec.freeze
+            ]
+        self.save_buff()
+        for db_name in db_names:
+            self.invalidate_frozen(db_name)
+            frozen_file = self.get_frozen_file(db_name)
+            with self.get_session() as session:
+                txn = session.get_txn(db_name)
+                n_items = session.get_number_items_from(db_name)
+
+                def items():
+                    return tqdm(
+                        txn.cursor(db=self.dbs[db_name]).iternext(),
+                        total=n_items,
+                        desc=f"Freeze {db_name}",
+                        disable=not show_progress,
+                    )
 
-        self.env, self.dbs = None, None
-        self.init_env_and_sub_databases()
+                n_rows = self.get_dense_rows(
+                    db_name, txn.cursor(db=self.dbs[db_name]), n_items
+                )
+                if n_rows is None:
+                    FrozenMap.build(frozen_file, items, n_items)
+                else:
+                    DenseMap.build(
+                        frozen_file,
+                        items,
+                        n_items,
+                        n_rows,
+                        self.codecs[db_name].key_dtype,
+                    )
+            self.frozen[db_name] = open_frozen(frozen_file)
+        return True
 
-        self.buff = defaultdict(list)
-        self.buff_size = 0
+    def get_dense_rows(self, db_name: str, cur, n_items: int) -> Optional[int]:
+        """
+        :return: largest key + 1 if the sub database is frozen as a DenseMap,
+        otherwise None
+        """
+        db_spec, codec = self.db_schema[db_name], self.codecs[db_name]
+        if db_spec.dense_keys is False or codec.key_dtype is None or codec.combinekey:
+            return None
+        if not n_items:
+            return 0
+        cur.last()
+        n_rows = int(numpy.frombuffer(cur.key(), dtype=codec.key_dtype)[0]) + 1
+        if db_spec.dense_keys is None and n_rows > n_items * DENSE_KEY_RATIO:
+            return None
+        return n_rows
 
-    def save_metadata_info(self, db_schema: List[DBSpec], buff_limit: int):
-        json_obj = {
-            "db_schema": [asdict(db_i) for db_i in db_schema],
-            "buff_limit": buff_limit,
-        }
-        save_json_file(self.metadata_file, json_obj)
+    def invalidate_frozen(self, db_name: str):
+        frozen = self.frozen.pop(db_name, None)
+        if frozen is not None:
+            frozen.close()
+        frozen_file = self.get_frozen_file(db_name)
+        if os.path.exists(frozen_file):
+            os.remove(frozen_file)
 
-    def load_metadata_info(self):
-        json_obj = read_json_file(self.metadata_file)
-        db_schema = {obj["name"]: DBSpec(**obj) for obj in json_obj["db_schema"]}
-        buff_limit = json_obj["buff_limit"]
-        return db_schema, buff_limit
+    def invalidate_position_index(self, db_name: str):
+        if db_name in self.load_position_index():
+            del self.position_index[db_name]
+            self.save_position_index()
 
     def init_env_and_sub_databases(self) -> bool:
         self.env = {}
         self.dbs = {}
+        self.codecs = {}
         default_env = None
         if not self.split_subdatabases:
             default_env = lmdb.open(
@@ -432,7 +3467,7 @@ class FReadDB:
                 map_async=True,
                 writemap=True,
                 subdir=False,
-                lock=False,
+                lock=not self.readonly,
                 max_dbs=self.max_db,
                 readonly=self.readonly,
             )
@@ -444,7 +3479,7 @@ class FReadDB:
                     map_async=True,
                     writemap=True,
                     subdir=False,
-                    lock=False,
+                    lock=not self.readonly,
                     max_dbs=2,
                     readonly=self.readonly,
                 )
@@ -461,8 +3496,10 @@ class FReadDB:
                     self.env[db_spec.name].set_mapsize(self.map_size)
             if db_spec.combinekey:
                 db_spec.integerkey = False
+            self.codecs[db_spec.name] = DBCodec(db_spec)
             self.dbs[db_spec.name] = self.env[db_spec.name].open_db(
-                db_spec.name.encode(ENCODING), integerkey=db_spec.integerkey
+                db_spec.name.encode(ENCODING),
+                integerkey=self.codecs[db_spec.name].lmdb_integerkey,
             )
 
         return True
@@ -518,11 +3555,26 @@ class FReadDB:
         return get_file_size(tmp)
 
     def get_number_items_from(self, db_name: str):
-        with self.env[db_name].begin(db=self.dbs[db_name]) as txn:
-            return txn.stat()["entries"]
+        with self.get_session() as session:
+            return session.get_number_items_from(db_name)
 
     def close(self):
         self.save_buff()
+        if self.flusher is not None:
+            self.flush_queue.put(None)
+            self.flusher.join()
+            self.flusher = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        session = getattr(self.local, "session", None)
+        if session is not None:
+            session.close()
+            self.local = threading.local()
+        for frozen in self.frozen.values():
+            frozen.close()
+        self.frozen = {}
         if self.split_subdatabases:
             for env_i in self.env.values():
                 env_i.close()
@@ -550,12 +3602,137 @@ class FReadDB:
             )
         return size_org, size_curr
 
-    def compress(self, print_status=True) -> None:
+    def train_value_dict(
+        self,
+        db_name: str,
+        n_samples: int = VALUE_DICT_SAMPLES,
+        batch_size: int = SCAN_BATCH_SIZE,
+    ) -> int:
+        """
+        Train an LZ4 dictionary from sample values of a sub database with
+        value_header and compress_value, save it in the metadata, and rewrite
+        the values with it.
+        :return: size of the dictionary
+        """
+        db_spec = self.db_schema[db_name]
+        if not (db_spec.value_header and db_spec.compress_value):
+            raise ValueError(
+                "Error: Value dictionaries need value_header and compress_value"
+            )
+        old_codec = self.codecs[db_name]
+        plain_codec = get_codec(bytes_value=db_spec.bytes_value, value_header=True)
+        # Every step-th value in one cursor pass, without seeking per sample
+        with self.get_session() as session:
+            n_items = session.get_number_items_from(db_name)
+            step = max(1, -(-n_items // n_samples))
+            cur = session.get_txn(db_name).cursor(db=self.dbs[db_name])
+            samples = [
+                plain_codec.encode_value(old_codec.decode_value(value))[1:]
+                for value in islice(cur.iternext(keys=False), 0, None, step)
+            ]
+        value_dict = train_value_dict(samples)
+        if not value_dict:
+            return 0
+
+        db_spec = replace(db_spec, value_dict=base64.b64encode(value_dict).decode())
+        self.db_schema[db_name] = db_spec
+        self.save_metadata_info(list(self.db_schema.values()), self.buff_limit)
+        codec = DBCodec(db_spec)
+        self.codecs[db_name] = codec
+
+        # The values are re-encoded in key order, batch_size per transaction
+        env, db = self.env[db_name], self.dbs[db_name]
+        start = None
+        while True:
+            try:
+                with env.begin(db=db, write=True) as txn:
+                    cur = txn.cursor()
+                    found = cur.set_range(start) if start else cur.first()
+                    items = []
+                    while found and len(items) < batch_size:
+                        items.append((cur.key(), cur.value()))
+                        found = cur.next()
+                    start = cur.key() if found else None
+                    cur.putmulti(
+                        [
+                            (k, codec.encode_value(old_codec.decode_value(v)))
+                            for k, v in items
+                        ]
+                    )
+            except lmdb.MapFullError:
+                resize_env(env, env.info()["map_size"] + LMDB_BUFF_LIMIT)
+                start = items[0][0]
+                continue
+            if start is None:
+                break
+        self.invalidate_cache(db_name)
+        self.invalidate_frozen(db_name)
+        return len(value_dict)
+
+    def compression_stats(self, db_name: Optional[str] = None) -> dict:
+        """
+        Compression ratio of the values of sub databases
+        :return: dict of db_name: {"values", "raw_bytes", "stored_bytes", "ratio"}
+        """
+        db_names = [db_name] if db_name else list(self.db_schema.keys())
+        responds = {}
+        for db_name in db_names:
+            codec = self.codecs[db_name]
+            n_values, raw_bytes, stored_bytes = 0, 0, 0
+            with self.get_session() as session:
+                txn = session.get_txn(db_name)
+                cur = txn.cursor(db=self.dbs[db_name])
+                for value in cur.iternext(keys=False, values=True):
+                    n_values += 1
+                    stored_bytes += len(value)
+                    if codec.value_header:
+                        if (value[0] >> 4) & 3 == ValueCompression.NONE:
+                            raw_bytes += len(value)
+                        else:
+                            # LZ4 blocks start with the uncompressed size
+                            raw_bytes += 1 + int.from_bytes(value[1:5], "little")
+                    elif codec.compress_value and codec.bytes_value not in (
+                        ToBytes.INT_NUMPY,
+                        ToBytes.INT_PACKED,
+                        ToBytes.NDARRAY,
+                        ToBytes.RECORD,
+                        ToBytes.INT_BITMAP,
+                        ToBytes.BYTES,
+                    ):
+                        try:
+                            raw_bytes += len(frame.decompress(value))
+                        except RuntimeError:
+                            raw_bytes += len(value)
+                    else:
+                        raw_bytes += len(value)
+            responds[db_name] = {
+                "values": n_values,
+                "raw_bytes": raw_bytes,
+                "stored_bytes": stored_bytes,
+                "ratio": raw_bytes / stored_bytes if stored_bytes else 1.0,
+            }
+        return responds
+
+    def compress(self, print_status=True, train_dict: bool = True) -> None:
         """
         Copy current env to new one (reduce file size)
+        :param train_dict: first train LZ4 dictionaries of the sub databases
+        with value_header and compress_value, see train_value_dict. Sub
+        databases with DBSpec.freeze are frozen after the copy, see freeze
         :return:
         :rtype:
         """
+        if train_dict and not self.readonly:
+            self.save_buff()
+            for db_name, db_spec in self.db_schema.items():
+                if not (db_spec.value_header and db_spec.compress_value):
+                    continue
+                if not self.get_number_items_from(db_name):
+                    continue
+                self.train_value_dict(db_name)
+                if print_status:
+                    ratio = self.compression_stats(db_name)[db_name]["ratio"]
+                    print(f"{db_name}: compression ratio {ratio:.2f}x")
         if not self.split_subdatabases:
             size_org = os.stat(self.db_file).st_size
             new_dir = self.db_file + ".copy"
@@ -584,177 +3761,300 @@ class FReadDB:
                 print(
                     f"Compressed: {100 - total_cur / total_org *100:.2f}% - {get_file_size(total_cur)}/{get_file_size(total_org)}"
                 )
+        self.build_position_index()
+        self.freeze()
+
+    def get_session(self) -> ReadSession:
+        """
+        The shared read session of the current thread, reused by the single
+        calls of FReadDB (get_value, get_values, ...):
+            with self.get_session() as session:
+                return session.get_value(db_name, key)
+        Each call reads a new snapshot, see ReadSession.enter
+        """
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = ReadSession(self, shared=True)
+            self.local.session = session
+        return session
+
+    def snapshot(self) -> ReadSession:
+        """
+        Open a read session, use it as a context manager:
+            with db.snapshot() as session:
+                session.get_value(db_name, key)
+        :return: ReadSession
+        """
+        return ReadSession(self)
+
+    def convert_key_format(
+        self,
+        db_file: str,
+        key_format: KeyFormat = KeyFormat.BIG_ENDIAN,
+        db_names: Optional[List[str]] = None,
+        show_progress: bool = True,
+    ) -> "FReadDB":
+        """
+        Copy the database to db_file and rewrite the integer and combined keys
+        of db_names (default: all sub databases) in key_format. Values are
+        copied as they are stored.
+        :return: the new database
+        :rtype: FReadDB
+        """
+        if db_names is None:
+            db_names = list(self.db_schema.keys())
+        db_schema = []
+        for db_name, db_spec in self.db_schema.items():
+            if db_name in db_names and (db_spec.integerkey or db_spec.combinekey):
+                db_spec = replace(db_spec, key_format=key_format)
+            db_schema.append(db_spec)
+
+        new_db = FReadDB(
+            db_file=db_file,
+            db_schema=db_schema,
+            map_size=self.map_size,
+            buff_limit=self.buff_limit,
+            split_subdatabases=self.split_subdatabases,
+        )
+        for db_name in self.db_schema.keys():
+            decode_key = self.codecs[db_name].decode_key
+            new_codec = new_db.codecs[db_name]
+            rewrite_key = (
+                new_codec.key_format != self.codecs[db_name].key_format
+                and db_name in db_names
+            )
+            p_bar = None
+            if show_progress:
+                p_bar = tqdm(
+                    total=self.get_number_items_from(db_name),
+                    desc=f"Convert {db_name}",
+                )
+            buff, buff_size = [], 0
+            for key, value in self.get_db_iter(db_name, deserialize_obj=False):
+                if rewrite_key:
+                    key = new_codec.encode_key(decode_key(key))
+                buff.append((key, value))
+                buff_size += len(key) + len(value)
+                if buff_size >= self.buff_limit:
+                    FReadDB.write(
+                        new_db.env[db_name], new_db.dbs[db_name], buff, codec=new_codec
+                    )
+                    if show_progress:
+                        p_bar.update(len(buff))
+                    buff, buff_size = [], 0
+            if buff:
+                FReadDB.write(
+                    new_db.env[db_name], new_db.dbs[db_name], buff, codec=new_codec
+                )
+            if show_progress:
+                p_bar.update(len(buff))
+                p_bar.close()
+        return new_db
 
     def get_random_key(self, db_name) -> Any:
-        db_schema = self.db_schema[db_name].get_key_args()
-        with self.env[db_name].begin(db=self.dbs[db_name], write=False) as txn:
-            random_index = random.randint(0, self.get_number_items_from(db_name))
-            cur = txn.cursor()
-            cur.first()
-            key = deserialize_key(cur.key(), **db_schema)
-            for i, k in enumerate(cur.iternext(values=False)):
-                if i == random_index:
-                    key = deserialize_key(k, **db_schema)
-                    break
-        return key
+        with self.get_session() as session:
+            return session.get_random_key(db_name)
+
+    def sample(self, db_name: str, n: int = 5, get_values: bool = True) -> List:
+        with self.get_session() as session:
+            return session.sample(db_name, n=n, get_values=get_values)
+
+    def scan(
+        self,
+        db_name: str,
+        start: Any = None,
+        stop: Any = None,
+        prefix: Any = None,
+        limit: Optional[int] = None,
+        reverse: bool = False,
+        batch_size: int = SCAN_BATCH_SIZE,
+        get_values: bool = True,
+    ) -> Iterator[List]:
+        with self.get_session() as session:
+            yield from session.scan(
+                db_name,
+                start=start,
+                stop=stop,
+                prefix=prefix,
+                limit=limit,
+                reverse=reverse,
+                batch_size=batch_size,
+                get_values=get_values,
+            )
+
+    def get_partition_keys(self, db_name: str, n_parts: int) -> List[Any]:
+        """
+        Get the keys that split a sub database into n_parts contiguous ranges
+        of about the same number of items. The boundaries are found in one
+        cursor pass, see ReadSession.seek_positions
+        """
+        with self.get_session() as session:
+            n_items = session.get_number_items_from(db_name)
+            n_parts = max(1, min(n_parts, n_items))
+            decode_key = self.codecs[db_name].decode_key
+            positions = [n_items * i // n_parts for i in range(1, n_parts)]
+            return [
+                decode_key(cur.key())
+                for cur in session.seek_positions(db_name, positions)
+            ]
+
+    def parallel_scan(
+        self,
+        db_name: str,
+        fn: Callable[[List], Any],
+        workers: Optional[int] = None,
+        chunk_keys: int = SCAN_BATCH_SIZE,
+        reduce_fn: Optional[Callable[[Any, Any], Any]] = None,
+        get_values: bool = True,
+        parts_per_worker: int = 4,
+    ) -> Any:
+        """
+        Scan a whole sub database with a pool of processes. The key space is
+        split into contiguous ranges, each worker opens the database read-only
+        and calls fn on decoded batches of at most chunk_keys items.
+        Only data saved to disk is scanned. fn and reduce_fn must be picklable.
+        :param reduce_fn: combine the results of fn, e.g. operator.add
+        :return: reduce_fn over all results, or the list of results of fn in
+        key order if reduce_fn is None
+        """
+        if workers is None:
+            workers = os.cpu_count()
+        ranges = [None] + self.get_partition_keys(db_name, workers * parts_per_worker)
+        ranges = [
+            (db_name, start, stop, fn, reduce_fn, chunk_keys, get_values)
+            for start, stop in zip(ranges, ranges[1:] + [None])
+        ]
+        with multiprocessing.Pool(
+            workers,
+            initializer=init_parallel_scan_worker,
+            initargs=(os.path.dirname(self.db_file),),
+        ) as pool:
+            results = pool.map(run_parallel_scan_range, ranges, chunksize=1)
+
+        if reduce_fn is None:
+            return [result for _, part in results for result in part]
+        results = [result for has_result, result in results if has_result]
+        if not results:
+            return None
+        return reduce(reduce_fn, results)
 
     def get_iter_integerkey(
         self, db_name: str, from_i: int = 0, to_i: int = -1, get_values: bool = True
     ) -> Iterator:
-        db_key_args = self.db_schema[db_name].get_key_args()
-        db_value_args = self.db_schema[db_name].get_value_args()
-        with self.env[db_name].begin(db=self.dbs[db_name], write=False) as txn:
-            if to_i == -1:
-                to_i = self.get_number_items_from(db_name)
-            cur = txn.cursor()
-            cur.first()
-            cur.set_range(serialize_key(from_i, **db_key_args))
-            for item in cur.iternext(values=get_values):
-                if get_values:
-                    key, value = item
-                else:
-                    key = item
-                key = deserialize_key(key, **db_key_args)
-                if not isinstance(key, int):
-                    raise ValueError(
-                        f"This function used for integerkey databases. This is {type(key)} key database"
-                    )
-                if key > to_i:
-                    break
-                if get_values:
-                    value = deserialize_value(value, **db_value_args)
-                    yield key, value
-                else:
-                    yield key
-            cur.next()
+        with self.get_session() as session:
+            yield from session.get_iter_integerkey(
+                db_name, from_i=from_i, to_i=to_i, get_values=get_values
+            )
 
     def get_iter_with_prefix(
         self, db_name: str, prefix: Any, get_values=True
     ) -> Iterator:
-        db_key_args = self.db_schema[db_name].get_key_args()
-        db_value_args = self.db_schema[db_name].get_value_args()
-        with self.env[db_name].begin(db=self.dbs[db_name], write=False) as txn:
-            cur = txn.cursor()
-            prefix = serialize_key(prefix, **db_key_args)
-            status = cur.set_range(prefix)
-            if status:
-                range_key = cur.key()
-            else:
-                return
-
-            while status and cur.key().startswith(prefix) is True:
-                try:
-                    if cur.key() and not cur.key().startswith(prefix):
-                        continue
-                    key = deserialize_key(cur.key(), **db_key_args)
-                    if get_values:
-                        value = deserialize_value(cur.value(), **db_value_args)
-                        yield key, value
-                    else:
-                        yield key
-                except Exception as message:
-                    print(message)
-                status = cur.next()
-
-            status = cur.set_range(range_key)
-            status = cur.prev()
-            while status and cur.key().startswith(prefix) is True:
-                try:
-                    if cur.key() and not cur.key().startswith(prefix):
-                        continue
-                    key = deserialize_key(cur.key(), **db_key_args)
-                    if get_values:
-                        value = deserialize_value(cur.value(), **db_value_args)
-                        yield key, value
-                    else:
-                        yield key
-                except Exception as message:
-                    print(message)
-                status = cur.prev()
+        with self.get_session() as session:
+            yield from session.get_iter_with_prefix(
+                db_name, prefix, get_values=get_values
+            )
 
     def is_available(self, db_name: str, key_obj: str) -> bool:
-        db_key_args = self.db_schema[db_name].get_key_args()
-        with self.env[db_name].begin(db=self.dbs[db_name]) as txn:
-            key_obj = serialize_key(key_obj, **db_key_args)
-            if key_obj:
-                try:
-                    value_obj = txn.get(key_obj)
-                    if value_obj:
-                        return True
-                except Exception as message:
-                    print(message)
-        return False
+        with self.get_session() as session:
+            return session.is_available(db_name, key_obj)
 
     def get_value_byte_size(self, db_name: str, key_obj: Any) -> Union[int, None]:
-        db_key_args = self.db_schema[db_name].get_key_args()
-        with self.env[db_name].begin(db=self.dbs[db_name], buffers=True) as txn:
-            key_obj = serialize_key(key_obj, **db_key_args)
-            if key_obj:
-                try:
-                    value_obj = txn.get(key_obj)
-                    if value_obj:
-                        return len(value_obj)
-                except Exception as message:
-                    print(message)
-            return None
+        with self.get_session() as session:
+            return session.get_value_byte_size(db_name, key_obj)
 
-    def get_values(self, db_name: str, key_objs: List, get_deserialize: bool = True):
-        db_key_args = self.db_schema[db_name].get_key_args()
-        db_value_args = self.db_schema[db_name].get_value_args()
-        with self.env[db_name].begin(db=self.dbs[db_name], buffers=True) as txn:
-            if isinstance(key_objs, numpy.ndarray):
-                key_objs = key_objs.tolist()
-            responds = dict()
-
-            if not (
-                isinstance(key_objs, list)
-                or isinstance(key_objs, set)
-                or isinstance(key_objs, tuple)
-            ):
-                return responds
+    def get_values(
+        self,
+        db_name: str,
+        key_objs: List,
+        get_deserialize: bool = True,
+        check_buffer: bool = False,
+        fields: Optional[List[str]] = None,
+    ):
+        with self.get_session() as session:
+            return session.get_values(
+                db_name,
+                key_objs,
+                get_deserialize=get_deserialize,
+                check_buffer=check_buffer,
+                fields=fields,
+            )
 
-            key_objs = [serialize_key(k, **db_key_args) for k in key_objs]
-            for k, v in txn.cursor(self.dbs[db_name]).getmulti(key_objs):
-                if not v:
-                    continue
-                k = deserialize_key(k, **db_key_args)
-                if get_deserialize:
-                    try:
-                        v = deserialize_value(v, **db_value_args)
-                    except Exception as message:
-                        print(message)
-                responds[k] = v
+    def bitmap_and(self, db_name: str, key_objs: List) -> BitMap:
+        with self.get_session() as session:
+            return session.bitmap_and(db_name, key_objs)
 
-        return responds
+    def bitmap_or(self, db_name: str, key_objs: List) -> BitMap:
+        with self.get_session() as session:
+            return session.bitmap_or(db_name, key_objs)
 
-    def get_value(self, db_name: str, key_obj: Any, get_deserialize: bool = True):
-        db_key_args = self.db_schema[db_name].get_key_args()
-        db_value_args = self.db_schema[db_name].get_value_args()
-        with self.env[db_name].begin(db=self.dbs[db_name], buffers=True) as txn:
-            key_obj = serialize_key(key_obj, **db_key_args)
-            responds = None
-            if not key_obj:
-                return responds
-            try:
-                value_obj = txn.get(key_obj)
-                if not value_obj:
-                    return responds
-                responds = value_obj
-                if get_deserialize:
-                    responds = deserialize_value(value_obj, **db_value_args)
+    def bitmap_andnot(self, db_name: str, key_objs: List) -> BitMap:
+        with self.get_session() as session:
+            return session.bitmap_andnot(db_name, key_objs)
 
-            except Exception as message:
-                print(message)
+    def bitmap_cardinality(self, db_name: str, key_objs: List, op: str = None):
+        with self.get_session() as session:
+            return session.bitmap_cardinality(db_name, key_objs, op=op)
 
-        return responds
+    def postings_intersect(self, db_name: str, key_objs: List) -> numpy.ndarray:
+        with self.get_session() as session:
+            return session.postings_intersect(db_name, key_objs)
+
+    def postings_union(self, db_name: str, key_objs: List) -> numpy.ndarray:
+        with self.get_session() as session:
+            return session.postings_union(db_name, key_objs)
+
+    def postings_count(self, db_name: str, key_objs: List, op: str = "and") -> int:
+        with self.get_session() as session:
+            return session.postings_count(db_name, key_objs, op=op)
+
+    def postings_top_k(
+        self, db_name: str, key_objs: List, k: int = 10
+    ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        with self.get_session() as session:
+            return session.postings_top_k(db_name, key_objs, k=k)
+
+    def get_values_array(
+        self,
+        db_name: str,
+        key_objs: numpy.ndarray,
+        dtype: Optional[numpy.dtype] = None,
+        fill_value: Any = 0,
+    ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        with self.get_session() as session:
+            return session.get_values_array(
+                db_name, key_objs, dtype=dtype, fill_value=fill_value
+            )
+
+    def get_value(
+        self,
+        db_name: str,
+        key_obj: Any,
+        get_deserialize: bool = True,
+        check_buffer: bool = False,
+        fields: Optional[List[str]] = None,
+    ):
+        with self.get_session() as session:
+            return session.get_value(
+                db_name,
+                key_obj,
+                get_deserialize=get_deserialize,
+                check_buffer=check_buffer,
+                fields=fields,
+            )
+
+    @contextmanager
+    def view(self, db_name: str, key_obj: Any):
+        """
+        Borrow a value without copying it, see ReadSession.get_view:
+            with db.view(db_name, key) as arr:
+                arr.sum()
+        """
+        with self.get_session() as session:
+            yield session.get_view(db_name, key_obj)
 
     def head(self, db_name: str, n: int = 5, from_i: int = 0):
-        respond = defaultdict()
-        for i, (k, v) in enumerate(self.get_db_iter(db_name, from_i=from_i)):
-            respond[k] = v
-            if i == n - 1:
-                break
-        return respond
+        with self.get_session() as session:
+            return session.head(db_name, n=n, from_i=from_i)
 
     def get_db_iter(
         self,
@@ -764,41 +4064,17 @@ class FReadDB:
         from_i: int = 0,
         to_i: int = -1,
     ):
-        db_key_args = self.db_schema[db_name].get_key_args()
-        db_value_args = self.db_schema[db_name].get_value_args()
-        if to_i == -1:
-            to_i = self.get_number_items_from(db_name)
-
-        with self.env[db_name].begin(db=self.dbs[db_name]) as txn:
-            cur = txn.cursor()
-            for i, db_obj in enumerate(cur.iternext(values=get_values)):
-                if i < from_i:
-                    continue
-                if i >= to_i:
-                    break
-
-                if get_values:
-                    key, value = db_obj
-                else:
-                    key = db_obj
-                try:
-                    if deserialize_obj:
-                        key = deserialize_key(key, **db_key_args)
-                        if get_values:
-                            value = deserialize_value(value, **db_value_args)
-                    if get_values:
-                        return_obj = (key, value)
-                        yield return_obj
-                    else:
-                        yield key
-                except UnicodeDecodeError:
-                    print(f"UnicodeDecodeError: {i}")
-                except Exception:
-                    print(i)
-                    raise Exception
+        with self.get_session() as session:
+            yield from session.get_db_iter(
+                db_name,
+                get_values=get_values,
+                deserialize_obj=deserialize_obj,
+                from_i=from_i,
+                to_i=to_i,
+            )
 
     def delete(self, db_name: str, key: Any, with_prefix: bool = False) -> Any:
-        db_key_args = self.db_schema[db_name].get_key_args()
+        codec = self.codecs[db_name]
         if not (
             isinstance(key, list) or isinstance(key, set) or isinstance(key, tuple)
         ):
@@ -812,29 +4088,90 @@ class FReadDB:
             if true_key:
                 key = list(true_key)
 
-        deleted_items = 0
+        deleted_keys = []
         with self.env[db_name].begin(
             db=self.dbs[db_name], write=True, buffers=True
         ) as txn:
             for k in key:
                 try:
-                    status = txn.delete(serialize_key(k, **db_key_args))
+                    k = codec.encode_key(k)
+                    status = txn.delete(k)
                     if status:
-                        deleted_items += 1
+                        deleted_keys.append(k)
                 except Exception as message:
                     print(message)
+        deleted_items = len(deleted_keys)
+        if deleted_items:
+            self.invalidate_cache(db_name, deleted_keys)
+            self.invalidate_position_index(db_name)
+            self.invalidate_frozen(db_name)
         return deleted_items
 
+    @staticmethod
+    def is_appendable(txn, data: List[Tuple[bytes, bytes]], codec: DBCodec) -> bool:
+        """
+        Check whether the keys of data are strictly increasing and all come
+        after the last key of the sub database, so they can be put with
+        MDB_APPEND
+        """
+        merge_key = get_merge_key(codec)
+        keys = [merge_key(item) for item in data]
+        if not all(map(operator.lt, keys, islice(keys, 1, None))):
+            return False
+        return FReadDB.is_after_last_key(txn, data[0][0], codec)
+
+    @staticmethod
+    def is_after_last_key(txn, key: bytes, codec: DBCodec) -> bool:
+        cur = txn.cursor()
+        if not cur.last():
+            return True
+        merge_key = get_merge_key(codec)
+        return merge_key((bytes(cur.key()),)) < merge_key((key,))
+
+    @staticmethod
+    def write_buffer(env, db, buff: WriteBuffer, codec: DBCodec) -> int:
+        order = buff.get_order(codec)
+        added_items = 0
+        try:
+            with env.begin(db=db, write=True) as txn:
+                for key in buff.tombstones:
+                    txn.delete(key)
+                if not order:
+                    return 0
+                cur = txn.cursor()
+                # Buffered keys are sorted and unique, append if they are new
+                if FReadDB.is_after_last_key(txn, buff.get_key(order[0]), codec):
+                    _, added_items = cur.putmulti(buff.iter_items(order), append=True)
+                    if added_items != len(order):
+                        _, added_items = cur.putmulti(buff.iter_items(order))
+                else:
+                    _, added_items = cur.putmulti(buff.iter_items(order))
+        except lmdb.MapFullError:
+            curr_limit = env.info()["map_size"]
+            resize_env(env, curr_limit + LMDB_BUFF_LIMIT)
+            return FReadDB.write_buffer(env, db, buff, codec)
+        return added_items
+
     @staticmethod
     def write(
         env, db, data, sort_key: bool = True, one_sample_write: bool = False, **kargs
     ):
-        data = preprocess_data_before_dump(data, sort_key=sort_key, **kargs)
+        codec = kargs.pop("codec", None)
+        if codec is None:
+            codec = get_codec(**kargs)
+        data = preprocess_data_before_dump(data, sort_key=sort_key, codec=codec)
         added_items = 0
         try:
             with env.begin(db=db, write=True, buffers=True) as txn:
                 if not one_sample_write:
-                    _, added_items = txn.cursor().putmulti(data)
+                    cur = txn.cursor()
+                    if data and FReadDB.is_appendable(txn, data, codec):
+                        # Append mode skips the B-tree search and fills pages
+                        _, added_items = cur.putmulti(data, append=True)
+                        if added_items != len(data):
+                            _, added_items = cur.putmulti(data)
+                    else:
+                        _, added_items = cur.putmulti(data)
                 else:
                     for k, v in data:
                         txn.put(k, v)
@@ -842,8 +4179,8 @@ class FReadDB:
         except lmdb.MapFullError:
             curr_limit = env.info()["map_size"]
             new_limit = curr_limit + LMDB_BUFF_LIMIT
-            env.set_mapsize(new_limit)
-            return FReadDB.write(env, db, data, sort_key=False)
+            resize_env(env, new_limit)
+            return FReadDB.write(env, db, data, sort_key=False, codec=codec)
         except lmdb.BadValsizeError:
             print(lmdb.BadValsizeError)
         except lmdb.BadTxnError:
@@ -854,6 +4191,7 @@ class FReadDB:
                     data,
                     sort_key=False,
                     one_sample_write=True,
+                    codec=codec,
                 )
         except Exception:
             raise Exception
@@ -868,13 +4206,21 @@ class FReadDB:
         show_progress: bool = True,
         step: int = 10000,
         message: str = "DB Write",
+        workers: int = 1,
+        chunk_size: int = SERIALIZE_CHUNK_SIZE,
         **kwargs,
     ) -> bool:
-        data = preprocess_data_before_dump(
-            data,
-            sort_key=sort_key,
-            **kwargs,
-        )
+        if workers > 1 and sort_key:
+            with multiprocessing.Pool(workers) as pool:
+                data = preprocess_data_parallel(
+                    data, pool, chunk_size=chunk_size, **kwargs
+                )
+        else:
+            data = preprocess_data_before_dump(
+                data,
+                sort_key=sort_key,
+                **kwargs,
+            )
 
         def update_desc():
             return f"{message} buffer: {buff_size / LMDB_BUFF_LIMIT * 100:.0f}%"
@@ -892,7 +4238,7 @@ class FReadDB:
             buff_size += len(k) + len(v)
 
             if buff_size >= LMDB_BUFF_LIMIT:
-                c = FReadDB.write(env, db, data[i_pre:i], sort_key=False)
+                c = FReadDB.write(env, db, data[i_pre:i], sort_key=False, **kwargs)
                 if c != len(data[i_pre:i]):
                     print(
                         f"WriteError: Missing data. Expected: {len(data[i_pre:i])} - Actual: {c}"
@@ -901,7 +4247,7 @@ class FReadDB:
                 buff_size = 0
 
         if buff_size:
-            FReadDB.write(env, db, data[i_pre:], sort_key=False)
+            FReadDB.write(env, db, data[i_pre:], sort_key=False, **kwargs)
 
         if show_progress:
             p_bar.update(len(data) % step)
@@ -909,22 +4255,141 @@ class FReadDB:
             p_bar.close()
         return True
 
+    def load_stream(
+        self,
+        db_name: str,
+        data: Iterator[Tuple[Any, Any]],
+        memory_limit: Optional[int] = None,
+        tmp_dir: Optional[str] = None,
+        show_progress: bool = True,
+        message: str = "DB Load",
+    ) -> int:
+        """
+        Load (key, value) pairs from an iterator of any size. Items are
+        serialized into sorted runs of at most memory_limit bytes (default:
+        buff_limit), runs are spilled to temporary files in tmp_dir, and the
+        runs are merged into LMDB in key order. The last value of a key wins.
+        :return: number of loaded items
+        """
+        if memory_limit is None:
+            memory_limit = self.buff_limit
+        codec = self.codecs[db_name]
+        env, db = self.env[db_name], self.dbs[db_name]
+        merge_key = get_merge_key(codec)
+        p_bar = tqdm(desc=message) if show_progress else None
+
+        def write_sorted(items: Iterator[Tuple[bytes, bytes]]):
+            buff, buff_size = [], 0
+            for k, v in items:
+                buff.append((k, v))
+                buff_size += len(k) + len(v)
+                if buff_size >= self.buff_limit:
+                    FReadDB.write(env, db, buff, sort_key=False, codec=codec)
+                    buff, buff_size = [], 0
+            if buff:
+                FReadDB.write(env, db, buff, sort_key=False, codec=codec)
+
+        n_items = 0
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+            run_files = []
+            run, run_size = [], 0
+            for k, v in data:
+                if not is_byte_obj(k):
+                    k = codec.encode_key(k)
+                v = codec.encode_value(v)
+                run.append((k, v))
+                # Tuple and bytes objects overhead
+                run_size += len(k) + len(v) + 130
+                n_items += 1
+                if run_size >= memory_limit:
+                    run.sort(key=merge_key)
+                    run_files.append(os.path.join(run_dir, f"{len(run_files)}.run"))
+                    dump_sorted_run(run_files[-1], run)
+                    run, run_size = [], 0
+                if show_progress and n_items % 10_000 == 0:
+                    p_bar.update(10_000)
+
+            run.sort(key=merge_key)
+            if not run_files:
+                write_sorted(run)
+            else:
+                runs = [read_sorted_run(file_name) for file_name in run_files]
+                write_sorted(heapq.merge(*runs, run, key=merge_key))
+            del run
+
+        if show_progress:
+            p_bar.update(n_items % 10_000)
+            p_bar.close()
+        self.invalidate_cache(db_name)
+        self.invalidate_position_index(db_name)
+        self.invalidate_frozen(db_name)
+        return n_items
+
+    @staticmethod
+    def merge_write(env, db, data: List[Tuple], codec: DBCodec, merge: Callable):
+        """
+        Merge items into the values stored under their keys: the stored values
+        are read with getmulti and the merged values are written back in the
+        same write transaction.
+        :return: number of skipped, updated, and new items
+        """
+        c_skip, c_update, c_new = 0, 0, 0
+        keys = [codec.encode_key(k) for k, _ in data]
+        try:
+            with env.begin(db=db, write=True) as txn:
+                cur = txn.cursor()
+                db_values = dict(cur.getmulti(keys))
+                merged = {}
+                for key, (_, value) in zip(keys, data):
+                    if key in merged:
+                        db_value = merged[key]
+                    else:
+                        db_value = db_values.get(key)
+                        if db_value is not None:
+                            db_value = codec.decode_value(db_value)
+                    if db_value is None:
+                        c_new += 1
+                    else:
+                        value = merge(db_value, value)
+                        if value is db_value:
+                            c_skip += 1
+                            continue
+                        c_update += 1
+                    merged[key] = value
+                items = [(k, codec.encode_value(v)) for k, v in merged.items()]
+                items.sort(key=get_merge_key(codec))
+                cur.putmulti(items)
+        except lmdb.MapFullError:
+            curr_limit = env.info()["map_size"]
+            resize_env(env, curr_limit + LMDB_BUFF_LIMIT)
+            return FReadDB.merge_write(env, db, data, codec, merge)
+        return c_skip, c_update, c_new
+
     def update_bulk_with_buffer(
         self,
         db_name,
         data,
-        update_type=DBUpdateType.SET,
+        update_type: Union[DBUpdateType, Callable] = DBUpdateType.SET,
         show_progress: bool = True,
         step: int = 10000,
         message="",
         buff_limit=LMDB_BUFF_LIMIT,
     ) -> bool:
-        db = self.dbs[db_name]
-        db_schema = self.db_schema[db_name].get_args()
+        """
+        Merge data into the stored values, step items per write transaction.
+        :param data: dict or iterable of (key, value)
+        :param update_type: a DBUpdateType merge operator, or a callable
+        merge(db_value, value) returning the value to write, or db_value to
+        skip the key
+        :param buff_limit: unused, items are merged in batches of step items
+        """
+        merge = get_merge_operator(update_type)
+        env, db, codec = self.env[db_name], self.dbs[db_name], self.codecs[db_name]
+        if isinstance(data, dict):
+            data = data.items()
 
-        buff = []
         p_bar = None
-        c_skip, c_update, c_new, c_buff = 0, 0, 0, 0
+        c_skip, c_update, c_new = 0, 0, 0
 
         def update_desc():
             return (
@@ -932,57 +4397,31 @@ class FReadDB:
                 f"|Skip:{c_skip:,}"
                 f"|New:{c_new:,}"
                 f"|Update:{c_update:,}"
-                f"|Buff:{c_buff / buff_limit * 100:.0f}%"
             )
 
         if show_progress:
-            p_bar = tqdm(total=len(data), desc=update_desc())
+            total = len(data) if hasattr(data, "__len__") else None
+            p_bar = tqdm(total=total, desc=update_desc())
 
-        for i, (k, v) in enumerate(data.items()):
-            if show_progress and i and i % step == 0:
-                p_bar.update(step)
-                p_bar.set_description(update_desc())
-
-            db_obj = self.get_value(db_name, k)
-            if update_type == DBUpdateType.SET:
-                if db_obj:
-                    db_obj = set(db_obj)
-                    v = set(v)
-                    if db_obj and len(v) <= len(db_obj) and db_obj.issuperset(v):
-                        c_skip += 1
-                        continue
-                    if db_obj:
-                        v.update(db_obj)
-                        c_update += 1
-                    else:
-                        c_new += 1
-                else:
-                    c_new += 1
-            else:
-                if db_obj:
-                    v += db_obj
-                    c_update += 1
-                else:
-                    c_new += 1
-
-            k, v = serialize(
-                k,
-                v,
-                **db_schema,
+        data = iter(data)
+        while True:
+            batch = list(islice(data, step))
+            if not batch:
+                break
+            c_skip_i, c_update_i, c_new_i = self.merge_write(
+                env, db, batch, codec, merge
             )
+            c_skip += c_skip_i
+            c_update += c_update_i
+            c_new += c_new_i
+            if show_progress:
+                p_bar.update(len(batch))
+                p_bar.set_description(update_desc())
 
-            c_buff += len(k) + len(v)
-            buff.append((k, v))
-
-            if c_buff >= buff_limit:
-                FReadDB.write(self.env[db_name], db, buff)
-                buff = []
-                c_buff = 0
-
-        if buff:
-            FReadDB.write(self.env[db_name], db, buff)
+        self.invalidate_cache(db_name)
+        self.invalidate_position_index(db_name)
+        self.invalidate_frozen(db_name)
         if show_progress:
-            p_bar.set_description(desc=update_desc())
             p_bar.close()
         return True
 
@@ -990,46 +4429,164 @@ class FReadDB:
         with self.env[db_name].begin(write=True) as in_txn:
             in_txn.drop(self.dbs[db_name])
             print(in_txn.stat())
+        self.invalidate_cache(db_name)
+        self.invalidate_position_index(db_name)
+        self.invalidate_frozen(db_name)
         return True
 
-    def save_buff(self) -> bool:
-        while self.buff:
-            gc.collect()
-            db_name, buff = self.buff.popitem()
-            self.write(
-                self.env[db_name],
-                self.dbs[db_name],
-                buff,
-                **self.db_schema[db_name].get_args(),
+    def flush_buffers(self, buffs: dict):
+        for db_name, buff in buffs.items():
+            if buff.pending:
+                kwargs = self.db_schema[db_name].get_args()
+                pending_values = list(buff.pending.values())
+                chunks = [
+                    (pending_values[i : i + self.chunk_size], kwargs)
+                    for i in range(0, len(pending_values), self.chunk_size)
+                ]
+                buff.serialize_pending(
+                    [
+                        value
+                        for values in self.get_pool().map(
+                            serialize_values_chunk, chunks
+                        )
+                        for value in values
+                    ]
+                )
+            self.write_buffer(
+                self.env[db_name], self.dbs[db_name], buff, self.codecs[db_name]
             )
-        del self.buff
-        gc.collect()
-        self.buff = defaultdict(list)
+            cache = self.caches.get(db_name)
+            if cache is not None and len(buff) + len(buff.tombstones) < len(cache):
+                self.invalidate_cache(db_name, buff.index)
+                self.invalidate_cache(db_name, buff.tombstones)
+            else:
+                self.invalidate_cache(db_name)
+            self.invalidate_position_index(db_name)
+            self.invalidate_frozen(db_name)
+
+    def run_flusher(self):
+        while True:
+            buffs = self.flush_queue.get()
+            try:
+                if buffs is None:
+                    return
+                if self.flush_error is None:
+                    self.flush_buffers(buffs)
+                else:
+                    # Drain the queue after a failed flush, wait_flush reports
+                    # the buffers that were not written
+                    self.flush_dropped += 1
+            except Exception as message:
+                self.flush_error = message
+                self.flush_dropped += 1
+            finally:
+                if buffs is not None:
+                    self.flushing.popleft()
+                self.flush_queue.task_done()
+
+    def flush_buff_async(self):
+        if self.flush_error is not None:
+            self.wait_flush()
+        if self.flusher is None:
+            self.flush_queue = queue.Queue(maxsize=self.flush_queue_size)
+            self.flusher = threading.Thread(target=self.run_flusher, daemon=True)
+            self.flusher.start()
+        buffs = self.buff
+        self.buff = defaultdict(WriteBuffer)
+        self.buff_size = 0
+        if buffs:
+            self.flushing.append(buffs)
+            with self.flush_waiting():
+                self.flush_queue.put(buffs)
+
+    def flush_waiting(self):
+        """
+        Pause the shared session of the current thread (a get_db_iter loop
+        that adds items) while it waits for the flusher, which may resize
+        the map
+        """
+        session = getattr(self.local, "session", None)
+        if session is None:
+            return nullcontext()
+        return session.paused()
+
+    def wait_flush(self):
+        if self.flush_queue is not None:
+            with self.flush_waiting():
+                self.flush_queue.join()
+        if self.flush_error is not None:
+            message, self.flush_error = self.flush_error, None
+            n_dropped, self.flush_dropped = self.flush_dropped, 0
+            raise ValueError(
+                f"Error: Async flush failed, {n_dropped} buffers were not written: "
+                f"{message}"
+            ) from message
+
+    def has_buffered(self, db_name: str) -> bool:
+        if self.buff.get(db_name):
+            return True
+        return any(buffs.get(db_name) for buffs in list(self.flushing))
+
+    def get_buffered(self, db_name: str, key: bytes, get_deserialize: bool = True):
+        """
+        Get the value of a serialized key from the unflushed buffers, the
+        newest first.
+        :return: BUFF_MISSING if the key is not buffered, None if it is deleted
+        """
+        codec = self.codecs[db_name]
+        buffs = [self.buff] + list(self.flushing)[::-1]
+        for buffs_i in buffs:
+            buff = buffs_i.get(db_name)
+            if buff is None:
+                continue
+            value = buff.get(key, codec, get_deserialize=get_deserialize)
+            if value is not BUFF_MISSING:
+                return value
+        return BUFF_MISSING
+
+    def save_buff(self) -> bool:
+        if self.async_flush or self.flusher is not None:
+            self.flush_buff_async()
+            self.wait_flush()
+            return True
+        buffs = self.buff
+        self.buff = defaultdict(WriteBuffer)
         self.buff_size = 0
+        self.flush_buffers(buffs)
         return True
 
     def add_buff(
         self, db_name: str, key: Any, value: Any, is_serialize_value: bool = True
     ) -> bool:
-        if is_serialize_value:
-            value = serialize_value(value, **self.db_schema[db_name].get_value_args())
-        self.buff_size += sys.getsizeof(key) + sys.getsizeof(value)
+        if self.flush_error is not None:
+            # Fail fast instead of buffering behind a failed flush
+            self.wait_flush()
+        codec = self.codecs[db_name]
+        if not is_byte_obj(key):
+            key = codec.encode_key(key)
+        # Bytes values are stored as they are only with is_serialize_value=False
+        if not is_byte_obj(value) or is_serialize_value:
+            if self.workers > 1:
+                self.buff_size += self.buff[db_name].add_pending(key, value)
+            else:
+                value = codec.encode_value(value)
+                self.buff_size += self.buff[db_name].add(key, value)
+        else:
+            self.buff_size += self.buff[db_name].add(key, value)
 
-        self.buff[db_name].append([key, value])
         if self.buff_size > self.buff_limit:
-            self.save_buff()
+            if self.async_flush:
+                self.flush_buff_async()
+            else:
+                self.save_buff()
 
         return True
 
     def delete_buff(self, db_name: str, key: Any) -> bool:
-        found = -1
-        for i, (k, _) in enumerate(self.buff[db_name]):
-            if k == key:
-                found = i
-                break
-
-        if found >= 0:
-            del self.buff[db_name][found]
-            return True
-        else:
-            return False
+        """
+        Delete a key from the buffer and from the database at the next flush
+        :return: True if an item was buffered for the key
+        """
+        if not is_byte_obj(key):
+            key = self.codecs[db_name].encode_key(key)
+        return self.buff[db_name].remove(key)
@@ -4,6 +4,7 @@ import shutil
 from xmlrpc.client import FastParser
 
 import marisa_trie
+import numpy
 import pycedar
 from tqdm import tqdm
 
@@ -107,6 +108,18 @@ def lmdb_retrieval_single(data_file, queries):
         assert lmdb.get_value("lid_qid", item) == query
 
 
+@profile
+def lmdb_retrieval_session(data_file, queries):
+    gc.collect()
+    lmdb = FReadDB(db_file=data_file, readonly=True)
+    with lmdb.snapshot() as session:
+        for query in queries:
+            item = session.get_value("qid_lid", query)
+            if item is None:
+                continue
+            assert session.get_value("lid_qid", item) == query
+
+
 @profile
 def lmdb_retrieval_multi(data_file, queries):
     gc.collect()
@@ -115,6 +128,21 @@ def lmdb_retrieval_multi(data_file, queries):
     lmdb.get_values("lid_qid", lids)
 
 
+@profile
+def lmdb_retrieval_array(data_file, limit):
+    gc.collect()
+    lmdb = FReadDB(db_file=data_file, readonly=True)
+    lids = numpy.arange(limit)
+    lmdb.get_values_array("lid_qid", lids)
+
+
+@profile
+def lmdb_freeze(data_file):
+    lmdb = FReadDB(db_file=data_file, split_subdatabases=True)
+    lmdb.freeze(["qid_lid", "lid_qid"])
+    lmdb.close()
+
+
 @profile
 def cedar_create_save(data_file: str, limit: int):
     d_trie = pycedar.dict()
@@ -176,7 +204,15 @@ def bench_trie_vs_lmdb(limit=100_000):
     # Test with lmdb
     lmdb_create_save(data_file, limit)
     lmdb_retrieval_single(data_file, queries)
+    lmdb_retrieval_session(data_file, queries)
+    lmdb_retrieval_multi(data_file, queries)
+    lmdb_retrieval_array(data_file, limit)
+
+    # Test with the frozen perfect hash maps of the sub databases
+    lmdb_freeze(data_file)
+    lmdb_retrieval_single(data_file, queries)
     lmdb_retrieval_multi(data_file, queries)
+    lmdb_retrieval_array(data_file, limit)
 
     # Test Tries
     trie_create_save(data_file_trie, limit)
@@ -1,11 +1,25 @@
+import operator
+import random
 import shutil
+import threading
+import tracemalloc
 from textwrap import indent
 
 import marisa_trie
+import numpy
+import pytest
 import ujson
+from pyroaring import BitMap
 from tqdm import tqdm
 
-from freaddb.db_lmdb import SIZE_1GB, DBSpec, FReadDB, ToBytes, profile
+from freaddb.db_lmdb import (CACHE_MISSING, OPEN_SESSIONS, SIZE_1GB, SIZE_1MB,
+                             DBCodec, DBSpec, DBUpdateType, DenseMap, FReadDB,
+                             FrozenMap, KeyFormat, ToBytes, ValueCodec,
+                             ValueCompression, deserialize, deserialize_value,
+                             get_codec, get_packed_blocks, hash_frozen_key,
+                             hash_frozen_keys, pack_sorted_ints,
+                             pack_value_header, profile, serialize,
+                             serialize_value, unpack_sorted_ints)
 
 
 @profile
@@ -266,3 +280,1256 @@ def test_db_large_qid_split():
     db.save_buff()
     db.compress()
     db.close()
+
+
+@profile
+def test_db_read_session():
+    data_file = "/tmp/freaddb/db_test_read_session"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="qid_lid"),
+        DBSpec(name="lid_qid", integerkey=True),
+    ]
+    limit = 1_000
+
+    db = FReadDB(
+        db_file=data_file,
+        db_schema=data_schema,
+        buff_limit=SIZE_1GB,
+        split_subdatabases=True,
+    )
+    for i in range(limit):
+        db.add_buff("qid_lid", f"Q{i + 1}", i)
+        db.add_buff("lid_qid", i, f"Q{i + 1}")
+    db.save_buff()
+    db.close()
+    db = FReadDB(db_file=data_file, readonly=True)
+
+    with db.snapshot() as session:
+        for i in range(limit):
+            lid = session.get_value("qid_lid", f"Q{i + 1}")
+            assert lid == i
+            assert session.get_value("lid_qid", lid) == f"Q{i + 1}"
+        assert session.get_value("qid_lid", "Q0") is None
+        assert session.is_available("lid_qid", 10)
+        assert not session.is_available("lid_qid", limit)
+        assert session.get_value_byte_size("lid_qid", 10) is not None
+        assert session.get_values("lid_qid", [1, 2]) == {1: "Q2", 2: "Q3"}
+        assert session.get_number_items_from("lid_qid") == limit
+        assert len(list(session.get_db_iter("lid_qid", from_i=10, to_i=20))) == 10
+        assert len(list(session.get_iter_integerkey("lid_qid", 10, 19))) == 10
+
+
+@profile
+def test_db_session_isolation():
+    data_file = "/tmp/freaddb/db_test_session_isolation"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [DBSpec(name="items", integerkey=True)]
+    limit = 20_000
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    for i in range(limit):
+        db.add_buff("items", i, f"Q{i}")
+    db.save_buff()
+
+    # Writes after the session started do not change what it reads
+    with db.snapshot() as session:
+        assert session.get_value("items", 5) == "Q5"
+        for step in range(5):
+            for i in range(step, limit, 5):
+                db.add_buff("items", i, f"new {i}" * 3)
+            db.save_buff()
+            db.delete("items", step)
+        assert all(session.get_value("items", i) == f"Q{i}" for i in range(limit))
+        assert session.get_number_items_from("items") == limit
+    assert db.get_value("items", 5) == "new 5" * 3
+    assert db.get_value("items", 1) is None
+
+    # Growing the map makes open sessions stale
+    map_size = db.env["items"].info()["map_size"]
+    with db.snapshot() as session:
+        assert session.get_value("items", 5) == "new 5" * 3
+        db.add_buff("items", limit, "x" * map_size)
+        db.save_buff()
+        with pytest.raises(ValueError):
+            session.get_value("items", 5)
+    assert db.get_value("items", 5) == "new 5" * 3
+
+    # Single calls reuse the shared session of their thread, without a
+    # transaction between the calls
+    session = db.get_session()
+    assert db.get_value("items", 6) == "new 6" * 3
+    assert db.get_session() is session and not session.txns
+    db.close()
+
+    # Read-only envs are never resized, their sessions are not registered
+    db = FReadDB(db_file=data_file, readonly=True)
+    assert db.get_value("items", 6) == "new 6" * 3
+    assert db.get_session() not in OPEN_SESSIONS
+    with db.snapshot() as session:
+        assert session not in OPEN_SESSIONS
+    db.close()
+
+
+def test_db_codec():
+    codec = DBCodec(DBSpec(name="data0", combinekey=True, is_64bit=True))
+    key = codec.encode_key((1, 2**40, 3))
+    assert key.count(b"|") == 2
+    assert codec.decode_key(memoryview(key)) == (1, 2**40, 3)
+
+    codec = DBCodec(DBSpec(name="data1", integerkey=True))
+    assert codec.decode_key(codec.encode_key(7)) == 7
+
+    codec = DBCodec(DBSpec(name="data2", compress_value=True))
+    value = {"One": [1, 2, 3], "Two": {2, 1}}
+    assert codec.decode_value(codec.encode_value(value)) == {
+        "One": [1, 2, 3],
+        "Two": [1, 2],
+    }
+
+    codec = DBCodec(DBSpec(name="data3", bytes_value=ToBytes.INT_NUMPY))
+    assert codec.decode_value(codec.encode_value({3, 1, 2})).tolist() == [1, 2, 3]
+
+
+@profile
+def test_db_get_values_array():
+    data_file = "/tmp/freaddb/db_test_get_values_array"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="lid_qid", integerkey=True),
+        DBSpec(name="lid_pagerank", integerkey=True, bytes_value=ToBytes.BYTES),
+    ]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    for i in range(0, 1_000, 2):
+        db.add_buff("lid_qid", i, f"Q{i + 1}")
+        db.add_buff("lid_pagerank", i, numpy.float32(i / 10).tobytes())
+    db.save_buff()
+    db.close()
+    db = FReadDB(db_file=data_file, readonly=True)
+
+    keys = numpy.array([998, 3, 0, 0, 1_001, 500])
+    values, found = db.get_values_array("lid_qid", keys)
+    assert found.tolist() == [True, False, True, True, False, True]
+    assert values.tolist() == ["Q999", None, "Q1", "Q1", None, "Q501"]
+
+    values, found = db.get_values_array("lid_pagerank", keys, dtype=numpy.float32)
+    assert values.dtype == numpy.float32
+    assert numpy.allclose(values, [99.8, 0, 0, 0, 0, 50.0])
+    assert found.tolist() == [True, False, True, True, False, True]
+
+
+@profile
+def test_db_view():
+    data_file = "/tmp/freaddb/db_test_view"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="postings", integerkey=True, bytes_value=ToBytes.INT_NUMPY),
+        DBSpec(name="blobs", bytes_value=ToBytes.BYTES),
+    ]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    db.add_buff("postings", 1, list(range(100_000)))
+    db.add_buff("blobs", "One", b"1" * 1_000)
+    db.save_buff()
+    db.close()
+    db = FReadDB(db_file=data_file, readonly=True)
+
+    with db.view("postings", 1) as arr:
+        assert not arr.flags.owndata
+        assert not arr.flags.writeable
+        assert arr.sum() == sum(range(100_000))
+
+    with db.view("blobs", "One") as blob:
+        assert isinstance(blob, memoryview)
+        assert blob == b"1" * 1_000
+
+    with db.snapshot() as session:
+        assert session.get_view("postings", 2) is None
+        assert len(session.get_view("postings", 1)) == 100_000
+
+
+@profile
+def test_db_key_format():
+    data_file = "/tmp/freaddb/db_test_key_format"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="data0", integerkey=True),
+        DBSpec(name="data1", combinekey=True),
+        DBSpec(name="data2", integerkey=False),
+    ]
+    data = {
+        "data0": {i: f"Q{i}" for i in [0, 1, 255, 256, 70_000, 2**32 - 1]},
+        "data1": {
+            (1, 0, 1): "a",
+            (1, 2, 3): "b",
+            (1, 256, 0): "c",
+            (256, 1, 2): "d",
+            (8535637, 1, 2): "e",
+            (8535637, 300, 2): "f",
+            (13699655, 1, 2): "g",
+        },
+        "data2": {"One": 1, "Two": 2},
+    }
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    for data_name, data_items in data.items():
+        for key, value in data_items.items():
+            db.add_buff(data_name, key, value)
+    db.save_buff()
+
+    for key_format in [KeyFormat.BIG_ENDIAN, KeyFormat.VARINT]:
+        new_file = f"{data_file}_{key_format.name.lower()}"
+        shutil.rmtree(new_file, ignore_errors=True)
+        new_db = db.convert_key_format(new_file, key_format, show_progress=False)
+        new_db.close()
+        new_db = FReadDB(db_file=new_file, readonly=True)
+        assert new_db.db_schema["data1"].key_format == key_format
+        assert new_db.db_schema["data2"].key_format == KeyFormat.LEGACY
+
+        for data_name, data_items in data.items():
+            # Byte order of the keys is the natural order of ints and tuples
+            items = list(new_db.get_db_iter(data_name))
+            if data_name != "data2":
+                assert items == sorted(data_items.items())
+            assert new_db.get_values(data_name, list(data_items)) == data_items
+
+        prefix_items = dict(new_db.get_iter_with_prefix("data1", (8535637,)))
+        assert prefix_items == {(8535637, 1, 2): "e", (8535637, 300, 2): "f"}
+        new_db.close()
+    db.close()
+
+
+@profile
+def test_db_scan():
+    data_file = "/tmp/freaddb/db_test_scan"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="labels"),
+        DBSpec(name="lid_qid", integerkey=True),
+        DBSpec(name="triples", combinekey=True, key_format=KeyFormat.BIG_ENDIAN),
+    ]
+    labels = {f"Tokyo {i}": i for i in range(300)}
+    labels.update({"Tokya": -1, "Tokz": -2, "Tok": -3})
+    triples = {(i // 100, i % 100, 1): i for i in range(1_000)}
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    for key, value in labels.items():
+        db.add_buff("labels", key, value)
+    for i in range(1_000):
+        db.add_buff("lid_qid", i * 300, f"Q{i}")
+    for key, value in triples.items():
+        db.add_buff("triples", key, value)
+    db.save_buff()
+    db.close()
+    db = FReadDB(db_file=data_file, readonly=True)
+
+    batches = list(db.scan("labels", prefix="Tokyo ", batch_size=64))
+    assert [len(batch) for batch in batches] == [64, 64, 64, 64, 44]
+    assert dict(item for batch in batches for item in batch) == {
+        k: v for k, v in labels.items() if k.startswith("Tokyo ")
+    }
+    items = [
+        k for batch in db.scan("labels", prefix="Tok", get_values=False) for k in batch
+    ]
+    assert items == sorted(labels)
+    batches = list(db.scan("labels", prefix="Tokyo 1", limit=5, reverse=True))
+    assert [k for k, _ in batches[0]] == [
+        "Tokyo 199",
+        "Tokyo 198",
+        "Tokyo 197",
+        "Tokyo 196",
+        "Tokyo 195",
+    ]
+
+    items = [
+        k
+        for batch in db.scan("lid_qid", start=600, stop=3_000, get_values=False)
+        for k in batch
+    ]
+    assert items == list(range(600, 3_000, 300))
+    items = [
+        k
+        for batch in db.scan(
+            "lid_qid", start=601, stop=3_001, reverse=True, get_values=False
+        )
+        for k in batch
+    ]
+    assert items == list(range(3_000, 601, -300))
+    assert list(db.get_iter_integerkey("lid_qid", 0, 900)) == [
+        (0, "Q0"),
+        (300, "Q1"),
+        (600, "Q2"),
+        (900, "Q3"),
+    ]
+    assert list(db.scan("lid_qid", start=3_000, stop=600)) == []
+
+    items = [
+        k
+        for batch in db.scan("triples", start=(2, 95), stop=(3, 3), get_values=False)
+        for k in batch
+    ]
+    assert items == [(2, i, 1) for i in range(95, 100)] + [(3, i, 1) for i in range(3)]
+    items = [
+        k
+        for batch in db.scan(
+            "triples", prefix=(9,), reverse=True, limit=3, get_values=False
+        )
+        for k in batch
+    ]
+    assert items == [(9, 99, 1), (9, 98, 1), (9, 97, 1)]
+    assert dict(db.get_iter_with_prefix("triples", (4, 2))) == {(4, 2, 1): 402}
+
+
+@profile
+def test_db_position_index():
+    data_file = "/tmp/freaddb/db_test_position_index"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [DBSpec(name="qid_lid")]
+    limit = 10_000
+    data = {f"Q{i}": i for i in range(limit)}
+    sorted_keys = sorted(data)
+
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    for key, value in data.items():
+        db.add_buff("qid_lid", key, value)
+    db.save_buff()
+    assert db.get_position_index("qid_lid", limit) is None
+    assert [k for k, _ in db.get_db_iter("qid_lid", from_i=5_000, to_i=5_003)] == (
+        sorted_keys[5_000:5_003]
+    )
+    positions = [0, 1, 127, 128, 129, 5_000, 5_001, 9_999]
+    with db.snapshot() as session:
+        keys = [bytes(c.key()) for c in session.seek_positions("qid_lid", positions)]
+    assert keys == [sorted_keys[i].encode() for i in positions]
+    db.build_position_index(step=128)
+    assert len(db.get_position_index("qid_lid", limit)["keys"]) == 79
+    with db.snapshot() as session:
+        keys = [bytes(c.key()) for c in session.seek_positions("qid_lid", positions)]
+    assert keys == [sorted_keys[i].encode() for i in positions]
+
+    # Writes invalidate the index
+    db.add_buff("qid_lid", "Q-1", -1)
+    db.save_buff()
+    assert db.get_position_index("qid_lid", limit + 1) is None
+    db.delete("qid_lid", "Q-1")
+    db.compress(print_status=False)
+    db.close()
+
+    db = FReadDB(db_file=data_file, readonly=True)
+    assert db.get_position_index("qid_lid", limit) is not None
+    for from_i in [0, 1, 4_095, 4_096, 9_998]:
+        items = list(db.get_db_iter("qid_lid", from_i=from_i, to_i=from_i + 2))
+        assert items == [(k, data[k]) for k in sorted_keys[from_i : from_i + 2]]
+    assert list(db.head("qid_lid", n=3, from_i=7_000)) == sorted_keys[7_000:7_003]
+    assert list(db.get_db_iter("qid_lid", from_i=limit)) == []
+
+    samples = db.sample("qid_lid", 100)
+    assert len(set(k for k, _ in samples)) == 100
+    assert all(data[k] == v for k, v in samples)
+    assert db.get_random_key("qid_lid") in data
+
+
+def sum_values(batch):
+    return sum(v for _, v in batch)
+
+
+def count_items(batch):
+    return len(batch)
+
+
+@profile
+def test_db_parallel_scan():
+    data_file = "/tmp/freaddb/db_test_parallel_scan"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [DBSpec(name="lid_count", integerkey=True)]
+    limit = 10_000
+
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    for i in range(limit):
+        db.add_buff("lid_count", i, i * 2)
+    db.save_buff()
+    db.compress(print_status=False)
+    db.close()
+    db = FReadDB(db_file=data_file, readonly=True)
+
+    assert db.get_partition_keys("lid_count", 4) == [2_500, 5_000, 7_500]
+    total = db.parallel_scan("lid_count", sum_values, workers=2, reduce_fn=operator.add)
+    assert total == sum(i * 2 for i in range(limit))
+    counts = db.parallel_scan("lid_count", count_items, workers=3, chunk_keys=100)
+    assert sum(counts) == limit
+    assert max(counts) <= 100
+
+
+@profile
+def test_db_parallel_serialize():
+    data_file = "/tmp/freaddb/db_test_parallel_serialize"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="data0", integerkey=True, compress_value=True),
+        DBSpec(name="data1", bytes_value=ToBytes.INT_BITMAP),
+        DBSpec(name="data2", integerkey=True),
+        DBSpec(name="header", value_header=True, compress_value=True),
+        DBSpec(name="pickle", bytes_value=ToBytes.PICKLE),
+    ]
+    limit = 1_000
+    db = FReadDB(
+        db_file=data_file,
+        db_schema=data_schema,
+        buff_limit=SIZE_1GB,
+        workers=2,
+        chunk_size=100,
+    )
+    for i in range(limit):
+        db.add_buff("data0", limit - i, {"label": f"Q{i}"})
+        db.add_buff("data1", f"Q{i}", list(range(i % 10)))
+        # Bytes values are serialized like with workers=1
+        db.add_buff("header", f"Q{i}", f"value {i}".encode() * 10)
+        db.add_buff("pickle", f"Q{i}", f"value {i}".encode())
+    # The last value of a key wins
+    db.add_buff("data0", 1, {"label": "last"})
+    db.save_buff()
+
+    FReadDB.write_with_buffer(
+        db.env["data2"],
+        db.dbs["data2"],
+        {i: str(i) for i in range(limit)},
+        show_progress=False,
+        workers=2,
+        chunk_size=128,
+        **db.db_schema["data2"].get_args(),
+    )
+    db.close()
+
+    db = FReadDB(db_file=data_file, readonly=True)
+    assert db.get_value("data0", 1) == {"label": "last"}
+    assert db.get_value("data0", 2) == {"label": f"Q{limit - 2}"}
+    assert list(db.get_value("data1", "Q15")) == list(range(5))
+    assert [k for k, _ in db.get_db_iter("data0")] == list(range(1, limit + 1))
+    assert dict(db.get_db_iter("data2")) == {i: str(i) for i in range(limit)}
+    # Undecodable values would come back as memoryviews of the stored bytes
+    value = db.get_value("header", "Q7")
+    assert isinstance(value, bytes) and value == b"value 7" * 10
+    value = db.get_value("pickle", "Q7")
+    assert isinstance(value, bytes) and value == b"value 7"
+
+
+@profile
+def test_db_load_stream():
+    data_file = "/tmp/freaddb/db_test_load_stream"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="lid_qid", integerkey=True),
+        DBSpec(name="qid_lid", compress_value=True),
+    ]
+    limit = 20_000
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+
+    def generate_items():
+        for i in range(limit):
+            yield (i * 7_919) % limit, f"Q{i}"
+        yield 5, "last"
+
+    # A small memory limit spills many sorted runs to disk
+    n_items = db.load_stream(
+        "lid_qid", generate_items(), memory_limit=50_000, show_progress=False
+    )
+    assert n_items == limit + 1
+    n_items = db.load_stream(
+        "qid_lid", ((f"Q{i}", i) for i in range(limit)), show_progress=False
+    )
+    assert n_items == limit
+    db.close()
+
+    db = FReadDB(db_file=data_file, readonly=True)
+    assert db.get_number_items_from("lid_qid") == limit
+    assert [k for k, _ in db.get_db_iter("lid_qid")] == list(range(limit))
+    assert db.get_value("lid_qid", 5) == "last"
+    assert db.get_value("lid_qid", 7_919) == "Q1"
+    assert db.get_value("qid_lid", "Q123") == 123
+
+
+@profile
+def test_db_append_write():
+    data_file = "/tmp/freaddb/db_test_append_write"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="appended", integerkey=True),
+        DBSpec(name="random", integerkey=True),
+    ]
+    limit = 50_000
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    env, db_codec = db.env["appended"], db.codecs["appended"]
+
+    # Sorted batches after the last key are appended
+    for start in range(0, limit, 10_000):
+        data = [(i, f"Q{i}") for i in range(start, start + 10_000)]
+        assert FReadDB.write(env, db.dbs["appended"], data, codec=db_codec) == 10_000
+    # Out of order and duplicated keys fall back to normal puts
+    data = [(5, "five"), (limit + 1, "after"), (5, "five")]
+    assert FReadDB.write(env, db.dbs["appended"], data, codec=db_codec) == 3
+    with env.begin(write=True) as txn:
+        data = [(db_codec.encode_key(i), b"\x00") for i in (limit + 2, 7, limit + 3)]
+        assert not FReadDB.is_appendable(txn, data, db_codec)
+
+    for i in random.sample(range(limit), limit):
+        db.add_buff("random", i, f"Q{i}")
+        if i % 10_000 == 0:
+            db.save_buff()
+    db.save_buff()
+
+    assert db.get_value("appended", 5) == "five"
+    assert db.get_value("appended", limit + 1) == "after"
+    assert db.get_value("appended", 49_999) == "Q49999"
+    assert db.get_number_items_from("appended") == limit + 1
+    with env.begin() as txn:
+        appended_pages = txn.stat(db.dbs["appended"])["leaf_pages"]
+        random_pages = txn.stat(db.dbs["random"])["leaf_pages"]
+    # Appended pages are full
+    assert appended_pages < random_pages
+    db.close()
+
+
+@profile
+def test_db_write_buffer():
+    data_file = "/tmp/freaddb/db_test_write_buffer"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="integer", integerkey=True),
+        DBSpec(name="string", integerkey=False),
+    ]
+    limit = 10_000
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    for i in random.sample(range(limit), limit):
+        db.add_buff("integer", i, f"Q{i}")
+        db.add_buff("string", f"Q{i}", i)
+    # The last buffered value of a key wins
+    db.add_buff("integer", 7, "seven")
+    db.add_buff("string", "Q7", -7)
+    assert db.delete_buff("integer", 8)
+    assert db.delete_buff("string", "Q8")
+    assert not db.delete_buff("string", "missing")
+
+    # Buffer size is the serialized bytes plus the offsets
+    assert len(db.buff["integer"]) == limit - 1
+    assert db.buff_size == sum(buff.get_size() for buff in db.buff.values()) - 32
+    db.save_buff()
+
+    assert db.get_number_items_from("integer") == limit - 1
+    assert db.get_number_items_from("string") == limit - 1
+    assert db.get_value("integer", 7) == "seven"
+    assert db.get_value("string", "Q7") == -7
+    assert db.get_value("integer", 8) is None
+    assert db.get_value("string", "Q9") == 9
+    db.close()
+
+
+@profile
+def test_db_write_buffer_size():
+    data_file = "/tmp/freaddb/db_test_write_buffer_size"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [DBSpec(name="items", integerkey=True), DBSpec(name="labels")]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    limit = 100_000
+    # The accounted size follows the memory the buffer really allocates
+    tracemalloc.start()
+    for i in range(limit):
+        db.add_buff("items", i, i)
+        db.add_buff("labels", f"Q{i}", f"label {i}")
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert 0.8 < allocated / db.buff_size < 1.25
+    db.close()
+
+
+@profile
+def test_db_read_your_writes():
+    data_file = "/tmp/freaddb/db_test_read_your_writes"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [DBSpec(name="items", integerkey=True)]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    for i in range(100):
+        db.add_buff("items", i, f"Q{i}")
+    db.save_buff()
+
+    db.add_buff("items", 1, "one")
+    db.add_buff("items", 100, "Q100")
+    assert db.delete_buff("items", 100)
+    assert not db.delete_buff("items", 2)
+    db.add_buff("items", 101, "Q101")
+    assert len(db.buff["items"]) == 2
+
+    # Unflushed items are only visible when checking the buffer
+    assert db.get_value("items", 1) == "Q1"
+    assert db.get_value("items", 1, check_buffer=True) == "one"
+    assert db.get_value("items", 2, check_buffer=True) is None
+    assert db.get_value("items", 3, check_buffer=True) == "Q3"
+    assert db.get_values("items", [1, 2, 3, 100, 101], check_buffer=True) == {
+        1: "one",
+        3: "Q3",
+        101: "Q101",
+    }
+
+    # Tombstones are deleted from LMDB at flush time
+    db.save_buff()
+    assert db.get_value("items", 1) == "one"
+    assert db.get_value("items", 2) is None
+    assert db.get_value("items", 101) == "Q101"
+    assert db.get_number_items_from("items") == 100
+    db.close()
+
+
+@profile
+def test_db_async_flush():
+    data_file = "/tmp/freaddb/db_test_async_flush"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [DBSpec(name="items", integerkey=True)]
+    limit = 100_000
+    db = FReadDB(
+        db_file=data_file,
+        db_schema=data_schema,
+        buff_limit=SIZE_1MB,
+        async_flush=True,
+    )
+    for i in range(limit):
+        db.add_buff("items", i, f"Q{i}")
+        if i % 10_000 == 0:
+            # Items in flight to the writer thread can still be read
+            assert db.get_value("items", i, check_buffer=True) == f"Q{i}"
+    assert db.flusher is not None
+    db.delete_buff("items", 0)
+    db.save_buff()
+    assert not db.flushing
+    assert db.get_number_items_from("items") == limit - 1
+    assert db.get_value("items", 0) is None
+    assert db.get_value("items", limit - 1) == f"Q{limit - 1}"
+    db.close()
+    assert db.flusher is None
+
+    # After a failed flush, queued buffers are not written and writes fail fast
+    db = FReadDB(db_file=data_file, async_flush=True, flush_queue_size=4)
+    write_buffer = db.write_buffer
+
+    def fail_write_buffer(*args):
+        raise RuntimeError("disk full")
+
+    db.write_buffer = fail_write_buffer
+    db.buff_limit = 1_000
+    with pytest.raises(ValueError, match="buffers were not written"):
+        for i in range(limit):
+            db.add_buff("items", i, "failed")
+    assert not db.flushing
+    db.write_buffer = write_buffer
+    db.buff.clear()
+    db.buff_size = 0
+    db.close()
+    db = FReadDB(db_file=data_file, readonly=True)
+    assert db.get_value("items", 1) == "Q1"
+    db.close()
+
+    # The writer thread grows the map while another thread reads
+    shutil.rmtree(data_file, ignore_errors=True)
+    db = FReadDB(
+        db_file=data_file,
+        db_schema=data_schema,
+        buff_limit=SIZE_1MB,
+        map_size=SIZE_1MB * 4,
+        async_flush=True,
+    )
+    for i in range(1_000):
+        db.add_buff("items", i, f"Q{i}")
+    db.save_buff()
+    map_size = db.env["items"].info()["map_size"]
+    stop, missing = threading.Event(), []
+
+    def read_items():
+        while not stop.is_set():
+            missing.extend(i for i in range(1_000) if db.get_value("items", i) is None)
+
+    reader = threading.Thread(target=read_items)
+    reader.start()
+    for i in range(1_000, 20_000):
+        db.add_buff("items", i, "x" * 1_000)
+    db.save_buff()
+    stop.set()
+    reader.join()
+    assert db.env["items"].info()["map_size"] > map_size
+    assert not missing
+    db.close()
+
+
+@profile
+def test_db_update_bulk():
+    data_file = "/tmp/freaddb/db_test_update_bulk"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="set", integerkey=True, bytes_value=ToBytes.INT_NUMPY),
+        DBSpec(name="counter", integerkey=False),
+        DBSpec(name="max", integerkey=True),
+        DBSpec(name="list", integerkey=True),
+        DBSpec(name="custom", integerkey=True),
+    ]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    for i in range(100):
+        db.add_buff("set", i, {i, i + 1})
+        db.add_buff("counter", f"Q{i}", i)
+        db.add_buff("max", i, i)
+        db.add_buff("list", i, [i])
+        db.add_buff("custom", i, f"Q{i}")
+    db.save_buff()
+
+    kwargs = {"show_progress": False, "step": 30}
+    db.update_bulk_with_buffer("set", {1: [1], 2: [7], 200: [3]}, **kwargs)
+    db.update_bulk_with_buffer(
+        "counter", [("Q1", 10), ("Q1", 5), ("Q200", 1)], DBUpdateType.COUNTER, **kwargs
+    )
+    db.update_bulk_with_buffer(
+        "max", {i: 50 for i in range(200)}, DBUpdateType.MAX, **kwargs
+    )
+    db.update_bulk_with_buffer("list", {1: [10, 11]}, DBUpdateType.LIST, **kwargs)
+    db.update_bulk_with_buffer(
+        "custom", {1: "x", 300: "y"}, lambda db_value, value: db_value + value, **kwargs
+    )
+
+    assert db.get_value("set", 1).tolist() == [1, 2]
+    assert db.get_value("set", 2).tolist() == [2, 3, 7]
+    assert db.get_value("set", 200).tolist() == [3]
+    assert db.get_value("counter", "Q1") == 16
+    assert db.get_value("counter", "Q200") == 1
+    assert db.get_value("max", 10) == 50
+    assert db.get_value("max", 70) == 70
+    assert db.get_value("max", 150) == 50
+    assert db.get_value("list", 1) == [1, 10, 11]
+    assert db.get_value("custom", 1) == "Q1x"
+    assert db.get_value("custom", 300) == "y"
+    db.close()
+
+
+@profile
+def test_db_bitmap():
+    data_file = "/tmp/freaddb/db_test_bitmap"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [DBSpec(name="index", bytes_value=ToBytes.INT_BITMAP)]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    db.add_buff("index", "even", range(0, 100, 2))
+    db.add_buff("index", "odd", range(1, 100, 2))
+    db.add_buff("index", "small", range(10))
+    db.save_buff()
+
+    assert list(db.bitmap_and("index", ["even", "small"])) == [0, 2, 4, 6, 8]
+    assert list(db.bitmap_and("index", ["even", "missing"])) == []
+    assert len(db.bitmap_or("index", ["even", "odd", "missing"])) == 100
+    assert list(db.bitmap_andnot("index", ["small", "even"])) == [1, 3, 5, 7, 9]
+    assert db.bitmap_cardinality("index", ["even", "small", "missing"]) == {
+        "even": 50,
+        "small": 10,
+    }
+    assert db.bitmap_cardinality("index", ["odd", "small"], op="and") == 5
+
+    db.update_bulk_with_buffer(
+        "index",
+        {"small": BitMap([5, 200]), "odd": [1, 3], "new": [7]},
+        DBUpdateType.BITMAP_OR,
+        show_progress=False,
+    )
+    assert list(db.bitmap_or("index", ["small"])) == list(range(10)) + [200]
+    assert len(db.bitmap_or("index", ["odd"])) == 50
+    assert list(db.bitmap_or("index", ["new"])) == [7]
+    db.close()
+
+
+@profile
+def test_db_posting_lists():
+    data_file = "/tmp/freaddb/db_test_posting_lists"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [DBSpec(name="postings", bytes_value=ToBytes.INT_NUMPY)]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    postings = {
+        "all": set(range(100_000)),
+        "even": set(range(0, 100_000, 2)),
+        "three": set(range(0, 100_000, 3)),
+        "few": {6, 7, 12, 99_999},
+    }
+    for key, value in postings.items():
+        db.add_buff("postings", key, value)
+    db.save_buff()
+
+    def expect(*keys, union=False):
+        items = set.union(*keys) if union else set.intersection(*keys)
+        return sorted(items)
+
+    # Galloping over skewed sizes, and merging similar sizes
+    assert db.postings_intersect("postings", ["all", "few"]).tolist() == expect(
+        postings["all"], postings["few"]
+    )
+    assert db.postings_intersect("postings", ["even", "three", "few"]).tolist() == [
+        6,
+        12,
+    ]
+    assert db.postings_intersect("postings", ["even", "three"]).tolist() == expect(
+        postings["even"], postings["three"]
+    )
+    assert len(db.postings_intersect("postings", ["even", "missing"])) == 0
+    assert db.postings_union("postings", ["even", "few"]).tolist() == expect(
+        postings["even"], postings["few"], union=True
+    )
+    assert db.postings_count("postings", ["even", "three"]) == 16_667
+    assert db.postings_count("postings", ["even", "three"], op="or") == 66_667
+
+    items, counts = db.postings_top_k("postings", ["all", "even", "three", "few"], k=3)
+    assert items.tolist() == [6, 12, 0]
+    assert counts.tolist() == [4, 4, 3]
+    for k in [0, -1]:
+        items, counts = db.postings_top_k("postings", ["all", "even"], k=k)
+        assert len(items) == len(counts) == 0
+    db.close()
+
+
+@profile
+def test_db_value_cache():
+    data_file = "/tmp/freaddb/db_test_value_cache"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="lru", integerkey=True, cache_size=10),
+        DBSpec(name="slru", integerkey=True, cache_size=10, cache_policy="slru"),
+        DBSpec(name="numpy", integerkey=True, bytes_value=ToBytes.INT_NUMPY),
+    ]
+    db = FReadDB(
+        db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB, cache_size=5
+    )
+    for i in range(100):
+        db.add_buff("lru", i, {"id": i})
+        db.add_buff("slru", i, {"id": i})
+        db.add_buff("numpy", i, [i, i + 1])
+    db.save_buff()
+
+    for _ in range(2):
+        assert db.get_value("lru", 1) == {"id": 1}
+        assert db.get_value("slru", 1) == {"id": 1}
+    assert db.get_values("lru", [1, 2]) == {1: {"id": 1}, 2: {"id": 2}}
+    assert db.cache_stats()["lru"] == {
+        "entries": 2,
+        "bytes": db.caches["lru"].n_bytes,
+        "hits": 2,
+        "misses": 2,
+        "evictions": 0,
+    }
+    # A scan of cold keys evicts the hot key from LRU but not from SLRU
+    for i in range(10, 30):
+        db.get_value("lru", i)
+        db.get_value("slru", i)
+    assert db.caches["lru"].get(db.codecs["lru"].encode_key(1)) is CACHE_MISSING
+    assert db.get_value("slru", 1) == {"id": 1}
+    assert db.cache_stats()["slru"]["evictions"] == 11
+
+    # Cached arrays do not point into the memory map
+    assert db.get_value("numpy", 3).tolist() == [3, 4]
+    assert db.get_value("numpy", 3).base is None
+
+    # Writes through the instance invalidate cached values
+    db.get_value("lru", 5)
+    db.add_buff("lru", 5, {"id": -5})
+    db.save_buff()
+    assert db.get_value("lru", 5) == {"id": -5}
+    db.delete("lru", 5)
+    assert db.get_value("lru", 5) is None
+    db.update_bulk_with_buffer(
+        "slru", {1: {"id": -1}}, lambda db_value, value: value, show_progress=False
+    )
+    assert db.get_value("slru", 1) == {"id": -1}
+
+    # A session older than a write does not cache its stale values
+    with db.snapshot() as session:
+        assert session.get_value("lru", 7) == {"id": 7}
+        db.add_buff("lru", 7, {"id": -7})
+        db.save_buff()
+        assert session.get_value("lru", 7) == {"id": 7}
+    assert db.get_value("lru", 7) == {"id": -7}
+
+    # Invalidation from another thread, like the async flusher
+    cache = db.caches["lru"]
+    stop = threading.Event()
+
+    def invalidate():
+        while not stop.is_set():
+            db.invalidate_cache("lru")
+
+    thread = threading.Thread(target=invalidate)
+    thread.start()
+    for i in range(20_000):
+        db.get_value("lru", i % 100)
+    stop.set()
+    thread.join()
+    assert cache.n_bytes == sum(size for _, size in cache.probation.values())
+    db.close()
+
+
+@profile
+def test_db_value_header():
+    data_file = "/tmp/freaddb/db_test_value_header"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="obj", value_header=True, compress_value=True),
+        DBSpec(
+            name="numpy",
+            integerkey=True,
+            bytes_value=ToBytes.INT_NUMPY,
+            value_header=True,
+        ),
+    ]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    long_value = {"label": "a" * 1_000}
+    db.add_buff("obj", "small", {"id": 1})
+    db.add_buff("obj", "long", long_value)
+    db.add_buff("obj", "raw", b"\x00\x01")
+    db.add_buff("numpy", 1, {3, 1, 2})
+    db.save_buff()
+
+    codec = db.codecs["obj"]
+    small, long = codec.encode_value({"id": 1}), codec.encode_value(long_value)
+    # Tiny values are stored uncompressed, compression is kept when it helps
+    assert small[0] == pack_value_header(ValueCodec.MSGPACK)
+    assert long[0] == pack_value_header(ValueCodec.MSGPACK, ValueCompression.LZ4)
+    assert len(long) < 100
+    assert db.get_value("obj", "small") == {"id": 1}
+    assert db.get_value("obj", "long") == long_value
+    assert db.get_value("obj", "raw") == b"\x00\x01"
+    assert db.get_value("numpy", 1).tolist() == [1, 2, 3]
+    with db.view("numpy", 1) as arr:
+        assert arr.tolist() == [1, 2, 3]
+
+    # Values of another codec decode by their header
+    db.add_buff(
+        "obj",
+        "pickle",
+        get_codec(bytes_value=ToBytes.PICKLE, value_header=True).encode_value({1, 2}),
+        is_serialize_value=False,
+    )
+    db.save_buff()
+    assert db.get_value("obj", "pickle") == {1, 2}
+    with pytest.raises(ValueError):
+        codec.decode_value(b"\xff")
+
+    # The module helpers take the codec fields of DBSpec
+    value = {"label": "Q1" * 100}
+    db_spec = db.db_schema["obj"]
+    value_obj = serialize_value(value, **db_spec.get_value_args())
+    assert db.codecs["obj"].encode_value(value) == value_obj
+    assert deserialize_value(value_obj, **db_spec.get_value_args()) == value
+    key_obj, value_obj = serialize("Q1", value, **db_spec.get_args())
+    assert deserialize(key_obj, value_obj, **db_spec.get_args()) == ("Q1", value)
+    db.close()
+
+
+@profile
+def test_db_value_dict():
+    data_file = "/tmp/freaddb/db_test_value_dict"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [DBSpec(name="items", value_header=True, compress_value=True)]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    countries = ["Q30", "Q17", "Q145"]
+    items = {
+        f"Q{i}": {
+            "label": f"entity {i}",
+            "description": f"Wikidata item about a person with number {i}",
+            "instance_of": "Q5",
+            "country": countries[i % 3],
+        }
+        for i in range(5_000)
+    }
+    for key, value in items.items():
+        db.add_buff("items", key, value)
+    db.save_buff()
+    ratio = db.compression_stats()["items"]["ratio"]
+
+    assert db.train_value_dict("items", n_samples=1_000)
+    assert db.get_value("items", "Q10") == items["Q10"]
+
+    # Retrain from values encoded with the first dictionary
+    db.compress(print_status=False)
+    assert db.db_schema["items"].value_dict
+    assert db.compression_stats("items")["items"]["ratio"] > ratio * 1.5
+    db.close()
+
+    # The dictionary is loaded from the metadata
+    db = FReadDB(db_file=data_file, readonly=True)
+    assert db.get_value("items", "Q10") == items["Q10"]
+    assert db.get_values("items", ["Q1", "Q4999"]) == {
+        "Q1": items["Q1"],
+        "Q4999": items["Q4999"],
+    }
+    db.close()
+
+
+@profile
+def test_db_int_packed():
+    data_file = "/tmp/freaddb/db_test_int_packed"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="packed", bytes_value=ToBytes.INT_PACKED),
+        DBSpec(name="header", bytes_value=ToBytes.INT_PACKED, value_header=True),
+        DBSpec(name="numpy", bytes_value=ToBytes.INT_NUMPY),
+    ]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    postings = {
+        "empty": set(),
+        "one": {7},
+        "dense": set(range(0, 300_000, 3)),
+        "sparse": set(random.sample(range(2**32 - 1), 1_000)) | {0, 6, 300},
+        "few": {6, 7, 300, 299_997},
+    }
+    for key, value in postings.items():
+        for db_name in ["packed", "header", "numpy"]:
+            db.add_buff(db_name, key, value)
+    db.save_buff()
+
+    for key, value in postings.items():
+        assert db.get_value("packed", key).tolist() == sorted(value)
+        assert db.get_value("header", key).tolist() == sorted(value)
+    # Deltas of 3 take 2 bits instead of 4 bytes
+    assert db.get_value_byte_size("packed", "dense") < 100_000 * 4 / 10
+
+    for db_name in ["packed", "header"]:
+        for keys in [["dense", "few"], ["dense", "sparse"], ["sparse", "few", "dense"]]:
+            assert (
+                db.postings_intersect(db_name, keys).tolist()
+                == db.postings_intersect("numpy", keys).tolist()
+            )
+        assert db.postings_union(db_name, ["one", "few"]).tolist() == [
+            6,
+            7,
+            300,
+            299_997,
+        ]
+
+    # Only the blocks around the items are unpacked
+    dense = pack_sorted_ints(postings["dense"])
+    n_items, firsts, _ = get_packed_blocks(dense)
+    assert n_items == 100_000
+    assert unpack_sorted_ints(dense, [1]).tolist() == list(range(384, 768, 3))
+    db.close()
+
+
+@profile
+def test_db_ndarray():
+    data_file = "/tmp/freaddb/db_test_ndarray"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="arrays", integerkey=True, bytes_value=ToBytes.NDARRAY),
+        DBSpec(
+            name="header",
+            integerkey=True,
+            bytes_value=ToBytes.NDARRAY,
+            value_header=True,
+        ),
+    ]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    arrays = {
+        0: numpy.random.rand(768).astype(numpy.float32),
+        1: numpy.random.rand(16).astype(numpy.float16),
+        2: numpy.arange(10, dtype=numpy.int64) * 2**40,
+        3: numpy.arange(12, dtype=numpy.float32).reshape(3, 4),
+        4: numpy.array([], dtype=numpy.int64),
+        5: numpy.arange(4, dtype=numpy.int32).reshape((1,) * 20 + (4,)),
+    }
+    for db_name in ["arrays", "header"]:
+        for key, value in arrays.items():
+            db.add_buff(db_name, key, value)
+    db.save_buff()
+
+    for db_name in ["arrays", "header"]:
+        for key, value in arrays.items():
+            arr = db.get_value(db_name, key)
+            assert arr.dtype == value.dtype
+            assert arr.shape == value.shape
+            assert numpy.array_equal(arr, value)
+        # Embeddings in overflow pages are aligned views of the memory map
+        with db.view(db_name, 0) as arr:
+            assert arr.flags.aligned
+            assert arr.base is not None
+            assert numpy.array_equal(arr, arrays[0])
+
+    # The data offset of the header is one byte
+    for db_spec in db.db_schema.values():
+        with pytest.raises(ValueError, match="does not fit"):
+            serialize_value(numpy.zeros((1,) * 32), **db_spec.get_value_args())
+    db.close()
+
+
+@profile
+def test_db_record():
+    data_file = "/tmp/freaddb/db_test_record"
+    shutil.rmtree(data_file, ignore_errors=True)
+    record_schema = [
+        ("label", "str"),
+        ("types", "obj"),
+        ("popularity", "uint32"),
+        ("pagerank", "float64"),
+    ]
+    data_schema = [
+        DBSpec(name="records", bytes_value=ToBytes.RECORD, record_schema=record_schema),
+        DBSpec(
+            name="header",
+            bytes_value=ToBytes.RECORD,
+            record_schema=record_schema,
+            value_header=True,
+            compress_value=True,
+        ),
+        DBSpec(
+            name="labels",
+            bytes_value=ToBytes.RECORD,
+            record_schema=[("label", "str"), ("types", "obj")],
+        ),
+    ]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    records = {
+        f"Q{i}": {
+            "label": f"entity {i}" * (i % 5),
+            "types": [i, i + 1] if i % 2 else None,
+            "popularity": i * 10,
+            "pagerank": i / 100,
+        }
+        for i in range(1_000)
+    }
+    for db_name in ["records", "header"]:
+        for key, value in records.items():
+            db.add_buff(db_name, key, value)
+    for key, value in records.items():
+        db.add_buff("labels", key, {"label": value["label"], "types": value["types"]})
+    db.save_buff()
+    db.add_buff("records", "Q1", dict(records["Q1"], popularity=7))
+    db.close()
+
+    db = FReadDB(db_file=data_file, readonly=True)
+    keys = ["Q3", "missing", "Q998"]
+    for db_name in ["records", "header"]:
+        assert db.get_value(db_name, "Q3") == records["Q3"]
+        assert db.get_value(db_name, "Q998", fields=["pagerank", "label"]) == {
+            "pagerank": 9.98,
+            "label": "entity 998" * 3,
+        }
+        assert db.get_value(db_name, "missing", fields=["label"]) is None
+
+        columns, found = db.get_values(
+            db_name, keys, fields=["popularity", "pagerank", "types"]
+        )
+        assert found.tolist() == [True, False, True]
+        assert columns["popularity"].dtype == numpy.uint32
+        assert columns["popularity"].tolist() == [30, 0, 9_980]
+        assert columns["pagerank"].tolist() == [0.03, 0.0, 9.98]
+        assert columns["types"].tolist() == [[3, 4], None, None]
+
+        # No rows to decode
+        columns, found = db.get_values(db_name, ["missing"], fields=["pagerank"])
+        assert found.tolist() == [False]
+        assert columns["pagerank"].tolist() == [0.0]
+        columns, found = db.get_values(db_name, [], fields=["pagerank", "label"])
+        assert not len(found)
+        assert not len(columns["pagerank"]) and not len(columns["label"])
+
+    # Records without fixed-width fields
+    columns, found = db.get_values("labels", keys, fields=["label", "types"])
+    assert found.tolist() == [True, False, True]
+    assert columns["label"].tolist() == ["entity 3" * 3, None, "entity 998" * 3]
+    assert columns["types"].tolist() == [[3, 4], None, None]
+    assert db.get_value("records", "Q1", fields=["popularity"]) == {"popularity": 7}
+    with pytest.raises(ValueError):
+        db.get_value("records", "Q1", fields=["unknown"])
+    db.close()
+
+
+@profile
+def test_db_freeze():
+    data_file = "/tmp/freaddb/db_test_freeze"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="labels", freeze=True),
+        DBSpec(name="ints", integerkey=True, bytes_value=ToBytes.INT_NUMPY),
+        DBSpec(name="empty", freeze=True),
+    ]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    labels = {f"Q{i}": f"label {i}" for i in range(10_000)}
+    for key, value in labels.items():
+        db.add_buff("labels", key, value)
+    for i in range(1_000):
+        db.add_buff("ints", i, [i, i + 1])
+    db.compress(print_status=False)
+    assert set(db.frozen) == {"labels", "empty"}
+    db.freeze(["ints"])
+    db.close()
+
+    db = FReadDB(db_file=data_file, readonly=True)
+    assert set(db.frozen) == {"labels", "ints", "empty"}
+    with db.snapshot() as session:
+        assert all(session.get_value("labels", k) == v for k, v in labels.items())
+        assert session.get_value("labels", "missing") is None
+        assert session.is_available("labels", "Q7")
+        assert not session.is_available("labels", "missing")
+        assert session.get_value_byte_size("labels", "Q7") > 0
+        # Single lookups of frozen sub databases need no read transaction
+        assert not session.txns
+        assert session.get_values("labels", ["Q3", "missing", "Q9999"]) == {
+            "Q3": "label 3",
+            "Q9999": "label 9999",
+        }
+        assert session.get_value("ints", 7).tolist() == [7, 8]
+        values, found = session.get_values_array("ints", [5, 5_000, 999])
+        assert found.tolist() == [True, False, True]
+        assert values[2].tolist() == [999, 1000]
+        assert session.get_value("empty", "Q1") is None
+    frozen, codec = db.frozen["labels"], db.codecs["labels"]
+    assert codec.decode_value(frozen.get(codec.encode_key("Q42"))) == "label 42"
+    assert frozen.get(codec.encode_key("missing")) is None
+    keys = [b"", b"\x00", b"a\x00\x00", b"Q1", b"x" * 511]
+    assert hash_frozen_keys(keys).tolist() == [hash_frozen_key(k) for k in keys]
+    db.close()
+
+    # Writes drop the frozen map of the sub database
+    db = FReadDB(db_file=data_file)
+    db.delete("labels", "Q3")
+    assert "labels" not in db.frozen
+    assert db.get_value("labels", "Q3") is None
+    assert db.get_value("labels", "Q4") == "label 4"
+    assert db.get_value("ints", 7).tolist() == [7, 8]
+    db.close()
+
+
+@profile
+def test_db_dense_keys():
+    data_file = "/tmp/freaddb/db_test_dense_keys"
+    shutil.rmtree(data_file, ignore_errors=True)
+    data_schema = [
+        DBSpec(name="fixed", integerkey=True, bytes_value=ToBytes.BYTES),
+        DBSpec(name="labels", integerkey=True, dense_keys=True),
+        DBSpec(name="sparse", integerkey=True),
+        DBSpec(name="never", integerkey=True, dense_keys=False),
+    ]
+    db = FReadDB(db_file=data_file, db_schema=data_schema, buff_limit=SIZE_1GB)
+    limit = 10_000
+    for i in range(limit):
+        if i % 7:
+            db.add_buff("fixed", i, numpy.int64(i * 3).tobytes())
+        db.add_buff("labels", i, f"Q{i}")
+        db.add_buff("sparse", i * 1_000, f"Q{i}")
+        db.add_buff("never", i, f"Q{i}")
+    db.add_buff("labels", limit * 3, "last")
+    db.freeze(["fixed", "labels", "sparse", "never"])
+    assert isinstance(db.frozen["fixed"], DenseMap)
+    assert db.frozen["fixed"].value_width == 8
+    assert isinstance(db.frozen["labels"], DenseMap)
+    assert isinstance(db.frozen["sparse"], FrozenMap)
+    assert isinstance(db.frozen["never"], FrozenMap)
+    db.close()
+
+    db = FReadDB(db_file=data_file, readonly=True)
+    assert isinstance(db.frozen["fixed"], DenseMap)
+    keys = numpy.array([0, 1, 14, 15, limit - 1, limit, limit * 5])
+    values, found = db.get_values_array("fixed", keys, dtype=numpy.int64)
+    assert found.tolist() == [False, True, False, True, True, False, False]
+    assert values.tolist() == [0, 3, 0, 45, (limit - 1) * 3, 0, 0]
+
+    values, found = db.get_values_array("labels", keys)
+    assert found.tolist() == [True, True, True, True, True, False, False]
+    assert values.tolist() == ["Q0", "Q1", "Q14", "Q15", f"Q{limit - 1}", None, None]
+    assert db.get_values("labels", [2, limit * 3, limit + 1]) == {
+        2: "Q2",
+        limit * 3: "last",
+    }
+    assert db.get_value("labels", limit * 3) == "last"
+    assert db.get_values("sparse", [2_000, 2_001]) == {2_000: "Q2"}
+    db.close()